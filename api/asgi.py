@@ -0,0 +1,32 @@
+"""
+ASGI entrypoint, serves the async endpoints of api/rest/v1/async_views.py and every other endpoint through Django
+
+    daphne -b 0.0.0.0 -p 8000 api.asgi:application
+"""
+import os
+
+import django
+
+from watchtower.settings.base import ENV
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "watchtower.settings.{}".format(ENV))
+django.setup()
+
+from channels.http import AsgiHandler  # noqa
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa
+from django.urls import re_path  # noqa
+
+from api.rest.v1.async_views import (  # noqa
+    SendTransactionConsumer,
+    CreateUnsignedTransactionConsumer,
+    SyncAccountBasedBalancesConsumer
+)
+
+application = ProtocolTypeRouter({
+    'http': URLRouter([
+        re_path(r'^api/v1/send$', SendTransactionConsumer),
+        re_path(r'^api/v1/tools/create_unsigned_transaction$', CreateUnsignedTransactionConsumer),
+        re_path(r'^api/v1/sync_account_based_balances$', SyncAccountBasedBalancesConsumer),
+        re_path(r'', AsgiHandler),
+    ]),
+})
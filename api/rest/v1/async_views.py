@@ -0,0 +1,143 @@
+"""
+Endpoints that mostly wait on upstream APIs, served by the ASGI deployment (api/asgi.py)
+
+Only send is natively async: its upstream calls go through the shared async client (common/utils/async_requests.py),
+so a worker holds any number of them in flight without a thread per request. create_unsigned_transaction and
+sync_account_based_balances are thread wrappers, they run the sync view in a worker thread through
+database_sync_to_async and hold that thread for the whole request, create_unsigned_transaction just fetches its input
+txs concurrently. Every other endpoint is served by the regular Django views.
+"""
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.http import AsgiRequest
+from corsheaders.middleware import CorsMiddleware
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+
+from common.services import ethereum_json_rpc
+from common.services.coinquery import get_client as get_coinquery_client
+from common.utils.async_requests import run_sync
+from common.utils.networks import ATOM, BNB, EOS, ETH, FIO, OSMO, RUNE, XRP
+
+from .views import (
+    CreateUnsignedTransactionPage,
+    SendTransactionPage,
+    SyncAccountBasedBalancesPage,
+    _unpack_send_request
+)
+
+logger = logging.getLogger('watchtower.rest.async_views')
+
+# networks broadcast through their sync clients
+SYNC_BROADCAST_NETWORKS = [BNB, XRP, FIO, EOS, ATOM, RUNE, OSMO]
+
+
+class AsyncJsonPage(AsyncHttpConsumer):
+    """ POST only json endpoint, subclasses define the async post(body) returning the JsonResponse to send
+
+        Consumers are not behind Django's middleware, so corsheaders' middleware is run on the request here.
+    """
+    cors = CorsMiddleware()
+
+    async def handle(self, body):
+        request = AsgiRequest(self.scope, body)
+        # answers preflight requests, None for everything else
+        response = self.cors.process_request(request)
+
+        if response is None:
+            if request.method == 'OPTIONS':
+                response = HttpResponse()
+            elif request.method != 'POST':
+                response = JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+            else:
+                try:
+                    response = await self.post(body)
+                except Exception as e:
+                    logger.exception('error handling %s', self.scope['path'])
+                    response = JsonResponse({
+                        'success': False,
+                        'error': str(e)
+                    }, status=500)
+
+        response = self.cors.process_response(request, response)
+        if 'HTTP_ORIGIN' in request.META:
+            patch_vary_headers(response, ['Origin'])
+
+        headers = [(name.encode(), value.encode()) for name, value in response.items()]
+        await self.send_response(response.status_code, response.content, headers=headers)
+
+
+class SendTransactionConsumer(AsyncJsonPage):
+    page = SendTransactionPage()
+
+    async def post(self, body):
+        try:
+            request_json = _unpack_send_request(body)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+
+        try:
+            txid = await self.broadcast(request_json)
+
+            return JsonResponse({
+                'success': True,
+                'txid': txid
+            })
+        except Exception as e:
+            logger.error('error sending tx %s', e)
+
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+
+    async def broadcast(self, request_json):
+        network = request_json.get('network')
+        rawtx = request_json.get('rawtx')
+
+        if network == ETH:
+            return await ethereum_json_rpc.send_raw_transaction_async(rawtx)
+
+        if network in SYNC_BROADCAST_NETWORKS:
+            return await database_sync_to_async(self.page.broadcast)(request_json)
+
+        coinquery = get_coinquery_client(network)
+        txid = await coinquery.send_async(rawtx)
+        await database_sync_to_async(self.page.start_watching_tx)(network, txid)
+        return txid
+
+
+class _ConcurrentInputsCreateUnsignedTransactionPage(CreateUnsignedTransactionPage):
+    def _fetch_input_txs(self, coinquery, txids_needing_prevtx, txids_needing_raw_hex, input_confirmations):
+        async def fetch():
+            return await asyncio.gather(
+                coinquery.get_transactions_for_txids_async(txids_needing_prevtx, precise=True),
+                coinquery.get_raw_transactions_for_txids_async(txids_needing_raw_hex, confirmations=input_confirmations)
+            )
+
+        prevtx_map, rawtx_map = run_sync(fetch())
+        return prevtx_map, rawtx_map
+
+
+class CreateUnsignedTransactionConsumer(AsyncJsonPage):
+    """ Input selection reads the database and the sync eth clients, so the request is built in a worker thread.
+        The transactions of the inputs, one upstream call each, are fetched concurrently on the shared async client.
+    """
+
+    async def post(self, body):
+        page = _ConcurrentInputsCreateUnsignedTransactionPage()
+        return await database_sync_to_async(page.create)(body)
+
+
+class SyncAccountBasedBalancesConsumer(AsyncJsonPage):
+    """ Only queues celery tasks, the account lookups and the broker publish run in a worker thread """
+
+    async def post(self, body):
+        page = SyncAccountBasedBalancesPage()
+        return await database_sync_to_async(page.sync_balances)(body)
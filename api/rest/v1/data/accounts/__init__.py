@@ -0,0 +1,3 @@
+from .resolver import AccountResolver
+
+resolver = AccountResolver()
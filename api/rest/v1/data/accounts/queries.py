@@ -0,0 +1,11 @@
+# Account ids of many (xpub, network, script_type) keys in one statement, the keys are passed as parallel arrays and
+# joined against the unique (xpub, network, script_type) index of tracker_account.
+RESOLVE_ACCOUNTS_SQL = """
+            SELECT a.id, a.xpub, a.network, a.script_type
+            FROM unnest(%(xpubs)s::text[], %(networks)s::text[], %(script_types)s::text[])
+                AS requested(xpub, network, script_type)
+            JOIN tracker_account a
+              ON a.xpub = requested.xpub
+             AND a.network = requested.network
+             AND a.script_type = requested.script_type
+"""
@@ -0,0 +1,88 @@
+import logging
+import os
+
+from django.db import connection
+from lru import LRU
+
+from common.exceptions import XPubNotRegisteredError
+from common.services.account_versions import get_registry_version
+from tracker.models import Account
+
+from .queries import RESOLVE_ACCOUNTS_SQL
+
+logger = logging.getLogger('watchtower.rest.views.data.accounts.resolver')
+
+ACCOUNT_RESOLVER_CACHE_SIZE = int(os.environ.get('ACCOUNT_RESOLVER_CACHE_SIZE') or '100000')
+
+
+class AccountResolver:
+    """ Resolves (xpub, network, script_type) keys to accounts
+
+        Known keys are answered from an in-process LRU of account ids. Registering or unregistering an account in any
+        process bumps the registry version, which clears the LRU of every process on its next lookup.
+    """
+    def __init__(self, size=ACCOUNT_RESOLVER_CACHE_SIZE):
+        self.ids = LRU(size)
+        self.registry_version = None
+
+    def resolve_ids(self, requested):
+        """ {(xpub, network, script_type): account_id} of the registered accounts among requested """
+        registry_version = get_registry_version()
+        if registry_version != self.registry_version:
+            self.ids.clear()
+            self.registry_version = registry_version
+
+        ids = {}
+        missing = []
+        for key in dict.fromkeys(requested):
+            account_id = self.ids.get(key)
+            if account_id is None:
+                missing.append(key)
+            else:
+                ids[key] = account_id
+
+        if missing:
+            with connection.cursor() as cursor:
+                cursor.execute(RESOLVE_ACCOUNTS_SQL, {
+                    'xpubs': [xpub for xpub, _, _ in missing],
+                    'networks': [network for _, network, _ in missing],
+                    'script_types': [script_type for _, _, script_type in missing],
+                })
+                for account_id, xpub, network, script_type in cursor.fetchall():
+                    self.ids[(xpub, network, script_type)] = account_id
+                    ids[(xpub, network, script_type)] = account_id
+
+        return ids
+
+    def resolve(self, requested):
+        """ Accounts of requested in order, raises XPubNotRegisteredError naming the first one that is not registered """
+        requested = list(dict.fromkeys(requested))
+        ids = self.resolve_ids(requested)
+        accounts = Account.objects.in_bulk(set(ids.values()))
+
+        # ids of accounts deleted since they were cached, before the registry version caught up
+        stale = [key for key, account_id in ids.items() if account_id not in accounts]
+        if stale:
+            for key in stale:
+                self.forget(key)
+            ids.update(self.resolve_ids(stale))
+            accounts.update(Account.objects.in_bulk([ids[key] for key in stale if key in ids]))
+
+        account_objects = []
+        for xpub, network, script_type in requested:
+            account = accounts.get(ids.get((xpub, network, script_type)))
+            if account is None:
+                raise XPubNotRegisteredError('Account is not registered: {network} {xpub} {script_type}'.format(
+                    network=network,
+                    xpub=xpub,
+                    script_type=script_type
+                ))
+            account_objects.append(account)
+
+        return account_objects
+
+    def forget(self, key):
+        try:
+            del self.ids[key]
+        except KeyError:
+            pass
@@ -0,0 +1,3 @@
+from .fetcher import BalanceHistoryFetcher
+
+fetcher = BalanceHistoryFetcher()
@@ -0,0 +1,78 @@
+import logging
+
+import arrow
+from django.db import connection
+
+from common.services.launchdarkly import is_feature_enabled, BALANCE_ROLLUPS
+from common.utils.time_series import INTERVALS
+from common.utils.utils import current_time_millis
+
+from .queries import MULTI_HISTORY_SQL, BALANCE_CHANGE_SQL, ROLLUP_BALANCE_CHANGE_SQL
+
+logger = logging.getLogger('watchtower.rest.views.data.balance_history.fetcher')
+
+ORDERINGS = ['asc', 'desc']
+
+
+class BalanceHistoryFetcher:
+    @staticmethod
+    def window(interval, limit, end, start, ordering):
+        """ Validate the time series params and return the (start, end) arrows of the requested window """
+        if interval not in INTERVALS:
+            raise ValueError('Invalid interval: {interval}. Choices: {choices}.'.format(
+                interval=interval,
+                choices=', '.join(INTERVALS.keys())
+            ))
+
+        if ordering not in ORDERINGS:
+            raise ValueError('Invalid ordering parameter: {ordering}. Choices: {choices}.'.format(
+                ordering=ordering,
+                choices=', '.join(ORDERINGS)
+            ))
+
+        end = arrow.get(end) if end else arrow.utcnow()
+
+        if start:
+            start = arrow.get(start)
+        else:
+            interval_unit = INTERVALS[interval]['unit']
+            interval_unit_amount = INTERVALS[interval]['amount']
+            start = end.shift(**{interval_unit: -interval_unit_amount * limit})
+
+        return start, end
+
+    @staticmethod
+    def fetch(series, interval, start, end, ordering):
+        """ Balance history of every (account_id, erc20_token_id) in series, erc20_token_id None for the native asset
+
+            Returns ({(account_id, erc20_token_id): [(period_start, balance), ...]}, query time in ms), every series is
+            computed by the same statement.
+        """
+        specs = list(dict.fromkeys((account_id, erc20_token_id or 0) for account_id, erc20_token_id in series))
+        if not specs:
+            return {}, 0
+
+        sql = MULTI_HISTORY_SQL.format(
+            balance_change=ROLLUP_BALANCE_CHANGE_SQL if is_feature_enabled(BALANCE_ROLLUPS) else BALANCE_CHANGE_SQL,
+            ordering=ordering.upper(),
+        )
+
+        start_time = current_time_millis()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {
+                'account_ids': [account_id for account_id, _ in specs],
+                'erc20_token_ids': [erc20_token_id for _, erc20_token_id in specs],
+                'interval_seconds': INTERVALS[interval]['seconds'],
+                'start': start.format('YYYY-MM-DD HH:mm:ssZZ'),
+                'end': end.format('YYYY-MM-DD HH:mm:ssZZ'),
+                'interval': '{} {}'.format(INTERVALS[interval]['amount'], INTERVALS[interval]['unit']),
+            })
+            rows = cursor.fetchall()
+        query_time_ms = current_time_millis() - start_time
+
+        results = {}
+        for account_id, erc20_token_id, period_start, balance in rows:
+            results.setdefault((account_id, erc20_token_id or None), []).append((period_start, balance))
+
+        logger.debug('fetched %s balance history series in %sms', len(specs), query_time_ms)
+        return results, query_time_ms
@@ -0,0 +1,83 @@
+# Balance history of many (account, erc20 token) series in one statement.
+#
+# The series are passed as parallel arrays account_ids / erc20_token_ids (0 for the native asset) and expanded WITH
+# ORDINALITY, every series shares the period grid and is summed in its own window partition. The balance at each
+# period is the balance before start plus every bucket from the first period up to it, same as for a single series.
+#
+# BALANCE_CHANGE_SQL sums the raw balance changes, ROLLUP_BALANCE_CHANGE_SQL the per minute rollups maintained by the
+# triggers in tracker/queries.py. The rollups only need the buckets from the first period on, the balance before start
+# is the rollup total minus those.
+PERIOD_START_SQL = "TO_TIMESTAMP(floor(extract('epoch' FROM {column}) / %(interval_seconds)s) * %(interval_seconds)s)"
+
+BALANCE_CHANGE_SQL = """
+            balance_change AS (
+                SELECT spec.account_id, spec.erc20_token_id, {ts} AS ts, SUM(bc.amount) AS amount
+                FROM spec
+                JOIN tracker_balancechange bc ON bc.account_id = spec.account_id
+                JOIN tracker_transaction t ON t.id = bc.transaction_id
+                WHERE t.erc20_token_id IS NOT DISTINCT FROM NULLIF(spec.erc20_token_id, 0)
+                GROUP BY spec.account_id, spec.erc20_token_id, ts
+            ), starting_balance AS (
+                SELECT spec.account_id, spec.erc20_token_id, COALESCE(SUM(balance_change.amount), 0) AS amount
+                FROM spec
+                LEFT JOIN balance_change
+                  ON balance_change.account_id = spec.account_id
+                 AND balance_change.erc20_token_id = spec.erc20_token_id
+                 AND balance_change.ts < %(start)s::timestamptz
+                GROUP BY spec.account_id, spec.erc20_token_id
+            )
+""".format(ts=PERIOD_START_SQL.format(column='t.block_time'))
+
+ROLLUP_BALANCE_CHANGE_SQL = """
+            balance_change AS (
+                SELECT spec.account_id, spec.erc20_token_id, {ts} AS ts, SUM(r.amount) AS amount
+                FROM spec
+                JOIN tracker_balancerollup r
+                  ON r.account_id = spec.account_id AND r.erc20_token_id = spec.erc20_token_id
+                WHERE r.bucket >= {first_period}
+                GROUP BY spec.account_id, spec.erc20_token_id, ts
+            ), starting_balance AS (
+                SELECT spec.account_id, spec.erc20_token_id, COALESCE(total.balance, 0) - COALESCE((
+                    SELECT SUM(balance_change.amount) FROM balance_change
+                    WHERE balance_change.account_id = spec.account_id
+                      AND balance_change.erc20_token_id = spec.erc20_token_id
+                      AND balance_change.ts >= %(start)s::timestamptz
+                ), 0) AS amount
+                FROM spec
+                LEFT JOIN tracker_balancerolluptotal total
+                  ON total.account_id = spec.account_id AND total.erc20_token_id = spec.erc20_token_id
+            )
+""".format(
+    ts=PERIOD_START_SQL.format(column='r.bucket'),
+    first_period=PERIOD_START_SQL.format(column='%(start)s::timestamptz'),
+)
+
+MULTI_HISTORY_SQL = """
+            WITH spec AS (
+                SELECT * FROM unnest(%(account_ids)s::int[], %(erc20_token_ids)s::int[])
+                WITH ORDINALITY AS spec(account_id, erc20_token_id, idx)
+            ), series AS (
+                SELECT generate_series(
+                    {first_period},
+                    %(end)s::timestamptz,
+                    %(interval)s::interval
+                ) AS period_start
+            ), {{balance_change}}
+            SELECT
+                spec.account_id,
+                spec.erc20_token_id,
+                series.period_start,
+                COALESCE(SUM(balance_change.amount) OVER (
+                    PARTITION BY spec.account_id, spec.erc20_token_id ORDER BY series.period_start ASC
+                ), 0) + starting_balance.amount AS balance
+            FROM spec
+            CROSS JOIN series
+            JOIN starting_balance
+              ON starting_balance.account_id = spec.account_id
+             AND starting_balance.erc20_token_id = spec.erc20_token_id
+            LEFT JOIN balance_change
+              ON balance_change.account_id = spec.account_id
+             AND balance_change.erc20_token_id = spec.erc20_token_id
+             AND balance_change.ts = series.period_start
+            ORDER BY spec.idx, series.period_start {{ordering}}
+""".format(first_period=PERIOD_START_SQL.format(column='%(start)s::timestamptz'))
@@ -1,21 +1,26 @@
+import base64
+import json
 import logging
 import math
+import os
+
+from django.core.cache import cache
 from django.db import connection
 
+from common.services.account_versions import get_versions
+from common.services.launchdarkly import is_feature_enabled, BALANCE_READ_MODEL
 from common.services.redis import redisClient, ETH_BLOCK_HEIGHT
 from common.utils.networks import ETH
+from tracker.models import AccountTotals
+from api.rest.v1.data.accounts import resolver as account_resolver
 
 from .queries import (
-    UTXO_TRANSACTIONS_SQL,
-    ETH_TRANSACTIONS_SQL,
-    ERC20_TRANSACTIONS_SQL,
-    ERC20_CONTRACT_ADDRESS_SQL,
-    ERC20_SYMBOL_SQL,
-    ERC20_GROUP_BY_SQL,
-    UNION_ALL_SQL,
-    COUNT_SQL,
+    TRANSACTIONS_SQL,
+    COUNT_BY_SPEC_SQL,
+    KEYSET_SQL,
     ORDER_BY_SQL,
-    LIMIT_OFFSET_SQL,
+    LIMIT_SQL,
+    OFFSET_SQL,
     TOKENS_WITH_TX,
     PENDING_TXS,
     TX_BY_TXID_SQL,
@@ -23,46 +28,21 @@ from .queries import (
 
 logger = logging.getLogger('watchtower.rest.views.data.transactions.fetcher')
 
-class TransactionFetcher:
-    DEFAULT_PAGE_SIZE = 10
-
-    @staticmethod
-    def tx_erc20_history_query_build(xpub, script_type, eth_height, token=None, contract_address=None, dex_trades=False, thor_trades=False):
-        params = [eth_height, xpub, script_type, dex_trades, dex_trades, thor_trades, thor_trades]
+TX_COUNT_CACHE_KEY = 'tx_count:{spec}:{version}'
+TX_COUNT_CACHE_TTL = 60 * 60 * 24
 
-        sql = ERC20_TRANSACTIONS_SQL
-        if isinstance(contract_address, str):
-            sql += ERC20_CONTRACT_ADDRESS_SQL
-            params.append(contract_address.lower())
-        else:
-            sql += ERC20_SYMBOL_SQL
-            params.append(token)
+# larger than the ordinality of any requested pair
+MAX_SPEC = 2 ** 31 - 1
 
-        sql += ERC20_GROUP_BY_SQL
+# rows read from the server side cursor of an export at a time
+TX_EXPORT_FETCH_SIZE = int(os.environ.get('TX_EXPORT_FETCH_SIZE') or '2000')
 
-        return sql, params
+class TransactionFetcher:
+    DEFAULT_PAGE_SIZE = 10
 
     def tx_unconfirmed_query_build(self, network):
         return PENDING_TXS, [network]
 
-    def tx_eth_history_query_build(self, xpub, script_type, eth_height, token=None, contract_address=None, dex_trades=False, thor_trades=False):
-        if token or contract_address:
-            return self.tx_erc20_history_query_build(xpub, script_type, eth_height, token, contract_address, dex_trades, thor_trades)
-
-        return ETH_TRANSACTIONS_SQL, [eth_height, xpub, script_type, dex_trades, dex_trades, thor_trades, thor_trades]
-
-    def tx_history_query_build(self, xpub, script_type, network, token=None, contract_address=None, dex_trades=False, thor_trades=False):
-        if dex_trades == None:
-            dex_trades = False
-        if thor_trades == None:
-            thor_trades = False
-
-        if network == ETH:
-            eth_height = int(redisClient.get(ETH_BLOCK_HEIGHT))
-            return self.tx_eth_history_query_build(xpub, script_type, eth_height, token, contract_address, dex_trades, thor_trades)
-
-        return UTXO_TRANSACTIONS_SQL, [xpub, script_type, network, thor_trades, thor_trades]
-
     @staticmethod
     def fetchall(cursor):
         columns = [col[0] for col in cursor.description]
@@ -127,95 +107,219 @@ class TransactionFetcher:
         }
 
 
-    def fetch(self, xpub_list, page_number=1, page_size=DEFAULT_PAGE_SIZE):
-        queries = []
-        all_params = []
+    @staticmethod
+    def encode_cursor(row):
+        block_time = row.get('block_time')
+        value = [block_time.isoformat() if block_time else None, row.get('id'), row.get('spec')]
+        return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """ (block_time, id, spec) of cursor, cursors issued without a spec continue after every row of their tx """
+        try:
+            value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if len(value) == 2:
+                value.append(MAX_SPEC)
+            block_time, tx_id, spec = value
+            return block_time, int(tx_id), int(spec)
+        except Exception:
+            raise ValueError('invalid cursor')
+
+    def build_specs(self, xpubs):
+        """ Resolve requested xpubs to the (account, filter) rows of TRANSACTIONS_SQL, one per distinct request
+
+            Returns the rows and the network of each account in them.
+        """
+        account_ids = account_resolver.resolve_ids([
+            (xpub.get('xpub'), xpub.get('network'), xpub.get('script_type')) for xpub in xpubs
+        ])
+
+        specs = []
+        networks = {}
+        for xpub in xpubs:
+            account_id = account_ids.get((xpub.get('xpub'), xpub.get('network'), xpub.get('script_type')))
+            if account_id is None:
+                continue
+
+            is_eth = xpub.get('network') == ETH
+            contract_address = xpub.get('contract_address')
+            spec = (
+                account_id,
+                is_eth and (xpub.get('token') is not None or contract_address is not None),
+                xpub.get('token') if is_eth else None,
+                contract_address.lower() if is_eth and isinstance(contract_address, str) else None,
+                bool(xpub.get('dex_trades')) and is_eth,
+                bool(xpub.get('thor_trades')),
+            )
+            if spec not in specs:
+                specs.append(spec)
+                networks[account_id] = xpub.get('network')
+
+        return specs, networks
+
+    @staticmethod
+    def spec_params(specs, eth_height):
+        account_ids, is_token, tokens, contract_addresses, dex_trades, thor_trades = zip(*specs)
+        return {
+            'account_ids': list(account_ids),
+            'is_token': list(is_token),
+            'tokens': list(tokens),
+            'contract_addresses': list(contract_addresses),
+            'dex_trades': list(dex_trades),
+            'thor_trades': list(thor_trades),
+            'eth_height': eth_height,
+        }
+
+    def count(self, cursor, specs, networks, eth_height):
+        """ Total number of transactions of specs
+
+            Plain requests of utxo accounts are counted by their account totals. Other requests are counted with one
+            grouped query, cached per request until the account's version changes when totals are on.
+        """
+        totals = {}
+        versions = {}
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            account_ids = list(dict.fromkeys(spec[0] for spec in specs))
+            totals = dict(AccountTotals.objects.filter(account_id__in=account_ids)
+                          .values_list('account_id', 'tx_count'))
+            versions = dict(zip(account_ids, get_versions(account_ids)))
+
+        total = 0
+        cache_keys = {}
+        for spec in specs:
+            account_id, is_token, _, _, dex_trades, thor_trades = spec
+            if account_id not in totals:
+                cache_keys[spec] = None
+            elif not (is_token or dex_trades or thor_trades) and networks[account_id] != ETH:
+                total += totals[account_id]
+            else:
+                cache_keys[spec] = TX_COUNT_CACHE_KEY.format(spec=':'.join(map(str, spec)),
+                                                             version=versions[account_id])
+
+        cached = cache.get_many([key for key in cache_keys.values() if key])
+        uncounted = []
+        for spec, key in cache_keys.items():
+            if key in cached:
+                total += cached[key]
+            else:
+                uncounted.append(spec)
+
+        if uncounted:
+            cursor.execute(COUNT_BY_SPEC_SQL.format(TRANSACTIONS_SQL), self.spec_params(uncounted, eth_height))
+            counts = dict(cursor.fetchall())
+            for i, spec in enumerate(uncounted):
+                count = counts.get(i + 1, 0)  # spec is the 1-based ordinality of the pair
+                total += count
+                if cache_keys[spec]:
+                    cache.set(cache_keys[spec], count, TX_COUNT_CACHE_TTL)
+
+        return total
+
+    @staticmethod
+    def format_transaction(t):
+        # opted to do this here, rather than nest the query another level deep to get it there
+        tx_amount = int(t.get('amount'))
+        if t.get('success') == False:
+            tx_type = 'error'
+        elif t.get('is_erc20_fee'):
+            tx_type = 'fee'
+        elif tx_amount > 0:
+            tx_type = 'receive'
+        else:
+            tx_type = 'send'
+
+        return {
+            'txid': t.get('txid'),
+            'status': t.get('status'),
+            'type': tx_type,
+            'amount': tx_amount,
+            'date': t.get('block_time'),
+            'confirmations': t.get('confirmations'),
+            'network': t.get('network'),
+            'symbol': t.get('network'),
+            'xpub': t.get('xpub'),
+            'thor_memo': t.get('thor_memo'),
+            'fee': t.get('fee'),
+        }
+
+    def export(self, xpub_list, fetch_size=TX_EXPORT_FETCH_SIZE):
+        """ Every transaction of xpub_list, in the order of fetch's pages and formatted like its data
 
+            The accounts are resolved right away, the returned generator then reads the history through a server side
+            cursor and yields it in lists of at most fetch_size transactions, so memory stays bounded whatever the
+            size of the history.
+        """
+        xpubs = self.filter_xpubs(xpub_list)
+        specs, networks = self.build_specs(xpubs) if xpubs else ([], {})
+        if not specs:
+            return iter([])
+
+        eth_height = int(redisClient.get(ETH_BLOCK_HEIGHT)) if ETH in networks.values() else None
+        return self._export(self.spec_params(specs, eth_height), fetch_size)
+
+    def _export(self, params, fetch_size):
+        with connection.chunked_cursor() as db_cursor:
+            db_cursor.execute(TRANSACTIONS_SQL + ORDER_BY_SQL, params)
+            while True:
+                rows = db_cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+
+                # named cursors only describe their columns once rows were fetched
+                columns = [col[0] for col in db_cursor.description]
+                yield [self.format_transaction(dict(zip(columns, row))) for row in rows]
+
+    def fetch(self, xpub_list, page_number=1, page_size=DEFAULT_PAGE_SIZE, cursor=None):
         xpubs = self.filter_xpubs(xpub_list)
+        specs, networks = self.build_specs(xpubs) if xpubs else ([], {})
 
         # handle case where no xpubs with tx history provided
-        if len(xpubs) == 0:
+        if len(specs) == 0:
             return {
                 'success': True,
                 'pagination': {
                     'page': 1,
                     'total_objects': 0,
-                    'total_pages': 1
+                    'total_pages': 1,
+                    'next_cursor': None
                 },
                 'data': []
             }
 
-        # Build SQL for each requested xpubs transactions"
-        for xpub in xpubs:
-            sql, params = self.tx_history_query_build(
-                xpub.get('xpub'),
-                xpub.get('script_type'),
-                xpub.get('network'),
-                xpub.get('token'),
-                xpub.get('contract_address'),
-                xpub.get('dex_trades'),
-                xpub.get('thor_trades'))
-            queries.append(sql)
-            all_params += params
-
-        # UNION the individual xpub queries together
-        query = UNION_ALL_SQL.join(queries)
-
-        # create the query to get the total count from full query
-        count_query = COUNT_SQL.format(query)
-
-        query += ORDER_BY_SQL
-        query += LIMIT_OFFSET_SQL
+        eth_height = int(redisClient.get(ETH_BLOCK_HEIGHT)) if ETH in networks.values() else None
 
-        with connection.cursor() as cursor:
-            # execute the total count query
-            cursor.execute(count_query, all_params)
-            total = cursor.fetchone()[0]
+        params = self.spec_params(specs, eth_height)
+        params['limit'] = page_size
+
+        query = TRANSACTIONS_SQL
+        if cursor:
+            params['cursor_block_time'], params['cursor_id'], params['cursor_spec'] = self.decode_cursor(cursor)
+            query += KEYSET_SQL
+        query += ORDER_BY_SQL + LIMIT_SQL
+        if not cursor:
+            # page numbers are still served for clients that do not follow next_cursor
+            params['offset'] = (page_number - 1) * page_size
+            query += OFFSET_SQL
 
-            # calc pagination data
+        with connection.cursor() as db_cursor:
+            total = self.count(db_cursor, specs, networks, eth_height)
             total_pages = math.ceil(total / page_size)
-            offset = (page_number - 1) * page_size
-            all_params.append(page_size)
-            all_params.append(offset)
 
-            # execute paginated query for tx list
-            cursor.execute(query, all_params)
-            results = self.fetchall(cursor)
+            db_cursor.execute(query, params)
+            results = self.fetchall(db_cursor)
 
-        # format result data
-        data = []
-        for t in results:
-            # opted to do this here, rather than nest the query another level deep to get it there
-            tx_amount = int(t.get('amount'))
-            if t.get('success') == False:
-                tx_type = 'error'
-            elif t.get('is_erc20_fee'):
-                tx_type = 'fee'
-            elif tx_amount > 0:
-                tx_type = 'receive'
-            else:
-                tx_type = 'send'
+        next_cursor = self.encode_cursor(results[-1]) if len(results) == page_size else None
 
-            data.append({
-                'txid': t.get('txid'),
-                'status': t.get('status'),
-                'type': tx_type,
-                'amount': tx_amount,
-                'date': t.get('block_time'),
-                'confirmations': t.get('confirmations'),
-                'network': t.get('network'),
-                'symbol': t.get('network'),
-                'xpub': t.get('xpub'),
-                'thor_memo': t.get('thor_memo'),
-                'fee': t.get('fee'),
-            })
+        # format result data
+        data = [self.format_transaction(t) for t in results]
 
         return {
             'success': True,
             'pagination': {
                 'page': page_number,
                 'total_objects': total,
-                'total_pages': total_pages
+                'total_pages': total_pages,
+                'next_cursor': next_cursor
             },
             'data': data
         }
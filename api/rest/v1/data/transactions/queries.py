@@ -1,90 +1,64 @@
-UTXO_TRANSACTIONS_SQL = """
-            SELECT account.xpub,
-                   account.script_type,
-                   account.network,
-                   tx.id,
-                   tx.txid,
-                   tx.block_height,
-                   tx.block_hash,
-                   tx.block_time,
-                   tx.success,
-                   COALESCE((chainheight.height + 1) - tx.block_height, 0) AS confirmations,
-                   CASE WHEN tx.block_height IS NULL OR tx.block_time IS NULL THEN 'pending'
-                        ELSE 'confirmed'
-                   END AS status,
-                   false AS is_erc20_fee,
-                   tx.thor_memo AS thor_memo,
-                   tx.fee AS fee,
-                   SUM(bal.amount) AS amount
-            FROM tracker_account account
-                   JOIN tracker_chainheight chainheight ON account.network = chainheight.network
-                   JOIN tracker_transaction tx ON account.id = tx.account_id
-                   JOIN tracker_balancechange bal ON tx.id = bal.transaction_id
-            WHERE account.xpub = %s
-              AND account.script_type = %s
-              AND account.network = %s
-              AND ( (tx.thor_memo IS NOT NULL AND %s = true) OR (%s = false) )
-            GROUP BY account.xpub, account.script_type, account.network, tx.id, tx.txid, tx.block_height, tx.block_hash, tx.block_time, chainheight.height, is_erc20_token_transfer, erc20_token_id, is_erc20_fee
+# Transactions of every requested (account, filter) pair in one statement. Each pair is a row of the requested
+# relation, built from parallel arrays: plain requests list the account's native txs, token requests its erc20 txs
+# of one contract (or symbol when no contract address is given), and dex/thor requests keep only those trades.
+TRANSACTIONS_SQL = """
+            WITH requested (account_id, is_token, token, contract_address, dex_trades, thor_trades, spec) AS (
+                SELECT * FROM unnest(%(account_ids)s::integer[], %(is_token)s::boolean[], %(tokens)s::text[],
+                                     %(contract_addresses)s::text[], %(dex_trades)s::boolean[],
+                                     %(thor_trades)s::boolean[])
+                WITH ORDINALITY
+            ), transactions AS (
+                SELECT requested.spec,
+                       account.xpub,
+                       account.script_type,
+                       CASE WHEN requested.is_token THEN erc20.symbol ELSE account.network END AS network,
+                       tx.id,
+                       tx.txid,
+                       tx.block_height,
+                       tx.block_hash,
+                       tx.block_time,
+                       tx.success,
+                       COALESCE((CASE WHEN account.network = 'ETH' THEN %(eth_height)s ELSE chainheight.height END + 1)
+                                - tx.block_height, 0) AS confirmations,
+                       CASE WHEN tx.block_height IS NULL THEN 'pending'
+                            WHEN account.network <> 'ETH' AND tx.block_time IS NULL THEN 'pending'
+                            ELSE 'confirmed'
+                       END AS status,
+                       account.network = 'ETH' AND tx.is_erc20_fee AS is_erc20_fee,
+                       tx.thor_memo AS thor_memo,
+                       tx.fee AS fee,
+                       SUM(bal.amount) AS amount
+                FROM requested
+                       JOIN tracker_account account ON account.id = requested.account_id
+                       JOIN tracker_transaction tx ON account.id = tx.account_id
+                       JOIN tracker_balancechange bal ON tx.id = bal.transaction_id
+                       LEFT JOIN tracker_chainheight chainheight ON account.network = chainheight.network
+                       LEFT JOIN tracker_erc20token erc20 ON tx.erc20_token_id = erc20.id
+                WHERE (account.network = 'ETH' OR chainheight.height IS NOT NULL)
+                  AND (
+                      (NOT requested.is_token AND NOT (account.network = 'ETH' AND tx.is_erc20_token_transfer))
+                      OR (requested.is_token AND tx.is_erc20_token_transfer
+                          AND (erc20.contract_address = requested.contract_address
+                               OR (requested.contract_address IS NULL AND erc20.symbol = requested.token)))
+                  )
+                  AND (tx.is_dex_trade OR NOT requested.dex_trades)
+                  AND (tx.thor_memo IS NOT NULL OR NOT requested.thor_trades)
+                GROUP BY requested.spec, requested.is_token, account.id, tx.id, erc20.symbol, chainheight.height
+            )
+            SELECT * FROM transactions
         """
 
-ETH_TRANSACTIONS_SQL = """
-            SELECT account.xpub,
-                   account.script_type,
-                   account.network,
-                   tx.id,
-                   tx.txid,
-                   tx.block_height,
-                   tx.block_hash,
-                   tx.block_time,
-                   tx.success,
-                   COALESCE((%s + 1) - tx.block_height, 0) AS confirmations,
-                   CASE WHEN tx.block_height IS NULL THEN 'pending'
-                        ELSE 'confirmed'
-                   END AS status,
-                   tx.is_erc20_fee AS is_erc20_fee,
-                   tx.thor_memo AS thor_memo,
-                   tx.fee AS fee,
-                   SUM(bal.amount) AS amount
-            FROM tracker_account account
-                   JOIN tracker_transaction tx ON account.id = tx.account_id
-                   JOIN tracker_balancechange bal ON tx.id = bal.transaction_id
-            WHERE account.xpub = %s
-              AND account.script_type = %s
-              AND account.network = 'ETH'
-              AND NOT tx.is_erc20_token_transfer
-              AND ( tx.is_dex_trade = %s OR %s = false )
-              AND ( (tx.thor_memo IS NOT NULL AND %s = true) OR (%s = false) )
-            GROUP BY account.xpub, account.script_type, account.network, tx.id, tx.txid, tx.block_height, tx.block_hash, tx.block_time, is_erc20_token_transfer, erc20_token_id, is_erc20_fee
-        """
+# Rows per requested pair, for the pairs whose total is not cached
+COUNT_BY_SPEC_SQL = "SELECT spec, COUNT(1) FROM ({}) AS page_source GROUP BY spec"
 
-ERC20_TRANSACTIONS_SQL = """
-            SELECT account.xpub,
-                   account.script_type,
-                   erc20.symbol AS network,
-                   tx.id,
-                   tx.txid,
-                   tx.block_height,
-                   tx.block_hash,
-                   tx.block_time,
-                   tx.success,
-                   COALESCE((%s + 1) - tx.block_height, 0) AS confirmations,
-                   CASE WHEN tx.block_height IS NULL THEN 'pending'
-                        ELSE 'confirmed'
-                   END AS status,
-                   tx.is_erc20_fee AS is_erc20_fee,
-                   tx.thor_memo AS thor_memo,
-                   tx.fee AS fee,
-                   SUM(bal.amount) AS amount
-            FROM tracker_account account
-                   JOIN tracker_transaction tx ON account.id = tx.account_id
-                   JOIN tracker_erc20token erc20 ON tx.erc20_token_id = erc20.id
-                   JOIN tracker_balancechange bal ON tx.id = bal.transaction_id
-            WHERE account.xpub = %s
-              AND account.script_type = %s
-              AND account.network = 'ETH'
-              AND tx.is_erc20_token_transfer
-              AND ( tx.is_dex_trade = %s OR %s = false )
-              AND ( (tx.thor_memo IS NOT NULL AND %s = true) OR (%s = false) )
+# Rows after a (block_time, id, spec) cursor in ORDER_BY_SQL order, pending txs (NULL block_time) sort first.
+# A tx is a row per requested pair it matches, so the spec is part of the key.
+KEYSET_SQL = """
+            WHERE (%(cursor_block_time)s::timestamptz IS NULL
+                       AND ((block_time IS NULL AND (id, spec) > (%(cursor_id)s, %(cursor_spec)s))
+                            OR block_time IS NOT NULL))
+               OR block_time < %(cursor_block_time)s::timestamptz
+               OR (block_time = %(cursor_block_time)s::timestamptz AND (id, spec) > (%(cursor_id)s, %(cursor_spec)s))
         """
 
 TX_BY_TXID_SQL = """
@@ -104,17 +78,10 @@ TX_BY_TXID_SQL = """
               WHERE txid = %s
        """
 
-ERC20_CONTRACT_ADDRESS_SQL = " AND erc20.contract_address = %s"
-ERC20_SYMBOL_SQL = " AND erc20.symbol = %s"
-ERC20_GROUP_BY_SQL = """ GROUP BY account.xpub, account.script_type, erc20.symbol, tx.id, tx.txid, tx.block_height,
-                           tx.block_hash, tx.block_time, is_erc20_token_transfer, erc20_token_id, is_erc20_fee """
-
-UNION_ALL_SQL = " UNION ALL "
-COUNT_SQL = "SELECT COUNT(1) FROM ({}) AS total"
-
-ORDER_BY_SQL = " ORDER BY block_time DESC, id ASC"
+ORDER_BY_SQL = " ORDER BY block_time DESC, id ASC, spec ASC"
 
-LIMIT_OFFSET_SQL = " LIMIT %s OFFSET %s"
+LIMIT_SQL = " LIMIT %(limit)s"
+OFFSET_SQL = " OFFSET %(offset)s"
 
 TOKENS_WITH_TX = """
             select distinct erc20.symbol, erc20.contract_address
@@ -2,6 +2,7 @@ import json
 import logging
 
 from common.utils.networks import SUPPORTED_NETWORKS
+from ingester.eth.balance_refresh import get_refresh_counts
 from django.http import JsonResponse
 from rest_framework.views import APIView
 from tracker.models import ProcessedBlock, ChainHeight
@@ -29,3 +30,13 @@ class LatestBlockPage(APIView):
             'success': True,
             'data': height
         })
+
+
+class BalanceRefreshesPage(APIView):
+
+    def get(self, request):
+        # balance syncs queued by the eth ingesters and the ones coalesced away, see ingester/eth/balance_refresh.py
+        return JsonResponse({
+            'success': True,
+            'data': get_refresh_counts()
+        })
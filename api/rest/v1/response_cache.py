@@ -0,0 +1,110 @@
+"""
+Response cache of the read endpoints, keyed by the account versions a response was computed at
+
+The key of a request is a digest of the endpoint, its normalized body and query string and the current versions of
+the accounts it names (see common/services/account_versions.py). Writers bump those versions, so a cached response
+is served for exactly as long as nothing it was computed from has changed. The digest doubles as the ETag, a client
+that sends it back in If-None-Match gets a 304 without the response being read or computed.
+
+Requests naming an unregistered account, and requests the endpoint declares uncacheable (responses that depend on
+upstream APIs or on the current time), are passed through untouched, as are error responses and responses marked
+Cache-Control: no-store.
+"""
+import hashlib
+import json
+import logging
+import os
+from functools import wraps
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+from api.rest.v1.data.accounts import resolver as account_resolver
+from common.services.account_versions import get_versions
+from common.services.launchdarkly import is_feature_enabled, RESPONSE_CACHE
+from common.services.redis import redisClient, RESPONSE_CACHE_PREFIX
+
+logger = logging.getLogger('watchtower.rest.response_cache')
+
+# entries stay valid until a version changes, the ttl only bounds how long unused ones take up memory
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 60 * 60 * 24)
+
+
+def _requested_accounts(body):
+    data = body.get('data', []) if isinstance(body, dict) else []
+    items = [data] if isinstance(data, dict) else data
+    return {(item.get('xpub'), (item.get('network') or '').upper(), item.get('script_type')) for item in items}
+
+
+def _resolve_accounts(requested):
+    """ {(xpub, network, script_type): (id, network)} of requested, None when any of them is not registered """
+    ids = account_resolver.resolve_ids(requested)
+    if len(ids) != len(requested):
+        return None
+    return {key: (account_id, key[1]) for key, account_id in ids.items()}
+
+
+def response_key(endpoint, request, chain=False, cacheable=None):
+    """ Digest identifying the response to request at the current versions, None when it can not be cached """
+    body = json.loads(request.body or '{}')
+    accounts = _resolve_accounts(_requested_accounts(body))
+    if accounts is None:
+        return None
+
+    networks = {network for _, network in accounts.values()}
+    if cacheable is not None and not cacheable(request, networks):
+        return None
+
+    account_ids = sorted(account_id for account_id, _ in accounts.values())
+    versions = get_versions(account_ids, chain=chain)
+    normalized = json.dumps([endpoint, body, sorted(request.GET.items()), account_ids, versions], sort_keys=True)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
+
+
+def cached_response(endpoint, chain=False, cacheable=None):
+    """ Cache the 200 responses of an APIView handler per response_key and answer matching If-None-Match with 304
+
+        chain: the response depends on chain heights (confirmations), so it is also keyed by the chain version
+        cacheable: optional (request, networks) -> bool, False for requests the cache must not answer
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            if not is_feature_enabled(RESPONSE_CACHE):
+                return handler(view, request, *args, **kwargs)
+
+            try:
+                key = response_key(endpoint, request, chain=chain, cacheable=cacheable)
+            except Exception as e:
+                # malformed requests are rejected by the handler itself
+                logger.debug('not caching %s: %s', endpoint, str(e))
+                key = None
+
+            if key is None:
+                return handler(view, request, *args, **kwargs)
+
+            etag = '"{}"'.format(key)
+            if _etag_matches(request, etag):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            content = redisClient.get(RESPONSE_CACHE_PREFIX + key)
+            if content is not None:
+                response = HttpResponse(content, content_type='application/json')
+            else:
+                response = handler(view, request, *args, **kwargs)
+                if response.status_code != 200 or 'no-store' in response.get('Cache-Control', ''):
+                    return response
+                redisClient.setex(RESPONSE_CACHE_PREFIX + key, RESPONSE_CACHE_TTL, response.content.decode())
+
+            response['ETag'] = etag
+            return response
+        return wrapper
+    return decorator
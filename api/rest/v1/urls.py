@@ -7,6 +7,7 @@ from .views import (
     XpubRegistrationPage,
     XpubUnregistrationPage,
     TransactionListPage,
+    TransactionExportPage,
     TransactionDetailsPage,
     SendTransactionPage,
     ReceiveAddressPage,
@@ -17,6 +18,7 @@ from .views import (
 )
 
 from .metrics import (
+    BalanceRefreshesPage,
     LatestBlockPage
 )
 
@@ -31,12 +33,14 @@ urlpatterns = [
     re_path(r'^send$', SendTransactionPage.as_view()),
     re_path(r'^receive$', ReceiveAddressPage.as_view()),
     re_path(r'^transactions$', TransactionListPage.as_view()),
+    re_path(r'^transactions/export$', TransactionExportPage.as_view()),
     re_path(r'^transaction$', TransactionDetailsPage.as_view()),
     re_path(r'^balance/multihistory$', MultiBalanceHistoryPage.as_view()),
     re_path(r'^balance$', BalancePage.as_view()),
     re_path(r'^tools/create_unsigned_transaction$', CreateUnsignedTransactionPage.as_view()),
     re_path(r'^metrics/latest_block$', LatestBlockPage.as_view()),
     re_path(r'^metrics/assets_in_orbit$', AssetsInOrbitPage.as_view()),
+    re_path(r'^metrics/balance_refreshes$', BalanceRefreshesPage.as_view()),
     re_path(r'^xpubs$', XPubStatusPage.as_view()),
     re_path(r'^sync_account_based_balances$', SyncAccountBasedBalancesPage.as_view()),
     re_path(r'^network_fees$', NetworkFeesPage.as_view()),
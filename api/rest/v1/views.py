@@ -3,18 +3,18 @@ import json
 from functools import reduce
 import itertools
 import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 import logging
 import time
 import requests
 import os
 
-from django.http import JsonResponse
-from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Count, Q
 from django.db import connection as db_connection
 from django.core.paginator import Paginator
 
-import arrow
-from requests.adapters import HTTPAdapter
 from rest_framework.views import APIView
 from ingester.tasks import initial_sync_xpub
 from ingester.eth.balance_sync import sync_eth_account_balances
@@ -22,7 +22,7 @@ from ingester.tendermint.balance_sync import sync_account_balances
 from ingester.bnb.balance_sync import sync_bnb_account_balances
 from ingester.xrp.balance_sync import sync_xrp_account_balances
 from ingester.fio.balance_sync import sync_fio_account_balances
-from tracker.models import Account, AccountBalance, Transaction, BalanceChange, ERC20Token, Address
+from tracker.models import Account, AccountBalance, AccountTotals, Transaction, ERC20Token, Address
 from tracker.signals import should_migrate
 from common.exceptions import XPubNotRegisteredError
 from common.services.coinquery import get_client as get_coinquery_client
@@ -32,7 +32,6 @@ from common.utils.ethereum import get_token_balance as get_eth_token_balance
 from common.utils.ethereum import get_balance as get_eth_balance
 from common.utils.bip32 import is_valid_bip32_xpub, CHANGE, GAP_LIMIT
 from common.utils.networks import SUPPORTED_NETWORKS, ATOM, BNB, ETH, BCH, XRP, EOS, FIO, RUNE, OSMO, NETWORK_CONFIGS
-from common.utils.time_series import INTERVALS
 from common.utils.transactions import SMALLEST_VALUE_FIRST
 from common.utils.transactions import (
     InsufficientFundsError,
@@ -40,6 +39,7 @@ from common.utils.transactions import (
     get_dust_limit
 )
 from common.utils.utils import current_time_millis
+from common.utils.async_requests import async_http, run_sync
 from common.utils.ethereum import (
     get_cached_gas_price,
     get_cached_eip1559_fees,
@@ -51,9 +51,13 @@ from common.utils.ethereum import (
 )
 
 from api.rest.v1.data.transactions import fetcher as tx_fetcher
+from api.rest.v1.data.balance_history import fetcher as balance_history_fetcher
+from api.rest.v1.data.accounts import resolver as account_resolver
+from api.rest.v1.response_cache import cached_response
 
 from common.services.redis import redisClient, WATCH_ADDRESS_PREFIX, WATCH_ADDRESS_SET_KEY, WATCH_TX_SET_KEY, ETH_ACCOUNT
-from common.services.launchdarkly import is_feature_enabled, ACCOUNT_BALANCE_TIMINGS, LOCAL_ACCOUNT_BALANCES, ALWAYS_HARD_REFRESH, UNCHAINED_ACCOUNT_BALANCES, INCLUDE_EIP1559_FEES
+from common.services.launchdarkly import is_feature_enabled, ACCOUNT_BALANCE_TIMINGS, LOCAL_ACCOUNT_BALANCES, ALWAYS_HARD_REFRESH, UNCHAINED_ACCOUNT_BALANCES, INCLUDE_EIP1559_FEES, \
+    BALANCE_READ_MODEL
 from common.utils.ethereum import eth_balance_cache_key_format
 from cashaddress import convert as convert_bch
 
@@ -66,13 +70,24 @@ DEFAULT_TIME_SERIES_LIMIT = 1000
 
 WATCH_ADDRESS_EXPIRATION_SECONDS = 60 * 60
 
+# concurrent balance lookups of BalancePage, shared by every request
+BALANCE_WORKERS = int(os.environ.get('BALANCE_WORKERS') or '16')
+BALANCE_DEADLINE = float(os.environ.get('BALANCE_DEADLINE') or '20')  # seconds, per branch once it runs
+BALANCE_CALL_TIMEOUT = float(os.environ.get('BALANCE_CALL_TIMEOUT') or '10')  # seconds, per upstream call
+_balance_executor = ThreadPoolExecutor(max_workers=BALANCE_WORKERS, thread_name_prefix='balances')
+_balance_account_executor = ThreadPoolExecutor(max_workers=BALANCE_WORKERS, thread_name_prefix='balance-accounts')
+
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 logger = logging.getLogger('watchtower.rest.views')
 
 def _unpack_and_validate_xpubs(request):
-    request_json = json.loads(request.body)
+    return _unpack_and_validate_xpubs_body(request.body)
+
+
+def _unpack_and_validate_xpubs_body(body):
+    request_json = json.loads(body)
     xpub_payload = request_json.get('data', [])
     xpub_list = [xpub_payload] if isinstance(xpub_payload, dict) else xpub_payload
     xpubs = []
@@ -125,26 +140,8 @@ def _validate_script_type(network, script_type):
         ))
 
 def _fetch_xpubs_from_db(requested_xpubs):
-    if not requested_xpubs:
-        return []
-
-    # get xpubs from db
-    xpub_queries = [Q(xpub=xpub, network=network, script_type=script_type) for xpub, network, script_type in requested_xpubs]
-    xpub_aggregate_query = reduce(lambda x, y: x | y, xpub_queries)
-    account_objects = Account.objects.filter(xpub_aggregate_query)
-
-    # raise exception if requested xpubs aren't registered
-    registered_xpubs = [(obj.xpub, obj.network, obj.script_type) for obj in account_objects]
-    for requested_xpub in requested_xpubs:
-        if requested_xpub not in registered_xpubs:
-            xpub, network, script_type = requested_xpub
-            raise ValueError('Account is not registered: {network} {xpub} {script_type}'.format(
-                network=network,
-                xpub=xpub,
-                script_type=script_type
-            ))
-
-    return account_objects
+    """ Accounts of requested_xpubs in order without duplicates, raises ValueError if any of them isn't registered """
+    return account_resolver.resolve(requested_xpubs)
 
 
 def _fetch_xpub_from_db(xpub, network, script_type):
@@ -172,117 +169,7 @@ def _paginate(request, queryset):
     }
 
 
-# Get balance history for a given xpub
-def getBalanceHistoryForXpub(account_object_id, interval, limit, end, start, ordering, address):
-
-    if interval not in INTERVALS:
-        return JsonResponse({
-            'success': False,
-            'error': 'Invalid interval: {interval}. Choices: {choices}.'.format(
-                interval=interval,
-                choices=', '.join(INTERVALS.keys())
-            )
-        }, status=400)
-
-    if end:
-        end = arrow.get(end)
-    else:
-        end = arrow.utcnow()
-
-    if start:
-        start = arrow.get(start)
-    else:
-        interval_unit = INTERVALS[interval]['unit']
-        interval_unit_amount = INTERVALS[interval]['amount']
-        start = end.shift(**{interval_unit: -interval_unit_amount * limit})
-
-    allowed_ordering_values = ['asc', 'desc']
-    if ordering not in allowed_ordering_values:
-        return JsonResponse({
-            'success': False,
-            'error': 'Invalid ordering parameter: {ordering}. Choices: {choices}.'.format(
-                ordering=ordering,
-                choices=', '.join(allowed_ordering_values)
-            )
-        }, status=400)
-
-    if address is not None:
-        address = address.lower()
-
-    token_obj = ERC20Token.objects.filter(contract_address=address).first() if address else None
-
-    if address:
-        erc20_token_id = token_obj.id if token_obj else -1
-    else:
-        erc20_token_id = None
-
-    results = None
-    with db_connection.cursor() as cursor:
-        sql_format = """
-            WITH series AS (
-                SELECT generate_series(
-                    TO_TIMESTAMP(
-                        floor(
-                            extract(
-                                'epoch' FROM TIMESTAMP WITH TIME ZONE '{start}'
-                            ) / {interval_seconds}
-                        ) * {interval_seconds}
-                    ),
-                    TIMESTAMP WITH TIME ZONE '{end}',
-                    '{interval}'
-                ) AS period_start
-            ), balance_change AS (
-                SELECT
-                    TO_TIMESTAMP(
-                        floor(
-                            extract(
-                                'epoch' FROM {transaction_table}.block_time
-                            ) / {interval_seconds}
-                        ) * {interval_seconds}
-                    ) AS ts,
-                    SUM({balance_change_table}.amount) AS amount
-                FROM {balance_change_table}
-                INNER JOIN {transaction_table}
-                ON ({balance_change_table}.transaction_id = {transaction_table}.id)
-                WHERE {balance_change_table}.account_id = {account_id}
-                AND {transaction_table}.erc20_token_id {erc20_token_id}
-                GROUP BY ts
-            ), starting_balance AS (
-                SELECT COALESCE(SUM(balance_change.amount), 0) AS amount
-                FROM balance_change
-                WHERE balance_change.ts < (TIMESTAMP WITH TIME ZONE '{start}')
-            )
-            SELECT
-                series.period_start,
-                COALESCE(SUM(balance_change.amount) OVER (ORDER BY series.period_start ASC), 0) + (
-                    SELECT starting_balance.amount FROM starting_balance
-                ) AS balance
-            FROM balance_change
-            RIGHT JOIN series
-            ON series.period_start = balance_change.ts
-            ORDER BY series.period_start {ordering}
-        """  # noqa
-
-        sql = sql_format.format(
-            balance_change_table=BalanceChange._meta.db_table,
-            transaction_table=Transaction._meta.db_table,
-            erc20_token_table=ERC20Token._meta.db_table,
-            account_id=account_object_id,
-            erc20_token_id="= '{}'".format(erc20_token_id) if erc20_token_id else 'IS NULL',
-            interval_seconds=INTERVALS[interval]['seconds'],
-            start=start.format('YYYY-MM-DD HH:mm:ssZZ'),
-            end=end.format('YYYY-MM-DD HH:mm:ssZZ'),
-            interval='{} {}'.format(INTERVALS[interval]['amount'], INTERVALS[interval]['unit']),
-            ordering=ordering.upper()
-        )
-
-        cursor.execute(sql)
-        results = cursor.fetchall()
-        try:
-            query_time_ms = int(float(db_connection.queries[1]['time']) * 1000)
-        except Exception:
-            query_time_ms = None
-
+def _format_balance_history(results, interval, start, end, limit, ordering, query_time_ms):
     formatted_results = [[time, int(balance)] for time, balance in results] if results else None
 
     results = {
@@ -338,7 +225,11 @@ class XpubRegistrationPage(APIView):
 
         data = request_data.get('data', None)
         _async = request.GET.get('async', 'true') == 'true'
-        hard_refresh = True if always_hard_refresh else request.GET.get('hard_refresh', 'false') == 'true'
+        requested_hard_refresh = request.GET.get('hard_refresh', 'false') == 'true'
+        hard_refresh = True if always_hard_refresh else requested_hard_refresh
+        # a mandated hard refresh of a checkpointed utxo account resyncs it incrementally (see initial_sync_xpub),
+        # one the client asked for always starts from scratch
+        incremental = False if requested_hard_refresh else None
 
         try:
             xpubs = _unpack_and_validate_xpubs(request)
@@ -350,9 +241,10 @@ class XpubRegistrationPage(APIView):
         # After data is validated, update each xpub
         for xpub, network, script_type in xpubs:
             if _async:
-                initial_sync_xpub.s(xpub, network, script_type, hard_refresh, publish=False).apply_async()
+                initial_sync_xpub.s(xpub, network, script_type, hard_refresh, publish=False,
+                                    incremental=incremental).apply_async()
             else:
-                initial_sync_xpub(xpub, network, script_type, hard_refresh, publish=False)
+                initial_sync_xpub(xpub, network, script_type, hard_refresh, publish=False, incremental=incremental)
 
         end = time.time()
 
@@ -402,6 +294,7 @@ class XpubUnregistrationPage(APIView):
 
 class TransactionListPage(APIView):
 
+    @cached_response('transactions', chain=True)
     def post(self, request):
         """
         Example Request Payload:
@@ -418,6 +311,9 @@ class TransactionListPage(APIView):
                 ...
             ]
         }
+
+        Query Params: pageSize=Integer, and either page=Integer or cursor=String (pagination.next_cursor of the
+        previous page, which stays stable while new transactions arrive)
         """
         try:
             request_json = json.loads(request.body)
@@ -427,14 +323,20 @@ class TransactionListPage(APIView):
 
             page_number = int(request.GET.get('page', 1))
             page_size = int(request.GET.get('pageSize', DEFAULT_PAGE_SIZE))
+            cursor = request.GET.get('cursor')
 
             start = int(round(time.time() * 1000))
-            response = tx_fetcher.fetch(xpub_list, page_number, page_size)
+            response = tx_fetcher.fetch(xpub_list, page_number, page_size, cursor=cursor)
 
             duration = int(round(time.time() * 1000)) - start
             logger.debug('fetched transactions for %s xpubs in %sms', len(xpub_list), duration)
 
             return JsonResponse(response)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
         except Exception as e:
             logger.exception('Error getting tx history for %s, error = %s', request_json, e)
             return JsonResponse({
@@ -442,6 +344,52 @@ class TransactionListPage(APIView):
                 'error': 'Error fetching transaction history'
             }, status=500)
 
+class TransactionExportPage(APIView):
+    def post(self, request):
+        """
+        Example Request Payload: same as /transactions
+
+        Streams the full history as NDJSON, one transaction per line formatted like the data of /transactions and in
+        the same order. A failure after the stream started is reported as a last {"success": false, ...} line.
+        """
+        try:
+            request_json = json.loads(request.body)
+
+            xpub_payload = request_json.get('data', [])
+            xpub_list = [xpub_payload] if isinstance(xpub_payload, dict) else xpub_payload
+
+            chunks = tx_fetcher.export(xpub_list)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+        except Exception as e:
+            logger.exception('Error exporting tx history, error = %s', e)
+            return JsonResponse({
+                'success': False,
+                'error': 'Error exporting transaction history'
+            }, status=500)
+
+        return StreamingHttpResponse(self.ndjson(chunks, len(xpub_list)), content_type='application/x-ndjson')
+
+    @staticmethod
+    def ndjson(chunks, xpub_count):
+        start = current_time_millis()
+        exported = 0
+        try:
+            for chunk in chunks:
+                exported += len(chunk)
+                yield ''.join(json.dumps(tx, cls=DjangoJSONEncoder) + '\n' for tx in chunk)
+        except Exception as e:
+            logger.exception('Error exporting tx history after %s transactions, error = %s', exported, e)
+            yield json.dumps({'success': False, 'error': 'Error exporting transaction history'}) + '\n'
+            return
+
+        logger.debug('exported %s transactions for %s xpubs in %sms', exported, xpub_count,
+                     current_time_millis() - start)
+
+
 class TransactionDetailsPage(APIView):
     def get(self, request):
         """
@@ -480,7 +428,13 @@ class TransactionDetailsPage(APIView):
 
 
 # Balance history page endpoint with support for multiple xpubs
+def _has_explicit_end(request, networks):
+    # without an end the window moves with the current time
+    return bool(request.GET.get('end'))
+
+
 class MultiBalanceHistoryPage(APIView):
+    @cached_response('multihistory', cacheable=_has_explicit_end)
     def post(self, request):
         """
         Example Query Parameters:
@@ -542,7 +496,7 @@ class MultiBalanceHistoryPage(APIView):
         with db_connection.cursor() as cursor:
             cursor.execute(
                 """
-                select distinct erc20.contract_address
+                select distinct erc20.id, erc20.contract_address
                 from tracker_account account
                 join tracker_transaction transaction on account.id = transaction.account_id
                 join tracker_erc20token erc20 on transaction.erc20_token_id = erc20.id
@@ -552,45 +506,67 @@ class MultiBalanceHistoryPage(APIView):
             [requested_addresses, requested_xpubs_list])
             tokens_with_tx = tx_fetcher.fetchall(cursor)
 
-        # convert to set for fast lookup
-        tokens_with_tx_set = set()
-        for token in tokens_with_tx:
-            tokens_with_tx_set.add(token['contract_address'])
+        # contract address -> token id, for fast lookup
+        token_ids_with_tx = {token['contract_address']: token['id'] for token in tokens_with_tx}
 
-        combinedResults = []
+        interval = request.GET.get('interval', 'daily').lower()
+        limit = int(request.GET.get('limit', DEFAULT_TIME_SERIES_LIMIT))
+        ordering = request.GET.get('ordering', 'asc').lower()
+        try:
+            start, end = balance_history_fetcher.window(
+                interval, limit, request.GET.get('end', None), request.GET.get('start', None), ordering)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
 
-        for data in request_data:
-            interval = request.GET.get('interval', 'daily').lower()
-            limit = int(request.GET.get('limit', DEFAULT_TIME_SERIES_LIMIT))
-            end = request.GET.get('end', None)
-            start = request.GET.get('start', None)
-            ordering = request.GET.get('ordering', 'asc').lower()
+        # resolve every requested account in one query
+        requested_accounts = [
+            (data.get('xpub'), data.get('network'), data.get('script_type')) for data in request_data
+        ]
+        try:
+            account_objects = _fetch_xpubs_from_db(list(dict.fromkeys(requested_accounts)))
+        except ValueError as e:
+            logger.error('attempting to get multihistory of unregistered xpub: ' + str(e))
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+                }, status=400)
+        account_ids = {(obj.xpub, obj.network, obj.script_type): obj.id for obj in account_objects}
+
+        # non eth token with tx history || OR || eth token with tx history
+        requested_series = []
+        for data, requested_account in zip(request_data, requested_accounts):
             address = data.get('contract_address')
-            script_type = data.get('script_type')
-            network = data.get('network')
-            token = data.get('token')
-            xpub = data.get('xpub')
+            if address is None and data.get('xpub') in xpubs_with_tx_set:
+                requested_series.append((data, (account_ids[requested_account], None)))
+            elif address is not None and address.lower() in token_ids_with_tx:
+                requested_series.append((data, (account_ids[requested_account], token_ids_with_tx[address.lower()])))
 
-            try:
-                account_object_id = _fetch_xpub_from_db(xpub, network, script_type).id
-            except XPubNotRegisteredError as e:
-                logger.error('attempting to get multihistory of unregistered xpub: ' + str(e))
-                return JsonResponse({
-                    'success': False,
-                    'error': str(e)
-                    }, status=400)
+        # every series is computed by the same query
+        history, query_time_ms = balance_history_fetcher.fetch(
+            [series for _, series in requested_series], interval, start, end, ordering)
 
-            # non eth token with tx history || OR || eth token with tx history
-            if (address is None and xpub in xpubs_with_tx_set) or (address is not None and address.lower() in tokens_with_tx_set):
-                results = getBalanceHistoryForXpub(account_object_id, interval, limit, end, start, ordering, address)
-                results['network'] =  network
-                results['token'] =  token
-                results['xpub'] =  xpub
-                combinedResults.append(results)
+        combinedResults = []
+        for data, series in requested_series:
+            results = _format_balance_history(history.get(series), interval, start, end, limit, ordering, query_time_ms)
+            results['network'] = data.get('network')
+            results['token'] = data.get('token')
+            results['xpub'] = data.get('xpub')
+            combinedResults.append(results)
 
         return JsonResponse({'combinedResults': combinedResults})
 
+def _balances_are_local(request, networks):
+    # eth balances come from upstream unless they are read from the local db
+    return ETH not in networks or (
+        is_feature_enabled(LOCAL_ACCOUNT_BALANCES) and not is_feature_enabled(UNCHAINED_ACCOUNT_BALANCES)
+    )
+
+
 class BalancePage(APIView):
+    @cached_response('balance', cacheable=_balances_are_local)
     def post(self, request):
         """
         Example Request Payload:
@@ -638,99 +614,133 @@ class BalancePage(APIView):
         # flag indicating whether to use ethereum unchained for balances
         unchained_balances_enabled = is_feature_enabled(UNCHAINED_ACCOUNT_BALANCES)
 
-        eth_accounts = list(filter(lambda x: x.network == ETH, account_objects))
+        # evaluated here, the branches below only read it
+        account_objects = list(account_objects)
 
+        def accounts_of(*networks):
+            return [account for account in account_objects if account.network in networks]
+
+        eth_accounts = accounts_of(ETH)
         if unchained_balances_enabled:
-            start = current_time_millis()
-            eth_balances, token_balances = self.unchained_eth_balances(eth_accounts, supported_tokens)
-            if balance_timing_enabled:
-                logger.info('[timing] fetch unchained eth and token balances: %sms', (current_time_millis() - start))
+            eth_branch = ('unchained eth and token', lambda: self.unchained_eth_balances(eth_accounts, supported_tokens))
         elif local_balances_enabled:
-            start = current_time_millis()
-            eth_balances, token_balances = self.eth_balances(eth_accounts, supported_tokens)
-            if balance_timing_enabled:
-                logger.info('[timing] fetch local eth and token balances: %sms', (current_time_millis() - start))
+            eth_branch = ('local eth and token', lambda: self.eth_balances(eth_accounts, supported_tokens))
         else:
-            eth_balances, token_balances = self.legacy_eth_balances(eth_accounts, supported_tokens)
+            eth_branch = ('eth and token', lambda: self.legacy_eth_balances(eth_accounts, supported_tokens))
 
-        # Cosmos
-        cosmos_accounts = list(filter(lambda x: x.network == ATOM, account_objects))
-        start = current_time_millis()
-        cosmos_balances = self.tendermint_account_balances(ATOM, cosmos_accounts)
-
-        if balance_timing_enabled:
-            logger.info('[timing] fetch cosmos balances: %sms', (current_time_millis() - start))
-
-        # Thorchain
-        thor_accounts = list(filter(lambda x: x.network == RUNE, account_objects))
-        start = current_time_millis()
-        thor_balances = self.tendermint_account_balances(RUNE, thor_accounts)
-
-        if balance_timing_enabled:
-            logger.info('[timing] fetch cosmos balances: %sms', (current_time_millis() - start))
+        # this `not in []` statement is gross
+        utxo_accounts = list(filter(lambda x: x.network not in [ETH, ATOM, BNB, XRP, EOS, FIO, RUNE, OSMO], account_objects))
 
-        # Osmosis
-        osmo_accounts = list(filter(lambda x: x.network == OSMO, account_objects))
+        # every network is looked up concurrently, a branch that fails or misses the deadline is left out
+        self.failed_branches = set()
         start = current_time_millis()
-        osmo_balances = self.tendermint_account_balances(OSMO, osmo_accounts)
-
+        atom_accounts, rune_accounts, bnb_accounts, xrp_accounts, eos_accounts, osmo_accounts, fio_accounts = \
+            [accounts_of(network) for network in (ATOM, RUNE, BNB, XRP, EOS, OSMO, FIO)]
+        results = self.fan_out([
+            ('utxo', utxo_accounts, lambda: self.utxo_balances(utxo_accounts), []),
+            (eth_branch[0], eth_accounts, eth_branch[1], ([], [])),
+            ('cosmos', atom_accounts, lambda: self.tendermint_account_balances(ATOM, atom_accounts), []),
+            ('thorchain', rune_accounts, lambda: self.tendermint_account_balances(RUNE, rune_accounts), []),
+            ('binance', bnb_accounts, lambda: self.binance_balances(bnb_accounts), []),
+            ('ripple', xrp_accounts, lambda: self.ripple_balances(xrp_accounts), []),
+            ('eos', eos_accounts, lambda: self.eos_balances(eos_accounts), []),
+            ('osmo', osmo_accounts, lambda: self.tendermint_account_balances(OSMO, osmo_accounts), []),
+            ('fio', fio_accounts, lambda: self.fio_balances(fio_accounts), []),
+        ], balance_timing_enabled)
         if balance_timing_enabled:
-            logger.info('[timing] fetch osmo balances: %sms', (current_time_millis() - start))
+            logger.info('[timing] fetch all balances: %sms', (current_time_millis() - start))
 
-        # Binance
-        binance_accounts = list(filter(lambda x: x.network == BNB, account_objects))
-        start = current_time_millis()
-        binance_balances = self.binance_balances(binance_accounts)
+        utxo_balances, (eth_balances, token_balances), cosmos_balances, thor_balances, binance_balances, \
+            ripple_balances, eos_balances, osmo_balances, fio_balances = results
 
-        if balance_timing_enabled:
-            logger.info('[timing] fetch binance balances: %sms', (current_time_millis() - start))
-
-        # Ripple
-        ripple_accounts = list(filter(lambda x: x.network == XRP, account_objects))
-        start = current_time_millis()
-        ripple_balances = self.ripple_balances(ripple_accounts)
+        data = utxo_balances + eth_balances + token_balances + cosmos_balances + thor_balances + binance_balances + ripple_balances + eos_balances + osmo_balances + fio_balances
 
-        if balance_timing_enabled:
-            logger.info('[timing] fetch ripple balances: %sms', (current_time_millis() - start))
+        if not self.failed_branches:
+            return JsonResponse({
+                'success': True,
+                'data': data
+            })
 
-        # EOS
-        eos_accounts = list(filter(lambda x: x.network == EOS, account_objects))
-        start = current_time_millis()
-        eos_balances = self.eos_balances(eos_accounts)
+        # partial balances must not be cached, see cached_response
+        response = JsonResponse({
+            'success': True,
+            'data': data,
+            'failed': sorted(self.failed_branches)
+        })
+        response['Cache-Control'] = 'no-store'
+        return response
 
-        if balance_timing_enabled:
-            logger.info('[timing] fetch eos balances: %sms', (current_time_millis() - start))
+    def fan_out(self, branches, balance_timing_enabled):
+        """ Run the (name, accounts, fetch, fallback) branches on the balance executor, return their results in order
 
-        # FIO
-        fio_accounts = list(filter(lambda x: x.network == FIO, account_objects))
-        start = current_time_millis()
-        fio_balances = self.fio_balances(fio_accounts)
+            Branches without accounts are not submitted, their result is the fallback. A branch that raises, is still
+            running BALANCE_DEADLINE seconds after it started or did not get a worker within BALANCE_DEADLINE seconds
+            is logged, added to failed_branches and replaced by its fallback.
+        """
+        started = {}  # branch index: time.monotonic() a worker picked the branch up
 
-        if balance_timing_enabled:
-            logger.info('[timing] fetch fio balances: %sms', (current_time_millis() - start))
+        def timed(i, name, fetch):
+            started[i] = time.monotonic()
+            start = current_time_millis()
+            try:
+                return fetch()
+            finally:
+                # worker threads do not go through the request cycle that closes connections
+                db_connection.close()
+                if balance_timing_enabled:
+                    logger.info('[timing] fetch %s balances: %sms', name, (current_time_millis() - start))
+
+        results = [fallback for _, _, _, fallback in branches]
+        submitted = time.monotonic()
+        futures = {
+            _balance_executor.submit(timed, i, name, fetch): i
+            for i, (name, accounts, fetch, _) in enumerate(branches) if accounts
+        }
 
-        # this `not in []` statement is gross
-        utxo_accounts = list(filter(lambda x: x.network not in [ETH, ATOM, BNB, XRP, EOS, FIO, RUNE, OSMO], account_objects))
-        start = current_time_millis()
-        utxo_balances = self.utxo_balances(utxo_accounts)
-        if balance_timing_enabled:
-            logger.info('[timing] fetch utxo balances: %sms', (current_time_millis() - start))
+        def deadline(future):
+            return started.get(futures[future], submitted) + BALANCE_DEADLINE
 
-        data = utxo_balances + eth_balances + token_balances + cosmos_balances + thor_balances + binance_balances + ripple_balances + eos_balances + osmo_balances + fio_balances
+        def fail(i, e):
+            logger.error('failed to fetch %s balances: %s', branches[i][0], repr(e))
+            self.failed_branches.add(branches[i][0])
 
-        return JsonResponse({
-            'success': True,
-            'data': data
-        })
+        pending = set(futures)
+        while pending:
+            timeout = max(min(deadline(future) for future in pending) - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    fail(futures[future], e)
+
+            now = time.monotonic()
+            for future in [future for future in pending if deadline(future) <= now]:
+                i = futures[future]
+                if i not in started and not future.cancel():
+                    # picked up since, its own deadline starts now
+                    started.setdefault(i, now)
+                    continue
+                # a branch still running keeps its worker, only the response stops waiting for it
+                fail(i, FutureTimeoutError())
+                pending.remove(future)
+        return results
 
     def utxo_balances(self, accounts):
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            balances = dict(
+                AccountTotals.objects.filter(account__in=accounts).values_list('account_id', 'balance')
+            )
+        else:
+            balances = {account.id: account.final_balance() for account in accounts}
+
         return [
             {
                 'xpub': account.xpub,
                 'network': account.network,
                 'symbol': account.network,
                 'script_type': account.script_type,
-                'balance': account.final_balance()
+                'balance': balances.get(account.id, 0)
             } for account in accounts
         ]
 
@@ -931,11 +941,23 @@ class BalancePage(APIView):
     def unchained_eth_balances(self, accounts, tokens):
         unchained = get_unchained_client(ETH)
 
+        # one unchained call per account, all in flight at once
+        eth_addresses = [account.get_account_address().address for account in accounts]
+        futures = [
+            _balance_account_executor.submit(
+                unchained.get_balances, eth_address, account.id, tokens, timeout=BALANCE_CALL_TIMEOUT)
+            for account, eth_address in zip(accounts, eth_addresses)
+        ]
+
         eth_balances = list()
         token_balances = list()
-        for account in accounts:
-            eth_address = account.get_account_address().address
-            balances = unchained.get_balances(eth_address, account.id, tokens)
+        for account, eth_address, future in zip(accounts, eth_addresses, futures):
+            try:
+                balances = future.result(timeout=BALANCE_CALL_TIMEOUT)
+            except Exception as e:
+                logger.error('failed to fetch unchained balances of %s: %s', eth_address, repr(e))
+                self.failed_branches.add('unchained eth and token')
+                continue
 
             eth_balance = balances.get(ETH)
             if eth_balance is None:
@@ -972,9 +994,6 @@ class BalancePage(APIView):
         balance_timing_enabled = is_feature_enabled(ACCOUNT_BALANCE_TIMINGS)
         eth_balances = []
         token_balances = []
-        # setup async loop for concurrent token balance requests
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
         for account in accounts:
             eth_address = account.get_account_address().address
 
@@ -1000,13 +1019,12 @@ class BalancePage(APIView):
                 })
 
             start = current_time_millis()
-            loop.run_until_complete(self._fetch_token_balances(token_balances, eth_address))
+            # concurrent token balance requests on the shared async client
+            run_sync(self._fetch_token_balances(token_balances, eth_address))
 
             if balance_timing_enabled:
                 logger.info('[timing] fetch token balances: %sms', (current_time_millis() - start))
 
-        loop.close()
-
         # process eth balances
         start = current_time_millis()
         eth_balances = self.get_eth_xpub_balances(eth_balances)
@@ -1016,9 +1034,6 @@ class BalancePage(APIView):
         return eth_balances, token_balances
 
     async def _fetch_token_balances(self, tokens, address):
-        loop_ref = asyncio.get_event_loop()
-        session = requests.Session()
-        session.mount('https://', HTTPAdapter(pool_maxsize=20))
         futures = []
 
         # get all token balances from redis in one shot
@@ -1031,22 +1046,19 @@ class BalancePage(APIView):
             else:
                 contract_addr = t['contract_address']
                 url = self._get_token_balance_url(contract_addr, address)
-                futures.append(loop_ref.run_in_executor(None, self._get_token_balance, session, url, contract_addr, balances[i]))
+                futures.append(self._get_token_balance(url, contract_addr, balances[i]))
 
         # await and update balances
         if len(futures):
-            results, _ = await asyncio.wait(futures)
+            results = await asyncio.gather(*futures)
 
-            for r in results:
-                balance, contract_addr = r.result()
+            for balance, contract_addr in results:
                 # store eth token balance in cache
                 key = eth_balance_cache_key_format(address, contract_addr)
                 redisClient.setex(key, ETH_BALANCE_TTL, balance)
                 t = next((t for t in tokens if t['contract_address'] == contract_addr and t['address'] == address), None)
                 t['balance'] = balance
 
-        session.close()
-
     def _get_token_balance_url(self, contract, addr):
         params = {
             'module': 'account',
@@ -1064,12 +1076,11 @@ class BalancePage(APIView):
             query_string=query_string
         )
 
-    def _get_token_balance(self, session, url, contract_addr, balance):
+    async def _get_token_balance(self, url, contract_addr, balance):
         if url is not None:
             try:
-                response = session.get(url)
-                json_data = response.json()
-                balance = json_data.get('result', None)
+                response = await async_http.get(url, timeout=BALANCE_CALL_TIMEOUT)
+                balance = response.json_data.get('result', None)
             except Exception as e:
                 logger.error('failed to GET ETH token balance from: {} | reason: {}'.format(url, str(e)))
 
@@ -1113,6 +1124,9 @@ class BalancePage(APIView):
 
 class CreateUnsignedTransactionPage(APIView):
     def post(self, request):
+        return self.create(request.body)
+
+    def create(self, body):
         """
         Example Request Payload:
         {
@@ -1143,7 +1157,7 @@ class CreateUnsignedTransactionPage(APIView):
         }                                      // only used for BTC
         """
         try:
-            request_json = json.loads(request.body)  # TODO: Validation
+            request_json = json.loads(body)  # TODO: Validation
             network = request_json.get('network')
             _validate_network(network)
             input_xpubs = []
@@ -1334,11 +1348,15 @@ class CreateUnsignedTransactionPage(APIView):
                 #    return False
                 return True
 
-            coinquery = get_coinquery_client(network)
             txids_needing_prevtx = [tx_input['txid'] for tx_input in unsigned_tx['inputs'] if include_txs and needs_prevtx(tx_input)]
             txids_needing_raw_hex = [tx_input['txid'] for tx_input in unsigned_tx['inputs'] if include_hex]
-            prevtx_map = coinquery.get_transactions_for_txids(txids_needing_prevtx, precise=True)
-            rawtx_map = coinquery.get_raw_transactions_for_txids(txids_needing_raw_hex)
+            input_confirmations = {tx_input['txid']: tx_input.get('confirmations') for tx_input in unsigned_tx['inputs']}
+            prevtx_map, rawtx_map = self._fetch_input_txs(
+                get_coinquery_client(network),
+                txids_needing_prevtx,
+                txids_needing_raw_hex,
+                input_confirmations
+            )
 
             for tx_input in unsigned_tx['inputs']:
                 tx_input['tx'] = prevtx_map.get(tx_input['txid'], None)
@@ -1374,6 +1392,12 @@ class CreateUnsignedTransactionPage(APIView):
             'data': formatted_unsigned_tx
         })
 
+    def _fetch_input_txs(self, coinquery, txids_needing_prevtx, txids_needing_raw_hex, input_confirmations):
+        """ (prevtx_map, rawtx_map) of the inputs, the async view fetches them concurrently instead """
+        prevtx_map = coinquery.get_transactions_for_txids(txids_needing_prevtx, precise=True)
+        rawtx_map = coinquery.get_raw_transactions_for_txids(txids_needing_raw_hex, confirmations=input_confirmations)
+        return prevtx_map, rawtx_map
+
     def _handle_erc20_token(self, account_object, recipients, contract_address, token=None):
         contract_address = format_ethereum_address(contract_address)
         from_address = format_ethereum_address(account_object.get_account_address().address)
@@ -1568,6 +1592,14 @@ class CreateUnsignedTransactionPage(APIView):
         })
 
 
+def _unpack_send_request(body):
+    logger.info('/send request: {}'.format(body))
+    request_json = json.loads(body)
+    _validate_network(request_json.get('network'))
+    # TODO: validate rawtx
+    return request_json
+
+
 class SendTransactionPage(APIView):
     def post(self, request):
         """
@@ -1578,13 +1610,7 @@ class SendTransactionPage(APIView):
         }
         """
         try:
-            logger.info('/send request: {}'.format(request.body))
-            request_json = json.loads(request.body)
-            network = request_json.get('network')
-            _validate_network(network)
-            # TODO: validate rawtx
-            rawtx = request_json.get('rawtx')
-
+            request_json = _unpack_send_request(request.body)
         except ValueError as e:
             return JsonResponse({
                 'success': False,
@@ -1592,23 +1618,7 @@ class SendTransactionPage(APIView):
             }, status=400)
 
         try:
-            if network == ETH:
-                txid = web3.toHex(web3.eth.sendRawTransaction(rawtx))             
-            elif network == BNB:
-                txid = binance_client.broadcast(rawtx)
-            elif network == XRP:
-                txid = ripple.broadcast(rawtx)
-            elif network == FIO:
-                txid = fio.broadcast(rawtx)
-            elif network == EOS:
-                txid = eos_client.broadcast(rawtx, request_json.get('signatures'))
-            elif network in [ATOM, RUNE, OSMO]:
-                gaia = get_gaia_client(network)
-                txid = gaia.broadcast(rawtx)
-            else:
-                coinquery = get_coinquery_client(network)
-                txid = coinquery.send(rawtx)
-                self.start_watching_tx(network, txid)
+            txid = self.broadcast(request_json)
 
             return JsonResponse({
                 'success': True,
@@ -1622,6 +1632,30 @@ class SendTransactionPage(APIView):
                 'error': str(e)
             }, status=400)
 
+    def broadcast(self, request_json):
+        network = request_json.get('network')
+        rawtx = request_json.get('rawtx')
+
+        if network == ETH:
+            txid = web3.toHex(web3.eth.sendRawTransaction(rawtx))
+        elif network == BNB:
+            txid = binance_client.broadcast(rawtx)
+        elif network == XRP:
+            txid = ripple.broadcast(rawtx)
+        elif network == FIO:
+            txid = fio.broadcast(rawtx)
+        elif network == EOS:
+            txid = eos_client.broadcast(rawtx, request_json.get('signatures'))
+        elif network in [ATOM, RUNE, OSMO]:
+            gaia = get_gaia_client(network)
+            txid = gaia.broadcast(rawtx)
+        else:
+            coinquery = get_coinquery_client(network)
+            txid = coinquery.send(rawtx)
+            self.start_watching_tx(network, txid)
+
+        return txid
+
     def start_watching_tx(self, network, txid):
         redisClient.sadd(WATCH_TX_SET_KEY + network, txid)
 
@@ -1795,6 +1829,7 @@ class XPubStatusPage(APIView):
                     raise e
 
 
+    @cached_response('xpubs')
     def post(self, request):
         try:
             xpubs = _unpack_and_validate_xpubs(request)
@@ -1804,17 +1839,26 @@ class XPubStatusPage(APIView):
                 'error': str(e)
             }, status=400)
 
+        try:
+            account_objects = _fetch_xpubs_from_db(xpubs)
+        except XPubNotRegisteredError as e:
+            logger.error('attempting to get status of unregistered pubkey: ' + str(e))
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+
+        accounts = {(obj.xpub, obj.network, obj.script_type): obj for obj in account_objects}
+        tx_counts = dict(
+            Transaction.objects.filter(account__in=account_objects)
+            .values_list('account_id')
+            .annotate(tx_count=Count('id'))
+        )
+
         results = []
 
         for xpub, network, script_type in xpubs:
-            try:
-                account_object = _fetch_xpub_from_db(xpub, network, script_type)
-            except XPubNotRegisteredError as e:
-                logger.error('attempting to get status of unregistered pubkey: ' + str(e))
-                return JsonResponse({
-                    'success': False,
-                    'error': str(e)
-                }, status=400)
+            account_object = accounts[(xpub, network, script_type)]
 
             try:
                 self.migrate(account_object)
@@ -1824,7 +1868,7 @@ class XPubStatusPage(APIView):
                     'error': str(e)
                 }, status=400)
 
-            tx_count = Transaction.objects.filter(account=account_object).count()
+            tx_count = tx_counts.get(account_object.id, 0)
 
             result = {
                 'xpub': account_object.xpub,
@@ -1842,10 +1886,47 @@ class XPubStatusPage(APIView):
             'data': results
         })
 
+# balance sync task of each account based network, in the order they are scheduled
+ACCOUNT_BALANCE_SYNCS = [
+    (ETH, lambda address: sync_eth_account_balances.s(address)),
+    (ATOM, lambda address: sync_account_balances.s(ATOM, address)),
+    (RUNE, lambda address: sync_account_balances.s(RUNE, address)),
+    (OSMO, lambda address: sync_account_balances.s(OSMO, address)),
+    (BNB, lambda address: sync_bnb_account_balances.s(address)),
+    (FIO, lambda address: sync_fio_account_balances.s(address)),
+    (XRP, lambda address: sync_xrp_account_balances.s(address)),
+]
+
+
+def _balance_sync_lock_key(network, address):
+    return 'watchtower:{}:balances:sync:lock:{}'.format(network.lower(), address)
+
+
+def _schedule_account_balance_syncs(account_objects):
+    """ Queue a balance sync of every account based account not synced in the last BALANCE_SYNC_TTL, returns their addresses """
+    result = list()
+    for network, sync_task in ACCOUNT_BALANCE_SYNCS:
+        for account in filter(lambda x: x.network == network, account_objects):
+            address = account.get_account_address().address
+            locked = redisClient.get(_balance_sync_lock_key(account.network, address))
+            if locked is None:
+                logger.info('syncing %s account balances: %s', network.lower(), address)
+                sync_task(address).apply_async()
+                result.append(address)
+                redisClient.setex(_balance_sync_lock_key(account.network, address), BALANCE_SYNC_TTL, address)
+            else:
+                logger.debug('recently synced account %s, ignoring', address)
+
+    return result
+
+
 class SyncAccountBasedBalancesPage(APIView):
     def post(self, request):
+        return self.sync_balances(request.body)
+
+    def sync_balances(self, body):
         try:
-            xpubs = _unpack_and_validate_xpubs(request)
+            xpubs = _unpack_and_validate_xpubs_body(body)
         except ValueError as e:
             return JsonResponse({
                 'success': False,
@@ -1861,96 +1942,9 @@ class SyncAccountBasedBalancesPage(APIView):
                 'error': str(e)
             }, status=400)
 
-        eth_accounts = list(filter(lambda x: x.network == ETH, account_objects))
-        cosmos_accounts = list(filter(lambda x: x.network == ATOM, account_objects))
-        thorchain_accounts = list(filter(lambda x: x.network == RUNE, account_objects))
-        osmo_accounts = list(filter(lambda x: x.network == OSMO, account_objects))
-        binance_accounts = list(filter(lambda x: x.network == BNB, account_objects))
-        ripple_accounts = list(filter(lambda x: x.network == XRP, account_objects))
-        fio_accounts = list(filter(lambda x: x.network == FIO, account_objects))
-
-        result = list()
-        for account in eth_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing eth account balances: %s', address)
-                sync_eth_account_balances.s(address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in cosmos_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing atom account balances: %s', address)
-                sync_account_balances.s(ATOM, address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in thorchain_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing thorchain account balances: %s', address)
-                sync_account_balances.s(RUNE, address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in osmo_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing osmo account balances: %s', address)
-                sync_account_balances.s(OSMO, address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in binance_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing bnb account balances: %s', address)
-                sync_bnb_account_balances.s(address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in fio_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing fio account balances: %s', address)
-                sync_fio_account_balances.s(address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
-
-        for account in ripple_accounts:
-            address = account.get_account_address().address
-            locked = redisClient.get(self.cache_key(account.network, address))
-            if locked is None:
-                logger.info('syncing xrp account balances: %s', address)
-                sync_xrp_account_balances.s(address).apply_async()
-                result.append(address)
-                redisClient.setex(self.cache_key(account.network, address), BALANCE_SYNC_TTL, address)
-            else:
-                logger.debug('recently synced account %s, ignoring', address)
+        result = _schedule_account_balance_syncs(account_objects)
 
         return JsonResponse({
             'success': True,
             'data': result
         })
-
-    def cache_key(self, network, address):
-        return 'watchtower:{}:balances:sync:lock:{}'.format(network.lower(), address)
@@ -0,0 +1,56 @@
+"""
+Per-account version counters for caching API responses
+
+Every writer of an account's transactions, balance changes or balances bumps the account's counter once its
+transaction commits, and refresh_chainheights bumps the chain counter that confirmations are computed from. A
+response computed from the accounts at versions v is then valid for as long as their counters stay at v, so cached
+responses are keyed by the versions they were computed at instead of expiring after a guessed TTL.
+
+The registry version is bumped whenever an account is registered or unregistered, for the in-process caches of which
+(xpub, network, script_type) is which account.
+"""
+import logging
+
+from django.db import transaction as db_transaction
+
+from common.services.redis import redisClient, ACCOUNT_VERSION_PREFIX, ACCOUNT_REGISTRY_VERSION, CHAIN_VERSION, \
+    ETH_BLOCK_HEIGHT
+
+logger = logging.getLogger('watchtower.common.services.account_versions')
+
+
+def _incr(keys):
+    try:
+        pipe = redisClient.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(key)
+        pipe.execute()
+    except Exception as e:
+        logger.error('failed to bump versions %s: %s', keys, str(e))
+
+
+def bump_account_versions(account_ids):
+    """ Bump the version of account_ids after the current transaction commits, right away outside of one """
+    keys = sorted({ACCOUNT_VERSION_PREFIX + str(account_id) for account_id in account_ids})
+    if keys:
+        db_transaction.on_commit(lambda: _incr(keys))
+
+
+def bump_chain_version():
+    db_transaction.on_commit(lambda: _incr([CHAIN_VERSION]))
+
+
+def bump_registry_version():
+    db_transaction.on_commit(lambda: _incr([ACCOUNT_REGISTRY_VERSION]))
+
+
+def get_registry_version():
+    return int(redisClient.get(ACCOUNT_REGISTRY_VERSION) or 0)
+
+
+def get_versions(account_ids, chain=False):
+    """ Current versions of account_ids, followed by the chain version and eth height when chain is set """
+    keys = [ACCOUNT_VERSION_PREFIX + str(account_id) for account_id in account_ids]
+    if chain:
+        keys += [CHAIN_VERSION, ETH_BLOCK_HEIGHT]
+    return [int(version or 0) for version in redisClient.mget(keys)] if keys else []
@@ -0,0 +1,180 @@
+"""
+Local disk cache of immutable upstream chain data
+
+Blocks, txs and raw tx hex stop changing once they are buried deep enough in the chain, so anything with at least
+CHAIN_CACHE_MIN_CONFIRMATIONS confirmations is kept on disk under CHAIN_CACHE_DIR and served from there instead of
+being downloaded again. Entries are content addressed by network, kind and block hash / txid, and written
+atomically so any number of processes can share a directory. Total size is capped at CHAIN_CACHE_MAX_BYTES by
+evicting the least recently used entries, reads bump an entry's mtime to mark it as used.
+
+Cached values are returned exactly as they were stored, so fields that keep changing after the write threshold
+(e.g. confirmations) are only a lower bound. The cache is disabled when CHAIN_CACHE_DIR is not set.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('watchtower.common.services.chain_cache')
+
+BLOCK = 'block'
+BLOCK_TXS = 'block_txs'
+TX = 'tx'
+TX_PRECISE = 'tx_precise'
+RAW_TX = 'raw_tx'
+
+EVICT_TO = 0.9  # fraction of max_bytes left after an eviction pass
+RESCAN_INTERVAL = 60 * 5  # seconds, re-measure the directory to account for writes from other processes
+
+
+class ChainCache:
+    def __init__(self, directory, max_bytes, min_confirmations):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_confirmations = min_confirmations
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._size = None
+        self._scanned_at = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get('CHAIN_CACHE_DIR') or None,
+            int(os.environ.get('CHAIN_CACHE_MAX_BYTES') or 1024 ** 3),
+            int(os.environ.get('CHAIN_CACHE_MIN_CONFIRMATIONS') or '6'),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def is_confirmed(self, confirmations):
+        return confirmations is not None and confirmations >= self.min_confirmations
+
+    def _path(self, network, kind, key):
+        digest = hashlib.sha256('{}:{}:{}'.format(network, kind, key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.json.gz')
+
+    def get(self, network, kind, key):
+        if not self.enabled:
+            return None
+
+        path = self._path(network, kind, key)
+        try:
+            with gzip.open(path, 'rt') as f:
+                value = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.error('dropping unreadable %s %s cache entry %s: %s', network, kind, key, str(e))
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def get_many(self, network, kind, keys):
+        """ Return {key: value} for the keys that are cached """
+        found = {}
+        for key in keys:
+            value = self.get(network, kind, key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def put(self, network, kind, key, value):
+        if not self.enabled:
+            return
+
+        path = self._path(network, kind, key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(json.dumps(value).encode('utf-8'))
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error('failed to cache %s %s %s: %s', network, kind, key, str(e))
+            if tmp_path:
+                self._remove(tmp_path)
+            return
+
+        self.writes += 1
+        with self._lock:
+            if self._size is None or time.time() - self._scanned_at > RESCAN_INTERVAL:
+                self._scan()
+            else:
+                self._size += size
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):  # still being written
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan(self):
+        self._size = sum(size for _, size, _ in self._entries())
+        self._scanned_at = time.time()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO
+
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+
+        self.evictions += evicted
+        self._size = total
+        self._scanned_at = time.time()
+        logger.info('evicted %s chain cache entries, %s bytes remain', evicted, total)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'size_bytes': self._size,
+            'max_bytes': self.max_bytes,
+        }
+
+
+chain_cache = ChainCache.from_env()
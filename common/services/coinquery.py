@@ -3,11 +3,14 @@ CoinQuery Python Client
 
 Based on Insight API (https://github.com/bitpay/insight-api)
 """
+import asyncio
 import logging
 import os
 import urllib3
 
-from common.utils.requests import requests_util, http
+from common.services.chain_cache import chain_cache, BLOCK, BLOCK_TXS, TX, TX_PRECISE, RAW_TX
+from common.utils.requests import requests_util, http, HTTPError
+from common.utils.async_requests import async_http
 from common.utils.networks import SUPPORTED_NETWORKS, BTC, BCH, DASH, DGB, ETH, LTC, DOGE, ATOM, BNB, EOS, XRP, FIO, RUNE, SCRT, KAVA, OSMO
 
 
@@ -16,9 +19,10 @@ apikey = 'watchtower-' + os.environ.get('ENV')
 
 
 class CoinQueryClient(object):
-    def __init__(self, network=BTC):
+    def __init__(self, network=BTC, cache=chain_cache):
         self.network = network
         self.baseurl = self.route(network)
+        self.cache = cache
 
     # switch on network
     @staticmethod
@@ -70,7 +74,35 @@ class CoinQueryClient(object):
 
             return txs
 
+    def get_transactions_page(self, addresses, _from, _to):
+        """ One page of the combined transactions of addresses, returns the insight response with items and totalItems """
+        url = '{}/addrs/{}/txs?from={}&to={}&apikey={}'.format(self.baseurl, ','.join(addresses), _from, _to, apikey)
+        return http.get(url, retries=2).json_data
+
+    def get_recent_transactions(self, addresses, max_confirmations, page_size=50):
+        """ Transactions of addresses with at most max_confirmations confirmations, unconfirmed ones included
+
+            insight lists transactions newest first, so paging stops at the first one that is older
+        """
+        txs = []
+        _from = 0
+        while True:
+            resp = self.get_transactions_page(addresses, _from, _from + page_size)
+            for tx in resp.get('items') or []:
+                if (tx.get('confirmations') or 0) > max_confirmations:
+                    return txs
+                txs.append(tx)
+
+            _from += page_size
+            if _from >= (resp.get('totalItems') or 0):
+                return txs
+
     def get_transactions_by_block_hash(self, block_hash, page=None):
+        if page is None:
+            cached = self.cache.get(self.network, BLOCK_TXS, block_hash)
+            if cached is not None:
+                return cached
+
         def get_url(page_x):
             url = '{}/txs?block={}&pageNum={}&apikey={}'.format(self.baseurl, block_hash, page_x if page_x is not None else 0, apikey)
 
@@ -87,43 +119,136 @@ class CoinQueryClient(object):
             for resp in requests_util.get_multiple(urls):
                 txs += resp.json_data.get('txs', [])
 
+            if txs and all(self.cache.is_confirmed(tx.get('confirmations')) for tx in txs):
+                self.cache.put(self.network, BLOCK_TXS, block_hash, txs)
+
             return txs
 
     def get_transactions_for_txids(self, txids, precise=False):
         baseurl = self.baseurl
         query_params = "?apikey={}".format(apikey)
+        kind = TX
 
         # CQ doesn't have Dash extraPayload/extraPayloadSize yet, so as a
         # crutch, grab this from dash.org instead:
         if precise and self.network == DASH:
             baseurl = "https://insight.dash.org/insight-api"
             query_params = ""
+            kind = TX_PRECISE
 
-        urls = ['{}/tx/{}{}'.format(baseurl, txid, query_params) for txid in set(txids)]
-        tx_map = {}
+        tx_map = self.cache.get_many(self.network, kind, set(txids))
+
+        urls = ['{}/tx/{}{}'.format(baseurl, txid, query_params) for txid in set(txids) if txid not in tx_map]
         for resp in requests_util.get_multiple(urls):
             tx = resp.json_data
             tx_map[tx['txid']] = tx
+            if self.cache.is_confirmed(tx.get('confirmations')):
+                self.cache.put(self.network, kind, tx['txid'], tx)
         return tx_map
 
-    def get_raw_transactions_for_txids(self, txids):
+    def lookup_transactions(self, txids):
+        """ (tx_map, not_found, failed) of txids, not_found are the txids upstream answered 404 for and failed the
+            ones whose lookup errored any other way
+        """
+        tx_map = self.cache.get_many(self.network, TX, set(txids))
+
+        not_found = []
+        failed = []
+        for txid in set(txids):
+            if txid in tx_map:
+                continue
+            try:
+                tx = http.get('{}/tx/{}?apikey={}'.format(self.baseurl, txid, apikey), retries=2).json_data
+            except HTTPError as e:
+                (not_found if e.status == 404 else failed).append(txid)
+                continue
+            except Exception as e:
+                logger.warning('failed to look up %s tx %s: %s', self.network, txid, str(e))
+                failed.append(txid)
+                continue
+
+            tx_map[tx['txid']] = tx
+            if self.cache.is_confirmed(tx.get('confirmations')):
+                self.cache.put(self.network, TX, tx['txid'], tx)
+        return tx_map, not_found, failed
+
+    def get_raw_transactions_for_txids(self, txids, confirmations=None):
+        """ confirmations optionally maps txid to a known confirmation count, only confirmed hex is cached """
+        confirmations = confirmations or {}
+        raw_tx_map = self.cache.get_many(self.network, RAW_TX, set(txids))
+
         baseurl = self.baseurl
         txid_dict = {}
         for txid in set(txids):
+            if txid in raw_tx_map:
+                continue
             txid_dict[txid] = {}
             txid_dict[txid]['url'] = '{}/rawtx/{}'.format(baseurl, txid)
 
-        raw_tx_map = {}
         for txid, value in requests_util.get_multiple_from_dictionary(txid_dict).items():
             tx = value['response'].json_data
             raw_tx_map[txid] = tx['rawtx']
+            if self.cache.is_confirmed(confirmations.get(txid)):
+                self.cache.put(self.network, RAW_TX, txid, tx['rawtx'])
+
+        return raw_tx_map
+
+    async def get_transactions_for_txids_async(self, txids, precise=False):
+        """ get_transactions_for_txids with the uncached transactions fetched concurrently """
+        baseurl = self.baseurl
+        query_params = "?apikey={}".format(apikey)
+        kind = TX
+
+        if precise and self.network == DASH:
+            baseurl = "https://insight.dash.org/insight-api"
+            query_params = ""
+            kind = TX_PRECISE
+
+        tx_map = self.cache.get_many(self.network, kind, set(txids))
+
+        urls = ['{}/tx/{}{}'.format(baseurl, txid, query_params) for txid in set(txids) if txid not in tx_map]
+        responses = await asyncio.gather(*[async_http.get(url, retries=2) for url in urls], return_exceptions=True)
+        for resp in responses:
+            if isinstance(resp, Exception):
+                continue
+            tx = resp.json_data
+            tx_map[tx['txid']] = tx
+            if self.cache.is_confirmed(tx.get('confirmations')):
+                self.cache.put(self.network, kind, tx['txid'], tx)
+        return tx_map
+
+    async def get_raw_transactions_for_txids_async(self, txids, confirmations=None):
+        """ get_raw_transactions_for_txids with the uncached transactions fetched concurrently """
+        confirmations = confirmations or {}
+        raw_tx_map = self.cache.get_many(self.network, RAW_TX, set(txids))
+
+        missing = [txid for txid in set(txids) if txid not in raw_tx_map]
+        responses = await asyncio.gather(*[
+            async_http.get('{}/rawtx/{}'.format(self.baseurl, txid), retries=2) for txid in missing
+        ])
+        for txid, resp in zip(missing, responses):
+            raw_tx_map[txid] = resp.json_data['rawtx']
+            if self.cache.is_confirmed(confirmations.get(txid)):
+                self.cache.put(self.network, RAW_TX, txid, resp.json_data['rawtx'])
 
         return raw_tx_map
 
-    def get_block_by_hash(self, block_hash):
+    def get_block_by_hash(self, block_hash, cached=True):
+        """ cached blocks come without confirmations and nextblockhash, pass cached=False to read the chain position """
+        if cached:
+            block = self.cache.get(self.network, BLOCK, block_hash)
+            if block is not None:
+                return block
+
         url = '{}/block/{}?apikey={}'.format(self.baseurl, block_hash, apikey)
         resp = http.get(url)
-        return resp.json_data
+        block = resp.json_data
+        if self.cache.is_confirmed(block.get('confirmations')):
+            # both change on a reorg at any depth
+            self.cache.put(self.network, BLOCK, block_hash, {
+                key: value for key, value in block.items() if key not in ('confirmations', 'nextblockhash')
+            })
+        return block
 
     def get_last_block_hash(self):
         url = '{}/status?q=getLastBlockHash&apikey={}'.format(self.baseurl, apikey)
@@ -131,7 +256,7 @@ class CoinQueryClient(object):
         return resp.json_data.get('lastblockhash')
 
     def get_next_block_hash(self, block_hash):
-        block = self.get_block_by_hash(block_hash)
+        block = self.get_block_by_hash(block_hash, cached=False)
         return block.get('nextblockhash')
 
     def get_utxos_for_addresses(self, addresses):
@@ -168,6 +293,16 @@ class CoinQueryClient(object):
 
         return resp.json_data.get('txid')
 
+    async def send_async(self, rawtx):
+        url = '{}/tx/send?apikey={}'.format(self.baseurl, apikey)
+        body = {'rawtx': rawtx}
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+
+        # connection failures and timeouts are retried like send (workaround for 104 Connection Reset By Peer)
+        resp = await async_http.post(url, body=body, headers=headers, retries=3)
+
+        return resp.json_data.get('txid')
+
 clients = {network: CoinQueryClient(network) for network in SUPPORTED_NETWORKS}
 
 def get_client(network):
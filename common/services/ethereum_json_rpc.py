@@ -1,6 +1,9 @@
+import json
 import requests
 import os
 
+from common.utils.async_requests import async_http
+
 # Web3 JSON-RPC Spec:
 # https://github.com/ethereum/eth1.0-specs/blob/b4ebe3d6056a2f5edb6f9411da58e042f7a95d2a/json-rpc/spec.json
 class EthereumJsonRpc:
@@ -21,8 +24,28 @@ class EthereumJsonRpc:
         response_json = response.json()
         return response_json.get('result', None)
 
+    def batch(self, calls, timeout=None):
+        """ One batched request of [(method, params)], returns the response object of every call in order """
+        body = [dict(self.req_body, id=i, method=method, params=params) for i, (method, params) in enumerate(calls)]
+        response = requests.post(self.baseurl, json=body, timeout=timeout)
+        response.raise_for_status()
+        items = response.json()
+        if not isinstance(items, list):
+            raise ValueError('batch request rejected: {}'.format(items))
+        by_id = {item.get('id'): item for item in items}
+        return [by_id.get(i, {'error': 'missing from batch response'}) for i in range(len(calls))]
+
     def get_max_priority_fee_per_gas(self):
         body = self.req_body
         body['method'] = 'eth_maxPriorityFeePerGas'
         body['params'] = []
         return self.post(body)
+
+    async def send_raw_transaction_async(self, rawtx):
+        """ eth_sendRawTransaction through the shared async client, raises ValueError with the node's error like web3 """
+        body = dict(self.req_body, method='eth_sendRawTransaction', params=[rawtx])
+        response = await async_http.post(self.baseurl, body=body, headers={'Content-Type': 'application/json'}, retries=0)
+        response_json = response.json_data or json.loads(response.data.decode('utf-8'))
+        if 'error' in response_json:
+            raise ValueError(response_json['error'])
+        return response_json.get('result', None)
@@ -14,6 +14,17 @@ UNCHAINED_REGISTRY = 'unchainedregistry'
 UNCHAINED_ACCOUNT_BALANCES = 'unchainedaccountbalances'
 PUBLISH_CONFIRMED_TXS = 'publishconfirmedtxs'
 INCLUDE_EIP1559_FEES = 'includeeip1559fees'
+BULK_SAVE_RESULTS = 'bulksaveresults'
+TRACKED_ADDRESS_PREFILTER = 'trackedaddressprefilter'
+BATCH_DERIVATION = 'batchderivation'
+INCREMENTAL_RESYNC = 'incrementalresync'
+BALANCE_READ_MODEL = 'balancereadmodel'
+LOCAL_UTXOS = 'localutxos'
+VERIFY_LOCAL_UTXOS = 'verifylocalutxos'
+BALANCE_ROLLUPS = 'balancerollups'
+RESPONSE_CACHE = 'responsecache'
+ERC20_TOPIC_FILTER = 'erc20topicfilter'
+COALESCED_BALANCE_REFRESH = 'coalescedbalancerefresh'
 
 # initialize LD
 ldclient.set_sdk_key(settings.LAUNCH_DARKLY_SDK_KEY)
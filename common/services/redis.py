@@ -26,4 +26,16 @@ ETH_ACCOUNT = 'watchtower:eth:account:'
 BTC_FEES = 'watchtower:btc:fees'
 BTC_FEES_NODE = 'watchtower:btc:fees_node'
 
+ADDRESS_FILTER_PREFIX = 'watchtower:address_filter:'
+
+ACCOUNT_VERSION_PREFIX = 'watchtower:version:account:'
+CHAIN_VERSION = 'watchtower:version:chain'
+ACCOUNT_REGISTRY_VERSION = 'watchtower:version:registry'
+RESPONSE_CACHE_PREFIX = 'watchtower:response:'
+ERC20_TOKEN_PREFIX = 'watchtower:erc20_token:'
+UTXO_MISSING_TXS_PREFIX = 'watchtower:utxo_missing_txs:'
+BALANCE_REFRESH_PREFIX = 'watchtower:balance_refresh:'
+BALANCE_REFRESHES_SCHEDULED = 'watchtower:metrics:balance_refreshes:scheduled'
+BALANCE_REFRESHES_SUPPRESSED = 'watchtower:metrics:balance_refreshes:suppressed'
+
 redisClient = redis.Redis(host=os.environ.get('REDIS_HOST'), port=os.environ.get('REDIS_PORT'), password='', decode_responses=True)
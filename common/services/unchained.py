@@ -30,12 +30,13 @@ class UnchainedClient(object):
             ETH: os.getenv('UNCHAINED_ETH_URL')
         }.get(network)
 
-    def get_balances(self, address, account_id, supported_tokens=None):
+    def get_balances(self, address, account_id, supported_tokens=None, timeout=None):
         if not address:
             logger.error("Unable to get %s balances for account: %s. No associated address.", self.network, account_id)
             return dict()
 
-        resp = http.get('{}/api/v2/address/{}?details=tokenBalances'.format(self.baseurl, address)).json_data
+        resp = http.get('{}/api/v2/address/{}?details=tokenBalances'.format(self.baseurl, address),
+                        timeout=timeout).json_data
 
         balances = {token.get('contract').lower(): token.get('balance') for token in resp.get('tokens', list())}
         balances[ETH] = resp.get('balance')
@@ -2,9 +2,15 @@ from django.test import TestCase
 from unittest import mock
 
 from .utils.bip32 import is_valid_bip32_xpub, derive_addresses, derive_ethereum_address, derive_segwit_p2sh_p2wpkh_addresses
+from .utils.bip32_batch import derive_range
 from .utils.networks import SUPPORTED_NETWORKS, BTC, BCH, BNB, LTC, DASH, DOGE, DGB, ATOM, XRP, EOS, RUNE, SCRT, KAVA, OSMO
 from .utils.transactions import create_unsigned_utxo_transaction
 from .utils.utils import timestamp_to_unix
+from .utils.utxo import parse_satoshis, decode_tx
+from .services.chain_cache import ChainCache, BLOCK, TX
+from .services.account_versions import bump_account_versions, get_versions
+from .services.redis import ACCOUNT_VERSION_PREFIX, CHAIN_VERSION, ETH_BLOCK_HEIGHT
+from .utils.requests import HTTPError
 
 
 class Bip32UtilTest(TestCase):
@@ -435,6 +441,19 @@ class Bip32UtilTest(TestCase):
         )
 
 
+class DeriveRangeTest(TestCase):
+    def test_matches_derive_addresses(self):
+        xpub = 'xpub6Chd4kunDV37PJANQzakXojBEUvjfvWk9ZoPuKdc5bDUwFbnA1dd9aScszzcNqzTEMXN9Qor5v9opipuNQf1EVxjdZPs5A5YwuyxFGe4AGu'
+        cases = [(network, 'p2pkh') for network in (BTC, BCH, LTC, DASH, DOGE, DGB)] + \
+                [(network, script_type) for network in (BTC, LTC) for script_type in ('p2sh-p2wpkh', 'p2wpkh')]
+
+        for network, script_type in cases:
+            for chain in (0, 1):
+                expected = derive_addresses(xpub, str(chain), 25, from_index=7, network=network, script_type=script_type)
+                self.assertEqual(derive_range(xpub, chain, 7, 25, script_type, network), expected,
+                                 '{} {} {}'.format(network, script_type, chain))
+
+
 class TimestampToUnixTestCase(TestCase):
     def test_timestamp_to_unix(self):
 
@@ -451,6 +470,140 @@ class TimestampToUnixTestCase(TestCase):
 
 
 
+class UtxoDecoderTestCase(TestCase):
+    def test_parse_satoshis_matches_decimal(self):
+        from decimal import Decimal
+        values = ['12.50517068', '0.00000546', '21000000.00000000', '1', '.5', '0.1', '1.000000005', '1.000000015',
+                  '1.0000000051', '1E-8', '-0.5', 0, 3, 0.1]
+        for value in values:
+            expected = int(Decimal(value).quantize(Decimal(10) ** -8) * (10 ** 8))
+            self.assertEqual(parse_satoshis(value), expected, value)
+
+    def test_decode_tx(self):
+        tx = decode_tx({
+            'txid': 'abc',
+            'vin': [{'valueSat': 1000}, {'addr': 'in1', 'valueSat': 5000}],
+            'vout': [
+                {'value': '0.00004000', 'scriptPubKey': {'addresses': ['out1']}},
+                {'value': '0.00000000', 'scriptPubKey': {'asm': 'OP_RETURN 00'}},
+            ],
+        })
+        self.assertEqual(tx.txid, 'abc')
+        self.assertEqual(tx.inputs, ((None, 1000), ('in1', 5000)))
+        self.assertEqual(tx.outputs, ((['out1'], 4000), ((), 0)))
+        self.assertEqual(tx.fee, 2000)
+
+
+class ChainCacheTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ChainCache(self.tmp.name, max_bytes=10 ** 6, min_confirmations=6)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.get(BTC, BLOCK, 'abc'))
+        self.cache.put(BTC, BLOCK, 'abc', {'hash': 'abc', 'confirmations': 10})
+        self.assertEqual(self.cache.get(BTC, BLOCK, 'abc'), {'hash': 'abc', 'confirmations': 10})
+        self.assertIsNone(self.cache.get(BCH, BLOCK, 'abc'))
+        self.assertIsNone(self.cache.get(BTC, TX, 'abc'))
+        self.assertTrue(self.cache.is_confirmed(6))
+        self.assertFalse(self.cache.is_confirmed(5))
+        self.assertFalse(self.cache.is_confirmed(None))
+
+    def test_evicts_least_recently_used(self):
+        import os
+        cache = self.cache
+        for i in range(4):
+            cache.put(BTC, TX, str(i), {'hex': os.urandom(500).hex()})
+            path = cache._path(BTC, TX, str(i))
+            os.utime(path, (i, i))
+        cache.max_bytes = cache.stats()['size_bytes'] + 10
+        cache.get(BTC, TX, '0')  # marks 0 as recently used
+        cache.put(BTC, TX, '4', {'hex': os.urandom(500).hex()})
+
+        self.assertGreater(cache.evictions, 0)
+        self.assertIsNotNone(cache.get(BTC, TX, '0'))
+        self.assertIsNone(cache.get(BTC, TX, '1'))
+        self.assertIsNotNone(cache.get(BTC, TX, '4'))
+
+    def test_disabled_without_directory(self):
+        cache = ChainCache(None, max_bytes=10 ** 6, min_confirmations=6)
+        cache.put(BTC, BLOCK, 'abc', {'hash': 'abc'})
+        self.assertIsNone(cache.get(BTC, BLOCK, 'abc'))
+
+    @mock.patch('common.services.coinquery.http')
+    def test_cached_blocks_leave_out_the_chain_position(self, mock_http):
+        from .services.coinquery import CoinQueryClient
+        client = CoinQueryClient(BTC, cache=self.cache)
+        mock_http.get.return_value.json_data = {'hash': 'abc', 'height': 1, 'confirmations': 10, 'nextblockhash': 'def'}
+
+        self.assertEqual(client.get_block_by_hash('abc')['nextblockhash'], 'def')
+        self.assertEqual(client.get_block_by_hash('abc'), {'hash': 'abc', 'height': 1})
+        self.assertEqual(mock_http.get.call_count, 1)
+
+        # a reorg moves the block off the main chain
+        mock_http.get.return_value.json_data = {'hash': 'abc', 'height': 1, 'confirmations': -1}
+        self.assertEqual(client.get_block_by_hash('abc', cached=False)['confirmations'], -1)
+        self.assertIsNone(client.get_next_block_hash('abc'))
+        self.assertEqual(mock_http.get.call_count, 3)
+
+
+class AsyncHttpTestCase(TestCase):
+    @mock.patch('common.utils.async_requests.httpclient.AsyncHTTPClient')
+    def test_connection_failures_are_retried(self, mock_client):
+        from io import BytesIO
+        from tornado.concurrent import Future
+        from tornado.httpclient import HTTPRequest, HTTPResponse
+        from .utils.async_requests import async_http, run_sync
+
+        def respond(request, raise_error=True):
+            future = Future()
+            if mock_client.return_value.fetch.call_count < 3:
+                future.set_result(HTTPResponse(request, 599, error=OSError('Connection reset by peer')))
+            else:
+                future.set_result(HTTPResponse(request, 200, headers={'Content-Type': 'application/json'},
+                                               buffer=BytesIO(b'{"txid": "abc"}')))
+            return future
+        mock_client.return_value.fetch.side_effect = respond
+
+        resp = run_sync(async_http.post('https://coinquery/tx/send', body={'rawtx': '00'}, retries=3))
+        self.assertEqual(resp.json_data, {'txid': 'abc'})
+        self.assertEqual(mock_client.return_value.fetch.call_count, 3)
+
+        mock_client.return_value.fetch.reset_mock()
+        with self.assertRaises(HTTPError) as raised:
+            run_sync(async_http.get('https://coinquery/status', retries=0))
+        self.assertEqual(raised.exception.status, 599)
+
+
+class AccountVersionsTestCase(TestCase):
+    @mock.patch('common.services.account_versions.redisClient')
+    def test_bump_waits_for_commit(self, mock_redis):
+        # every TestCase runs inside a transaction that is never committed
+        bump_account_versions([1])
+        mock_redis.pipeline.assert_not_called()
+
+    @mock.patch('common.services.account_versions.db_transaction.on_commit', side_effect=lambda callback: callback())
+    @mock.patch('common.services.account_versions.redisClient')
+    def test_bump_and_get(self, mock_redis, mock_on_commit):
+        bump_account_versions([3, 1, 3])
+        pipe = mock_redis.pipeline.return_value
+        self.assertListEqual([c[0][0] for c in pipe.incr.call_args_list],
+                             [ACCOUNT_VERSION_PREFIX + '1', ACCOUNT_VERSION_PREFIX + '3'])
+        pipe.execute.assert_called_once_with()
+
+        mock_redis.mget.return_value = ['2', None, '7', '100']
+        self.assertListEqual(get_versions([1, 3], chain=True), [2, 0, 7, 100])
+        mock_redis.mget.assert_called_once_with(
+            [ACCOUNT_VERSION_PREFIX + '1', ACCOUNT_VERSION_PREFIX + '3', CHAIN_VERSION, ETH_BLOCK_HEIGHT])
+
+        bump_account_versions([])
+        self.assertEqual(mock_on_commit.call_count, 1)
+
+
 class CreateUnsignedTransactionTestCase(TestCase):
     def test_create_unsigned_utxo_transaction_without_errors(self):
         utxos = [
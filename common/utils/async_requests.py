@@ -0,0 +1,117 @@
+"""
+Async counterpart of common/utils/requests.py
+
+One tornado AsyncHTTPClient per event loop (tornado keeps it per IOLoop) holds up to ASYNC_HTTP_MAX_CLIENTS requests
+in flight at once, so a single ASGI worker can wait on hundreds of upstream calls. Responses carry the same status,
+data, headers and json_data as the ones of Http, and error statuses raise the same HTTPError.
+
+Sync code that wants to fan out requests runs its coroutine with run_sync, on a loop thread shared by the process,
+instead of creating an event loop per call.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from urllib.parse import urlencode
+
+from tornado import httpclient
+
+from common.utils.requests import HTTPError
+
+logger = logging.getLogger('watchtower.common.utils.async_requests')
+
+ASYNC_HTTP_MAX_CLIENTS = int(os.environ.get('ASYNC_HTTP_MAX_CLIENTS') or '500')
+ASYNC_HTTP_TIMEOUT = float(os.environ.get('ASYNC_HTTP_TIMEOUT') or '60')  # seconds, per request
+
+httpclient.AsyncHTTPClient.configure(None, max_clients=ASYNC_HTTP_MAX_CLIENTS)
+
+
+class Response:
+    def __init__(self, status, data, headers):
+        self.status = status
+        self.data = data
+        self.headers = headers
+        self.json_data = None
+
+
+class AsyncHttp:
+    async def get(self, url, params={}, headers={}, retries=3, timeout=None):
+        return await self._request('GET', url, params=params, headers=headers, retries=retries, timeout=timeout)
+
+    async def post(self, url, params={}, headers={}, body=None, retries=3, timeout=None):
+        return await self._request('POST', url, params=params, headers=headers, body=body, retries=retries,
+                                   timeout=timeout)
+
+    async def _request(self, method, url, params={}, headers={}, body=None, retries=3, timeout=None):
+        payload = body
+        if payload and not isinstance(payload, str):
+            payload = json.dumps(payload)
+
+        if params:
+            url = '{}{}{}'.format(url, '&' if '?' in url else '?', urlencode(params))
+
+        request = httpclient.HTTPRequest(
+            url,
+            method=method,
+            headers=headers,
+            body=(payload or '') if method == 'POST' else None,
+            request_timeout=timeout or ASYNC_HTTP_TIMEOUT,
+        )
+
+        # only connection failures and timeouts are retried, same as urllib3.Retry. tornado 5 returns them as 599
+        # responses instead of raising when raise_error is off
+        attempt = 0
+        while True:
+            response = await httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+            if response.code != 599:
+                break
+            if attempt >= retries:
+                raise HTTPError(u'599 Connection Error: %s' % response.error, status=599)
+            attempt += 1
+            logger.debug('retrying %s %s (%s): %s', method, url, attempt, str(response.error))
+
+        result = Response(response.code, response.body or b'', response.headers)
+        content_type = response.headers.get('Content-Type')
+
+        # Check for http error
+        if result.status < 200 or result.status >= 400:
+            r_data = result.data.decode('utf-8').rstrip()
+
+            http_error_msg = ''
+            if 400 <= result.status < 500:
+                logger.warning(u'%d Client Error: %s for url: %s' % (result.status, r_data, url))
+                http_error_msg = u'%d Client Error: %s' % (result.status, r_data)
+            elif 500 <= result.status < 600:
+                logger.error(u'%d Server Error: %s for url: %s' % (result.status, r_data, url))
+                http_error_msg = u'%d Server Error: %s' % (result.status, r_data)
+
+            if http_error_msg:
+                raise HTTPError(http_error_msg, status=result.status)
+
+        # Decode json response
+        if isinstance(content_type, str) and content_type.startswith('application/json'):
+            result.json_data = json.loads(result.data.decode('utf-8'))
+
+        return result
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _shared_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='async-http', daemon=True).start()
+        return _loop
+
+
+def run_sync(coroutine, timeout=None):
+    """ Run coroutine on the shared loop thread and return its result, for sync callers """
+    return asyncio.run_coroutine_threadsafe(coroutine, _shared_loop()).result(timeout)
+
+
+async_http = AsyncHttp()
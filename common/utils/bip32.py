@@ -4,6 +4,7 @@ from bitcash.format import public_key_to_address as bch_public_key_to_address
 from bitcash.format import point_to_public_key
 from cashaddress import convert as convert_bch
 import hashlib
+from functools import lru_cache
 from common.utils.networks import SUPPORTED_NETWORKS, BTC, BCH, LTC, DASH, DOGE, DGB, ATOM, BNB, XRP, EOS, FIO, RUNE, \
     KAVA, SCRT, OSMO
 from common.services import eos_client
@@ -27,8 +28,14 @@ SUPPORTED_ADDR_KIND_CHOICES = [(n, n) for n in ADDR_KINDS]
 
 GAP_LIMIT = 20
 
+# With account based chains, we only track addresses, not xpubs,
+# so the thing stored as the xpub already is the address.
+ACCOUNT_BASED_NETWORKS = (ATOM, BNB, XRP, EOS, RUNE, SCRT, KAVA)
+
 CHANGE = 1
 
+NODE_CACHE_SIZE = 1024  # parsed chain nodes kept per process, two per xpub
+
 
 def pycoin_network_for_network(network):
     return {
@@ -101,12 +108,21 @@ def is_valid_bip32_xpub(xpub, network):
     return key.as_text() == xpub
 
 
+@lru_cache(maxsize=NODE_CACHE_SIZE)
+def _pycoin_chain_node(xpub, child_path):
+    # parsing the base58 xpub and walking to the chain node is done once per process instead of once per call
+    return btc_network.parse.bip32_pub(xpub).subkey_for_path(child_path)
+
+
+@lru_cache(maxsize=NODE_CACHE_SIZE)
+def _pywallet_chain_node(xpub, child_path, network):
+    return Wallet.deserialize(xpub, network).get_child_for_path('M/' + child_path)
+
+
 def derive_addresses(xpub, child_path, count, from_index=0, network=BTC, script_type='p2pkh'):
     assert network in SUPPORTED_NETWORKS
 
-    if network in (ATOM, BNB, XRP, EOS, RUNE, SCRT, KAVA):
-        # With account based chains, we only track addresses, not xpubs,
-        # so the thing stored here already is the address.
+    if network in ACCOUNT_BASED_NETWORKS:
         return [xpub]
 
     if script_type == 'p2sh-p2wpkh':
@@ -130,8 +146,7 @@ def derive_ethereum_address(xpub):
 
 def derive_segwit_native_addresses(xpub, child_path, count, from_index=0, network=BTC):
     net = pycoin_network_for_network(network)
-    account = btc_network.parse.bip32_pub(xpub)
-    node = account.subkey_for_path(child_path)
+    node = _pycoin_chain_node(xpub, child_path)
     children = node.children(
         max_level=(count - 1),
         start_index=from_index,
@@ -151,8 +166,7 @@ def derive_segwit_native_addresses(xpub, child_path, count, from_index=0, networ
 
 def derive_segwit_p2sh_p2wpkh_addresses(xpub, child_path, count, from_index=0, network=BTC):
     net = pycoin_network_for_network(network)
-    account = btc_network.parse.bip32_pub(xpub)
-    node = account.subkey_for_path(child_path)
+    node = _pycoin_chain_node(xpub, child_path)
     children = node.children(
         max_level=(count - 1),
         start_index=from_index,
@@ -178,8 +192,7 @@ def _hash160(data):
 
 def _derive_addresses_pycoin(xpub, child_path, count, from_index=0, network=BTC):
     net = pycoin_network_for_network(network)
-    account = btc_network.parse.bip32_pub(xpub)
-    node = account.subkey_for_path(child_path)
+    node = _pycoin_chain_node(xpub, child_path)
     children = node.children(
         max_level=(count - 1),
         start_index=from_index,
@@ -196,16 +209,17 @@ def _derive_addresses_pycoin(xpub, child_path, count, from_index=0, network=BTC)
 
 
 def _derive_addresses_pywallet(xpub, child_path, count, from_index=0, network=BTC):
-    wallet = Wallet.deserialize(xpub, network)
-    node = wallet.get_child_for_path('M/' + child_path)
+    node = _pywallet_chain_node(xpub, child_path, network)
 
     addresses = []
     for index in range(from_index, from_index + count):
-        address = node.get_child(index).to_address()
+        child = node.get_child(index)
 
         if network == BCH:
-            pubkey = point_to_public_key(node.get_child(index).public_key)
+            pubkey = point_to_public_key(child.public_key)
             address = convert_bch.to_legacy_address(bch_public_key_to_address(pubkey))
+        else:
+            address = child.to_address()
 
         addresses.append(address)
 
@@ -0,0 +1,261 @@
+"""
+Batched BIP32 public child derivation
+
+derive_range derives a run of consecutive children of one chain of an xpub and encodes their addresses in one pass.
+The xpub is decoded and the chain node derived once per process. For every child, IL * G is computed by looking up
+one precomputed multiple of G per byte of IL, so it costs 32 point additions instead of a full double-and-add, and
+all children of a range share a single modular inversion when they are converted back to affine coordinates.
+When coincurve (libsecp256k1) is installed, the tweak-add runs natively there instead, libsecp256k1 keeps its own
+precomputed tables for G.
+
+Output is identical to derive_addresses for the same arguments: address prefixes and bech32 hrps are read from the
+same pycoin networks the per-child functions use.
+"""
+import hashlib
+import hmac
+from functools import lru_cache
+
+from common.utils.bip32 import ACCOUNT_BASED_NETWORKS, NODE_CACHE_SIZE, pycoin_network_for_network, _hash160
+from common.utils.networks import BCH
+
+try:
+    from coincurve import PublicKey as _NativePublicKey
+except ImportError:  # pragma: no cover
+    _NativePublicKey = None
+
+# secp256k1
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+WINDOW_BITS = 8
+WINDOWS = 256 // WINDOW_BITS
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+
+# -- field and curve arithmetic, points in jacobian coordinates (X, Y, Z) with Z == 0 at infinity --
+
+def _double(point):
+    x, y, z = point
+    if not y or not z:
+        return (0, 1, 0)
+    yy = y * y % P
+    s = 4 * x * yy % P
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    return (x3, (m * (s - x3) - 8 * yy * yy) % P, 2 * y * z % P)
+
+
+def _add_affine(point, affine):
+    """ point + affine, where affine is an (x, y) pair """
+    x1, y1, z1 = point
+    x2, y2 = affine
+    if not z1:
+        return (x2, y2, 1)
+
+    zz = z1 * z1 % P
+    h = (x2 * zz - x1) % P
+    r = (y2 * zz * z1 - y1) % P
+    if not h:
+        return _double(point) if not r else (0, 1, 0)
+
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    return (x3, (r * (v - x3) - y1 * hhh) % P, z1 * h % P)
+
+
+def _to_affine(points):
+    """ Convert jacobian points to (x, y) with one inversion for the whole batch (Montgomery's trick) """
+    prefix = []
+    acc = 1
+    for _, _, z in points:
+        if not z:
+            raise ValueError('point at infinity')
+        prefix.append(acc)
+        acc = acc * z % P
+
+    inverse = pow(acc, P - 2, P)
+    affine = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        x, y, z = points[i]
+        z_inverse = inverse * prefix[i] % P
+        inverse = inverse * z % P
+        zz = z_inverse * z_inverse % P
+        affine[i] = (x * zz % P, y * zz * z_inverse % P)
+    return affine
+
+
+@lru_cache(maxsize=1)
+def _generator_table():
+    """ table[w][d - 1] = d * 2^(8w) * G for every window w and non-zero byte d, built once per process """
+    rows = []
+    base = G
+    for _ in range(WINDOWS):
+        row = [(base[0], base[1], 1)]
+        for _ in range(2 ** WINDOW_BITS - 2):
+            row.append(_add_affine(row[-1], base))
+        rows.append(row)
+
+        next_base = (base[0], base[1], 1)
+        for _ in range(WINDOW_BITS):
+            next_base = _double(next_base)
+        base = _to_affine([next_base])[0]
+
+    flat = _to_affine([point for row in rows for point in row])
+    width = 2 ** WINDOW_BITS - 1
+    return [flat[w * width:(w + 1) * width] for w in range(WINDOWS)]
+
+
+def _multiply_generator(k):
+    table = _generator_table()
+    point = (0, 1, 0)
+    for window in range(WINDOWS):
+        digit = (k >> (window * WINDOW_BITS)) & 0xff
+        if digit:
+            point = _add_affine(point, table[window][digit - 1])
+    return point
+
+
+def _sec(affine):
+    x, y = affine
+    return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+
+
+def _point_from_sec(sec):
+    x = int.from_bytes(sec[1:], 'big')
+    y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+    if (y & 1) != (sec[0] & 1):
+        y = P - y
+    return (x, y)
+
+
+# -- BIP32 --
+
+def _tweaks(chain_code, sec, start, count):
+    for index in range(start, start + count):
+        digest = hmac.new(chain_code, sec + index.to_bytes(4, 'big'), hashlib.sha512).digest()
+        tweak = int.from_bytes(digest[:32], 'big')
+        if tweak >= N:
+            raise ValueError('invalid child at index {}'.format(index))
+        yield digest[:32], digest[32:]
+
+
+def _child_secs(chain_code, sec, start, count):
+    """ Compressed public keys of children start to start + count - 1 of the node (chain_code, sec) """
+    if _NativePublicKey is not None:
+        parent = _NativePublicKey(sec)
+        return [parent.add(tweak).format(compressed=True) for tweak, _ in _tweaks(chain_code, sec, start, count)]
+
+    parent = _point_from_sec(sec)
+    points = [
+        _add_affine(_multiply_generator(int.from_bytes(tweak, 'big')), parent)
+        for tweak, _ in _tweaks(chain_code, sec, start, count)
+    ]
+    return [_sec(affine) for affine in _to_affine(points)]
+
+
+def _b58decode_check(text):
+    number = 0
+    for char in text:
+        number = number * 58 + B58_ALPHABET.index(char)
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    data = b'\0' * (len(text) - len(text.lstrip('1'))) + data
+    payload, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise ValueError('invalid base58 checksum')
+    return payload
+
+
+def _b58encode_check(payload):
+    data = payload + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    number = int.from_bytes(data, 'big')
+    chars = []
+    while number:
+        number, remainder = divmod(number, 58)
+        chars.append(B58_ALPHABET[remainder])
+    return '1' * (len(data) - len(data.lstrip(b'\0'))) + ''.join(reversed(chars))
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            checksum ^= generator[i] if ((top >> i) & 1) else 0
+    return checksum
+
+
+def _bech32_encode_witness_v0(hrp, program):
+    data = [0]
+    acc = bits = 0
+    for byte in program:
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+
+    expanded_hrp = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    polymod = _bech32_polymod(expanded_hrp + data + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+@lru_cache(maxsize=NODE_CACHE_SIZE)
+def _chain_node(xpub, chain):
+    data = _b58decode_check(xpub)
+    if len(data) != 78:
+        raise ValueError('invalid xpub')
+    chain_code, sec = data[13:45], data[45:]
+    (tweak, child_chain_code), = _tweaks(chain_code, sec, chain, 1)
+    return child_chain_code, _child_secs(chain_code, sec, chain, 1)[0]
+
+
+@lru_cache(maxsize=None)
+def _address_format(network, script_type):
+    """ ('base58', prefix) or ('bech32', hrp), read from the pycoin network derive_addresses would use """
+    if network == BCH and script_type not in ('p2sh-p2wpkh', 'p2wpkh'):
+        # derive_addresses goes through pywallet and bitcash for these, which end in a legacy p2pkh address
+        return 'base58', b'\x00'
+
+    net = pycoin_network_for_network(network)
+    blank = bytes(20)
+    if script_type == 'p2wpkh':
+        address = net.address.for_script(net.contract.for_p2pkh_wit(blank))
+        return 'bech32', address[:address.rindex('1')]
+    if script_type == 'p2sh-p2wpkh':
+        address = net.address.for_script(net.contract.for_p2s(net.contract.for_p2pkh_wit(blank)))
+    else:
+        address = net.address.for_script(net.contract.for_p2pkh(blank))
+    return 'base58', _b58decode_check(address)[:-20]
+
+
+def _encode_addresses(secs, network, script_type):
+    encoding, prefix = _address_format(network, script_type)
+    hashes = [_hash160(sec) for sec in secs]
+
+    if encoding == 'bech32':
+        return [_bech32_encode_witness_v0(prefix, h) for h in hashes]
+    if script_type == 'p2sh-p2wpkh':
+        hashes = [_hash160(b'\x00\x14' + h) for h in hashes]
+    return [_b58encode_check(prefix + h) for h in hashes]
+
+
+def derive_range(xpub, chain, start, count, script_type='p2pkh', network='BTC'):
+    """ Addresses of children start to start + count - 1 on chain (0 external, 1 change) of xpub """
+    if network in ACCOUNT_BASED_NETWORKS:
+        return [xpub]
+    if count <= 0:
+        return []
+
+    chain_code, sec = _chain_node(xpub, int(chain))
+    return _encode_addresses(_child_secs(chain_code, sec, start, count), network, script_type)
@@ -7,7 +7,9 @@ logger = logging.getLogger('watchtower.common.utils.requests')
 
 class HTTPError(Exception):
     """An error status was returned from the http request"""
-    pass
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
 
 class RequestsUtil:
     def get_multiple(self, urls):
@@ -30,18 +32,19 @@ class Http:
     def __init__(self):
         self.http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
 
-    def get(self, url, params={}, headers={}, retries=urllib3.Retry(3)):
-        return self._request('GET', url, params=params, headers=headers, retries=retries)
+    def get(self, url, params={}, headers={}, retries=urllib3.Retry(3), timeout=None):
+        return self._request('GET', url, params=params, headers=headers, retries=retries, timeout=timeout)
 
     def post(self, url, params={}, headers={}, body=None, retries=urllib3.Retry(3)):
         return self._request('POST', url, params=params, headers=headers, body=body, retries=retries)
 
-    def _request(self, method, url, params={}, headers={}, body=None, retries=urllib3.Retry(3)):
+    def _request(self, method, url, params={}, headers={}, body=None, retries=urllib3.Retry(3), timeout=None):
         payload = body
         if payload and not isinstance(payload, str):
             payload = json.dumps(payload)
 
-        response = self.http.request(method, url, fields=params, body=payload, retries=retries, headers=headers)
+        response = self.http.request(method, url, fields=params, body=payload, retries=retries, headers=headers,
+                                     timeout=timeout)
         content_type = response.headers.get('Content-Type')
 
         # Check for http error
@@ -57,7 +60,7 @@ class Http:
                 http_error_msg = u'%d Server Error: %s' % (response.status, r_data)
 
             if http_error_msg:
-                raise HTTPError(http_error_msg)
+                raise HTTPError(http_error_msg, status=response.status)
 
         # Decode json response
         if isinstance(content_type, str) and content_type.startswith('application/json'):
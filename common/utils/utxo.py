@@ -0,0 +1,105 @@
+"""
+Compact decoding of Insight-style utxo transactions
+
+Block ingestion and xpub syncing only need the txid and, for each input and output, the addresses and satoshi
+value of an Insight tx. decode_tx pulls those out once into a small slotted record of flat tuples, with output
+values parsed exactly from their decimal strings into integer satoshis.
+"""
+from decimal import Decimal
+
+SATOSHI_DECIMALS = 8
+SATOSHIS_PER_COIN = 10 ** SATOSHI_DECIMALS
+
+
+def _decimal_to_satoshis(value):
+    return int(Decimal(value).quantize(Decimal(10) ** -SATOSHI_DECIMALS) * SATOSHIS_PER_COIN)
+
+
+def parse_satoshis(value):
+    """ Convert a coin amount (decimal string or number) to integer satoshis
+
+        Matches int(Decimal(value).quantize(Decimal(10) ** -8) * (10 ** 8)), including round half even past the
+        8th decimal, without building Decimals for the plain 'whole.fraction' strings Insight returns.
+    """
+    if not isinstance(value, str):
+        return _decimal_to_satoshis(value)
+
+    whole, dot, fraction = value.partition('.')
+    if len(fraction) == SATOSHI_DECIMALS and whole.isdigit() and fraction.isdigit():
+        # insight always sends exactly 8 decimals
+        return int(whole + fraction)
+
+    if not (whole.isdigit() or (dot and whole == '')) or (fraction and not fraction.isdigit()):
+        # signs, exponents, whitespace etc. are rare enough to leave to Decimal
+        return _decimal_to_satoshis(value)
+
+    satoshis = int(whole or '0') * SATOSHIS_PER_COIN
+    if len(fraction) <= SATOSHI_DECIMALS:
+        return satoshis + int(fraction.ljust(SATOSHI_DECIMALS, '0') or '0')
+
+    satoshis += int(fraction[:SATOSHI_DECIMALS])
+    remainder = fraction[SATOSHI_DECIMALS:]
+    half = '5'.ljust(len(remainder), '0')
+    if remainder > half or (remainder == half and satoshis % 2):
+        satoshis += 1
+    return satoshis
+
+
+class DecodedTx:
+    """ txid plus flat tuples of inputs as (address, satoshis) and outputs as (addresses, satoshis) """
+    __slots__ = ('txid', 'inputs', 'outputs')
+
+    def __init__(self, txid, inputs, outputs):
+        self.txid = txid
+        self.inputs = inputs
+        self.outputs = outputs
+
+    @property
+    def fee(self):
+        return sum(satoshis for _, satoshis in self.inputs) - sum(satoshis for _, satoshis in self.outputs)
+
+
+def decode_tx(tx):
+    """ Decode an Insight tx dict into a DecodedTx, coinbase inputs are kept with an address of None """
+    inputs = tuple([(tx_in.get('addr'), tx_in.get('valueSat', 0)) for tx_in in tx.get('vin') or ()])
+    outputs = tuple([
+        (tx_out['scriptPubKey'].get('addresses', ()), parse_satoshis(tx_out.get('value', 0)))
+        for tx_out in tx.get('vout') or ()
+    ])
+    return DecodedTx(tx.get('txid'), inputs, outputs)
+
+
+def decode_txs(txs):
+    return [tx if isinstance(tx, DecodedTx) else decode_tx(tx) for tx in txs]
+
+
+def map_txs_by_address(txs, txs_by_address=None, filter_addresses=None):
+    """ Net satoshi change per txid for each address in txs, optionally limited to filter_addresses
+
+        txs can be raw insight txs or already decoded ones, results are merged into txs_by_address if given
+    """
+    if txs_by_address is None:
+        txs_by_address = {}
+    filter_addresses = set(filter_addresses) if filter_addresses else None
+
+    for tx in decode_txs(txs):
+        txid = tx.txid
+
+        for address, satoshis in tx.inputs:
+            if not address:  # skip coinbase inputs
+                continue
+            if filter_addresses is not None and address not in filter_addresses:
+                continue
+
+            address_txs = txs_by_address.setdefault(address, {})
+            address_txs[txid] = address_txs.get(txid, 0) - satoshis
+
+        for addresses, satoshis in tx.outputs:
+            for address in addresses:
+                if filter_addresses is not None and address not in filter_addresses:
+                    continue
+
+                address_txs = txs_by_address.setdefault(address, {})
+                address_txs[txid] = address_txs.get(txid, 0) + satoshis
+
+    return txs_by_address
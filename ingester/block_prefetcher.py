@@ -0,0 +1,78 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('watchtower.ingester.block_prefetcher')
+
+PUT_TIMEOUT = 1  # seconds, how often a blocked producer checks whether the consumer went away
+
+
+class BlockPrefetcher:
+    """ Walk a CoinQuery chain from start_hash, fetching up to depth blocks ahead of the consumer
+
+        A producer thread follows nextblockhash one block at a time and submits each block's transaction pages to
+        a pool of depth workers. Blocks are yielded strictly in chain order as (block_hash, block, txs). The queue
+        between the producer and the consumer holds at most depth blocks, so a slow consumer stalls the producer.
+
+        Only upstream requests run off the consumer's thread, all db writes stay with the consumer.
+    """
+    _DONE = object()
+
+    def __init__(self, coinquery, start_hash, depth):
+        self.coinquery = coinquery
+        self.start_hash = start_hash
+        self.depth = max(int(depth), 1)
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.depth)
+        self._thread = threading.Thread(target=self._walk, name='block-prefetcher-{}'.format(coinquery.network))
+        self._thread.daemon = True
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _walk(self):
+        block_hash = self.start_hash
+        try:
+            while block_hash and not self._stop.is_set():
+                # the walk follows nextblockhash, which the cached copy of a block does not have
+                block = self.coinquery.get_block_by_hash(block_hash, cached=False)
+                txs = self._executor.submit(self.coinquery.get_transactions_by_block_hash, block_hash)
+                if not self._put((block_hash, block, txs)):
+                    return
+                block_hash = block.get('nextblockhash')
+        except Exception as e:
+            if self._stop.is_set():
+                # the consumer went away and shut down the pool underneath us
+                return
+            logger.error('failed to prefetch %s block %s: %s', self.coinquery.network, block_hash, str(e))
+            self._put(e)
+            return
+
+        self._put(self._DONE)
+
+    def close(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                block_hash, block, txs = item
+                yield block_hash, block, txs.result()
+        finally:
+            self.close()
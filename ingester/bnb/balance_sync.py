@@ -2,6 +2,7 @@ from celery import task
 from celery_once import QueueOnce
 
 from tracker.models import AccountBalance, Address
+from common.services.account_versions import bump_account_versions
 from common.services import binance_client
 from common.utils.networks import BNB
 from common.utils.utils import current_time_millis
@@ -30,6 +31,7 @@ def sync_bnb_account_balances(address):
             'balance': balance
         }
     )
+    bump_account_versions([account.id])
 
     logger.info('synced bnb balances for %s, balance = %s in %sms',
                 address, balance, (current_time_millis() - start))
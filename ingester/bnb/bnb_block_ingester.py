@@ -9,6 +9,8 @@ from time import sleep
 from dateutil import parser
 
 from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock
+from common.services.account_versions import bump_account_versions
+from tracker.address_filter import get_tracked_addresses
 from common.utils.networks import BNB
 from common.utils.utils import timestamp_to_unix
 from common.services import binance_client
@@ -175,10 +177,7 @@ class BinanceBlockIngester:
     def _get_registered_addresses_from_txs(self, txs):
         # all addresses found in tx block
         tx_addresses = list(set(itertools.chain(*[(tx['from'], tx['to']) for tx in txs])))
-        registered_addresses = Address.objects \
-            .select_related('account') \
-            .filter(address__in=tx_addresses, account__network=BNB) \
-            .values_list('address', flat=True)
+        registered_addresses = set(get_tracked_addresses(BNB, tx_addresses))
         return registered_addresses
 
     def _filter_txs_by_registered_address(self, txs):
@@ -286,6 +285,9 @@ class BinanceBlockIngester:
 
                 rabbit_transactions.append(msg)
 
+        bump_account_versions(
+            Address.objects.filter(address__in=list(tx_by_address)).values_list('account_id', flat=True))
+
         # publish to rabbit
         for msg in rabbit_transactions:
             RabbitConnection().publish(exchange=EXCHANGE_TXS, routing_key='', message_type='event.platform.transaction', body=json.dumps(msg))
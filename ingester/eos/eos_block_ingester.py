@@ -4,6 +4,7 @@ import itertools
 import logging
 
 from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock
+from common.services.account_versions import bump_account_versions
 from common.utils.networks import EOS
 from common.utils.utils import timestamp_to_unix
 from common.services import eos_client
@@ -195,6 +196,9 @@ class EOSBlockIngester:
                     rabbit_transactions.append(msg)
                     logger.info('EOS ingested tx: {}'.format(tx.get('txid')))
 
+        bump_account_versions(
+            Address.objects.filter(address__in=list(tx_by_address)).values_list('account_id', flat=True))
+
         # publish to rabbit
         for msg in rabbit_transactions:
             RabbitConnection().publish(exchange=EXCHANGE_TXS, routing_key='', message_type='event.platform.transaction', body=json.dumps(msg))
@@ -0,0 +1,101 @@
+"""
+Coalesced balance refreshes for the ETH block ingester
+
+Saving a block used to queue a balance sync per saved row, so one busy address fanned out into dozens of tasks
+fetching the same balance. The rows of a block are collected as (address, asset) pairs instead, asset being ETH or a
+token contract, and every pair is refreshed at most twice per BALANCE_REFRESH_DEBOUNCE seconds across all ingesters:
+
+- the first change of a window is refreshed right away
+- any later change in the window schedules one trailing refresh for when the window ends, so the last change is
+  never left out
+
+Every sync a saved row asks for that is not queued counts as suppressed, see get_refresh_counts.
+"""
+import logging
+import os
+
+from common.services.launchdarkly import is_feature_enabled, COALESCED_BALANCE_REFRESH
+from common.services.redis import redisClient, BALANCE_REFRESH_PREFIX, BALANCE_REFRESHES_SCHEDULED, \
+    BALANCE_REFRESHES_SUPPRESSED
+from common.utils.networks import ETH
+from ingester.eth.balance_sync import sync_eth_account_balances, sync_eth_token_balance
+
+logger = logging.getLogger('watchtower.ingester.eth.balance_refresh')
+
+BALANCE_REFRESH_DEBOUNCE = int(os.environ.get('BALANCE_REFRESH_DEBOUNCE') or '30')  # seconds
+
+
+class BalanceRefreshes:
+    def __init__(self):
+        self.touched = 0
+        self.pairs = dict()  # (address, ETH or contract_address): task signature
+
+    def add(self, account_id, address, token=None):
+        """ Refresh the eth balance of address, and its balance of token when given """
+        self.touched += 1
+        self.pairs.setdefault((address, ETH), sync_eth_account_balances.s(address, False))
+        if token is not None:
+            self.touched += 1
+            self.pairs.setdefault(
+                (address, token.contract_address),
+                sync_eth_token_balance.s(account_id, address, token.symbol, token.contract_address)
+            )
+
+    @staticmethod
+    def _acquire(keys):
+        """ Take the keys that are free for the next BALANCE_REFRESH_DEBOUNCE seconds, True for each one taken """
+        pipe = redisClient.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, 1, nx=True, ex=BALANCE_REFRESH_DEBOUNCE)
+        return [bool(acquired) for acquired in pipe.execute()]
+
+    def schedule(self):
+        """ Queue the refreshes of the collected pairs, returns the number of queued tasks """
+        if not is_feature_enabled(COALESCED_BALANCE_REFRESH):
+            # the pairs of a block are still deduplicated
+            for signature in self.pairs.values():
+                signature.apply_async()
+            return self._count(len(self.pairs))
+
+        pairs = list(self.pairs.items())
+        keys = [BALANCE_REFRESH_PREFIX + '{}:{}'.format(address, asset) for (address, asset), _ in pairs]
+        try:
+            leading = self._acquire(keys)
+            waiting = [i for i, acquired in enumerate(leading) if not acquired]
+            trailing = dict(zip(waiting, self._acquire([keys[i] + ':trailing' for i in waiting])))
+        except Exception as e:
+            logger.error('failed to debounce balance refreshes, queueing all of them: %s', str(e))
+            leading, trailing = [True] * len(pairs), {}
+
+        scheduled = 0
+        for i, (_, signature) in enumerate(pairs):
+            if leading[i]:
+                signature.apply_async()
+                scheduled += 1
+            elif trailing.get(i):
+                signature.apply_async(countdown=BALANCE_REFRESH_DEBOUNCE)
+                scheduled += 1
+        return self._count(scheduled)
+
+    def _count(self, scheduled):
+        """ Add the queued refreshes and the syncs the saved rows asked for that were not queued to the counters """
+        suppressed = self.touched - scheduled
+        try:
+            pipe = redisClient.pipeline(transaction=False)
+            pipe.incrby(BALANCE_REFRESHES_SCHEDULED, scheduled)
+            pipe.incrby(BALANCE_REFRESHES_SUPPRESSED, suppressed)
+            pipe.execute()
+        except Exception as e:
+            logger.error('failed to count balance refreshes: %s', str(e))
+
+        logger.debug('queued %s balance refreshes, suppressed %s', scheduled, suppressed)
+        return scheduled
+
+
+def get_refresh_counts():
+    """ Balance refreshes queued and suppressed by all ingesters since the counters were created """
+    scheduled, suppressed = redisClient.mget([BALANCE_REFRESHES_SCHEDULED, BALANCE_REFRESHES_SUPPRESSED])
+    return {
+        'scheduled': int(scheduled or 0),
+        'suppressed': int(suppressed or 0),
+    }
@@ -3,6 +3,7 @@ from celery import task
 from celery_once import QueueOnce
 
 from tracker.models import AccountBalance, Address, ERC20Token
+from common.services.account_versions import bump_account_versions
 
 from common.utils.networks import ETH
 from common.utils.requests import http
@@ -43,6 +44,7 @@ def sync_eth_account_balances(address, include_tokens=True):
         )
 
         logger.debug('created (ETH) = %s, account_balance = %s', ab_created, balance)
+        bump_account_versions([account.id])
     except Exception as e:
         logger.error('failed to GET ETH balance from %s: %s', os.getenv('COINQUERY_ETH_URL'), str(e))
 
@@ -96,3 +98,5 @@ def sync_eth_token_balance(account_id, address, symbol, contract_address):
             balance_type='R'
         ).update(balance=0)
         logger.debug('%s: update count = %s, account_balance = %s', address, update_count, balance)
+
+    bump_account_versions([account_id])
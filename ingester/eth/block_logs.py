@@ -0,0 +1,63 @@
+"""
+One eth_getLogs call for all the events the eth ingester decodes
+
+The topics of the erc20, bitgo multisig, weth and thor decoders are OR'ed into one filter, and each decoder is handed
+the logs of its own topic in the order the node returned them, so it sees exactly what its own getLogs call used to
+return. During catch-up, blocks deep enough below the chain head not to be reorganized are fetched a range at a time.
+"""
+import logging
+import os
+
+from common.services import cointainer_web3 as web3
+
+logger = logging.getLogger('watchtower.ingester.eth.block_logs')
+
+ETH_LOGS_RANGE = int(os.environ.get('ETH_LOGS_RANGE') or '20')  # blocks per getLogs call during catch-up
+ETH_LOGS_RANGE_CONFIRMATIONS = int(os.environ.get('ETH_LOGS_RANGE_CONFIRMATIONS') or '12')
+
+
+class BlockLogs:
+    def __init__(self, topics):
+        """ topics: {topic: number of topics of its filter}, a log only matched a filter with at most as many topics
+            as it has, e.g. [transfer_topic, None, None] skipped transfer events that index fewer arguments
+        """
+        self.topics = topics
+        self.prefetched = {}  # height: (hash of the block the logs are from, None without logs, {topic: [log]})
+
+    def _fetch(self, from_height, to_height):
+        logs = web3.eth.getLogs({
+            'fromBlock': from_height,
+            'toBlock': to_height,
+            'topics': [list(self.topics)]
+        })
+
+        fetched = {height: [None, {topic: [] for topic in self.topics}] for height in range(from_height, to_height + 1)}
+        for log in logs:
+            topics = log.get('topics')
+            topic = web3.toHex(topics[0]).lower() if topics else None
+            if topic not in self.topics or len(topics) < self.topics[topic]:
+                continue
+
+            entry = fetched[log.get('blockNumber')]
+            entry[0] = web3.toHex(log.get('blockHash'))
+            entry[1][topic].append(log)
+
+        logger.debug('fetched %s logs of blocks %s to %s', len(logs), from_height, to_height)
+        return fetched
+
+    def for_block(self, block, head=None):
+        """ {topic: [log]} of block, blocks ETH_LOGS_RANGE_CONFIRMATIONS below head are fetched ETH_LOGS_RANGE at once """
+        height = block.get('number')
+        block_hash = web3.toHex(block.get('hash'))
+
+        if height not in self.prefetched and head is not None and height + ETH_LOGS_RANGE_CONFIRMATIONS <= head:
+            self.prefetched = self._fetch(height, min(height + ETH_LOGS_RANGE, head - ETH_LOGS_RANGE_CONFIRMATIONS + 1) - 1)
+
+        prefetched = self.prefetched.pop(height, None)
+        if prefetched is not None and prefetched[0] in (None, block_hash):
+            return prefetched[1]
+
+        if prefetched is not None:
+            logger.info('logs prefetched for block %s are from %s, fetching them again', block_hash, prefetched[0])
+
+        return self._fetch(height, height)[height][1]
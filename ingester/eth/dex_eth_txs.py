@@ -15,14 +15,9 @@ k = sha3.keccak_256()
 k.update('Deposit(address,uint256)'.encode('utf-8'))
 weth_deposit_topic = '0x' + k.hexdigest()
 
-def get_dex_eth_deposits(block):
+def get_dex_eth_deposits(block, logs):
     block_hash = web3.toHex(block.get('hash'))
     block_height = block.get('number')
-    logs = web3.eth.getLogs({
-        'fromBlock': block_height,
-        'toBlock': block_height,
-        'topics': [weth_deposit_topic]
-    })
 
     if len(logs) < 1:
         logger.info('No logs of type weth deposit found for block %s %s', block_height, block_hash)
@@ -61,14 +56,9 @@ def get_dex_eth_deposits(block):
 
     return weth_deposit_transactions
 
-def get_dex_eth_withdrawals(block):
+def get_dex_eth_withdrawals(block, logs):
     block_hash = web3.toHex(block.get('hash'))
     block_height = block.get('number')
-    logs = web3.eth.getLogs({
-        'fromBlock': block_height,
-        'toBlock': block_height,
-        'topics': [weth_withdrawal_topic]
-    })
 
     if len(logs) < 1:
         logger.info('No logs of type weth withdrawal found for block %s %s', block_height, block_hash)
@@ -106,9 +96,12 @@ def get_dex_eth_withdrawals(block):
 
     return weth_withdrawal_transactions
 
-def get_dex_eth_txs(block):
-    withdrawals = get_dex_eth_withdrawals(block)
-    deposits = get_dex_eth_deposits(block)
+# topics of the logs get_dex_eth_txs decodes, see ingester/eth/block_logs.py
+LOG_TOPICS = {weth_withdrawal_topic: 1, weth_deposit_topic: 1}
+
+def get_dex_eth_txs(block, block_logs):
+    withdrawals = get_dex_eth_withdrawals(block, block_logs[weth_withdrawal_topic])
+    deposits = get_dex_eth_deposits(block, block_logs[weth_deposit_topic])
     all = withdrawals.copy()
     all.update(deposits)
     return all
@@ -0,0 +1,173 @@
+"""
+ERC20 token metadata for ETH ingestion, without contract calls inside block processing
+
+Token metadata (id, symbol, name, precision) is looked up in an in-process LRU, then in redis, then in postgres, so
+a token seen in a block is normally answered without a query. The metadata of contracts that are not ERC20Tokens yet
+is read with one batched JSON-RPC request of eth_calls per block, bounded by ERC20_TOKEN_RESOLVE_TIMEOUT. Contracts
+that time out or answer anything undecodable are handed to resolve_erc20_token, which creates the token in the
+background and attaches it to the transactions that were saved without it.
+
+Token rows rarely change. Saving one drops its redis entry, other processes pick the change up once their own entry
+is older than ERC20_TOKEN_CACHE_TTL.
+"""
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from celery import task
+from celery_once import QueueOnce
+from lru import LRU
+
+from common.services import ethereum_json_rpc
+from common.services.account_versions import bump_account_versions
+from common.services.redis import redisClient, ERC20_TOKEN_PREFIX
+from ingester.eth.balance_sync import sync_eth_token_balance
+from tracker.models import BalanceChange, ERC20Token, Transaction
+
+logger = logging.getLogger('watchtower.ingester.eth.erc20_tokens')
+
+ERC20_TOKEN_CACHE_SIZE = int(os.environ.get('ERC20_TOKEN_CACHE_SIZE') or '10000')
+ERC20_TOKEN_CACHE_TTL = int(os.environ.get('ERC20_TOKEN_CACHE_TTL') or 60 * 60)  # seconds, in-process entries
+ERC20_TOKEN_REDIS_TTL = int(os.environ.get('ERC20_TOKEN_REDIS_TTL') or 60 * 60 * 24)  # seconds
+ERC20_TOKEN_RESOLVE_TIMEOUT = float(os.environ.get('ERC20_TOKEN_RESOLVE_TIMEOUT') or '5')  # seconds, per block
+
+# selectors of name(), symbol() and decimals()
+NAME_SELECTOR = '0x06fdde03'
+SYMBOL_SELECTOR = '0x95d89b41'
+DECIMALS_SELECTOR = '0x313ce567'
+
+TokenMetadata = namedtuple('TokenMetadata', ['id', 'contract_address', 'name', 'symbol', 'precision'])
+
+
+def _metadata(token):
+    return TokenMetadata(token.id, token.contract_address, token.name, token.symbol, token.precision)
+
+
+def _decode_string(result):
+    """ abi encoded string, or the bytes32 some early tokens (MKR) return instead """
+    data = bytes.fromhex(result[2:])
+    if len(data) == 32:
+        return data.rstrip(b'\x00').decode('utf-8')
+
+    offset = int.from_bytes(data[:32], 'big')
+    length = int.from_bytes(data[offset:offset + 32], 'big')
+    value = data[offset + 32:offset + 32 + length]
+    if len(value) != length:
+        raise ValueError('truncated string {}'.format(result))
+    return value.decode('utf-8')
+
+
+def _decode_uint(result):
+    if len(result) <= 2:
+        raise ValueError('empty result')
+    return int(result, 16)
+
+
+class TokenCache:
+    def __init__(self, size=ERC20_TOKEN_CACHE_SIZE):
+        self.tokens = LRU(size)  # contract_address: (TokenMetadata, cached_at)
+
+    def _remember(self, token, share=True):
+        self.tokens[token.contract_address] = (token, time.time())
+        if share:
+            redisClient.setex(ERC20_TOKEN_PREFIX + token.contract_address, ERC20_TOKEN_REDIS_TTL,
+                              json.dumps(token._asdict()))
+
+    def forget(self, contract_address):
+        self.tokens.pop(contract_address.lower(), None)
+        redisClient.delete(ERC20_TOKEN_PREFIX + contract_address.lower())
+
+    def get_many(self, contract_addresses):
+        """ {contract_address: TokenMetadata} of the contract_addresses that are ERC20Tokens """
+        tokens = {}
+        missing = []
+        for contract_address in dict.fromkeys(address.lower() for address in contract_addresses):
+            entry = self.tokens.get(contract_address)
+            if entry is not None and time.time() - entry[1] <= ERC20_TOKEN_CACHE_TTL:
+                tokens[contract_address] = entry[0]
+            else:
+                missing.append(contract_address)
+
+        if missing:
+            for contract_address, cached in zip(missing, redisClient.mget([ERC20_TOKEN_PREFIX + c for c in missing])):
+                if cached is not None:
+                    tokens[contract_address] = TokenMetadata(**json.loads(cached))
+                    self._remember(tokens[contract_address], share=False)
+            missing = [contract_address for contract_address in missing if contract_address not in tokens]
+
+        if missing:
+            for token in ERC20Token.objects.filter(contract_address__in=missing):
+                tokens[token.contract_address] = _metadata(token)
+                self._remember(tokens[token.contract_address])
+
+        return tokens
+
+    def resolve(self, contract_addresses):
+        """ get_many, creating the tokens of unknown contracts from one batched request
+
+            Returns the tokens and the contract addresses that could not be resolved in time, see resolve_erc20_token
+        """
+        tokens = self.get_many(contract_addresses)
+        unknown = [contract_address for contract_address in dict.fromkeys(c.lower() for c in contract_addresses)
+                   if contract_address not in tokens]
+        if not unknown:
+            return tokens, []
+
+        try:
+            calls = [
+                ('eth_call', [{'to': contract_address, 'data': selector}, 'latest'])
+                for contract_address in unknown for selector in (NAME_SELECTOR, SYMBOL_SELECTOR, DECIMALS_SELECTOR)
+            ]
+            responses = ethereum_json_rpc.batch(calls, timeout=ERC20_TOKEN_RESOLVE_TIMEOUT)
+        except Exception as e:
+            logger.warning('failed to read the metadata of erc20 contracts %s: %s', unknown, str(e))
+            return tokens, unknown
+
+        unresolved = []
+        for i, contract_address in enumerate(unknown):
+            name, symbol, decimals = responses[i * 3:i * 3 + 3]
+            try:
+                token, created = ERC20Token.objects.get_or_create(contract_address=contract_address, defaults={
+                    'name': _decode_string(name['result']),
+                    'symbol': _decode_string(symbol['result']),
+                    'precision': _decode_uint(decimals['result']),
+                })
+            except Exception as e:
+                logger.warning('failed to read the metadata of erc20 contract %s: %s', contract_address, str(e))
+                unresolved.append(contract_address)
+                continue
+
+            if created:
+                logger.info('saved new ERC20Token with contract address %s', contract_address)
+            tokens[contract_address] = _metadata(token)
+            self._remember(tokens[contract_address])
+
+        return tokens, unresolved
+
+
+token_cache = TokenCache()
+
+
+@task(base=QueueOnce, once={'graceful': True})
+def resolve_erc20_token(contract_address, transaction_ids):
+    """ Create the token of contract_address and attach it to the transactions that were saved without it """
+    try:
+        token = ERC20Token.get_or_create(contract_address)
+    except Exception:
+        logger.exception('error obtaining details for erc20 contract %s', contract_address)
+        return
+
+    token_cache.forget(contract_address)
+
+    Transaction.objects.filter(id__in=transaction_ids, erc20_token__isnull=True).update(erc20_token=token)
+    balance_changes = BalanceChange.objects.filter(transaction_id__in=transaction_ids).select_related('address')
+    for balance_change in balance_changes:
+        sync_eth_token_balance.s(
+            balance_change.account_id,
+            balance_change.address.address,
+            token.symbol,
+            token.contract_address
+        ).apply_async()
+    bump_account_versions({balance_change.account_id for balance_change in balance_changes})
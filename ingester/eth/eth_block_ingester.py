@@ -1,5 +1,7 @@
 
-from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock, ERC20Token
+from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock
+from common.services.account_versions import bump_account_versions
+from tracker.address_filter import get_tracked_addresses
 from common.utils.blockchain import ETH
 from common.utils.utils import timestamp_to_unix
 from common.services import cointainer_web3 as web3, etherscan, thorchain
@@ -8,9 +10,13 @@ from common.services.rabbitmq import RabbitConnection, EXCHANGE_TXS, EXCHANGE_BL
 from common.services.redis import redisClient
 from common.utils.ethereum import eth_balance_cache_key_format
 from datetime import datetime, timezone
-from ingester.eth.balance_sync import sync_eth_account_balances, sync_eth_token_balance
-from ingester.eth.dex_eth_txs import get_dex_eth_txs
-from ingester.eth.thor_eth_txs import get_thor_txs
+from ingester.eth.balance_refresh import BalanceRefreshes
+from ingester.eth.block_logs import BlockLogs
+from ingester.eth.erc20_tokens import token_cache, resolve_erc20_token
+from ingester.eth.receipts import BlockReceipts
+from ingester.eth.transfer_filter import transfer_filter
+from ingester.eth.dex_eth_txs import get_dex_eth_txs, LOG_TOPICS as DEX_ETH_LOG_TOPICS
+from ingester.eth.thor_eth_txs import get_thor_txs, LOG_TOPICS as THOR_ETH_LOG_TOPICS
 
 import json
 import sha3
@@ -38,6 +44,9 @@ class EthereumBlockIngester:
     bitgo_multisig_topic = '0x' + k.hexdigest()
     # 0x59bed9ab5d78073465dd642a9e3e76dfdb7d53bcae9d09df7d0b8f5234d5a806
 
+    # every log decoded for a block is fetched by one getLogs call, with the topic count of the decoder's filter
+    LOG_TOPICS = {transfer_topic: 3, bitgo_multisig_topic: 1, **DEX_ETH_LOG_TOPICS, **THOR_ETH_LOG_TOPICS}
+
     def poll_blocks(self):
         latest_known = ProcessedBlock.latest(ETH)
         if latest_known is not None:
@@ -61,10 +70,19 @@ class EthereumBlockIngester:
 
     def process_blocks(self, start_number):
         logger.debug('sync_eth_blocks: %s', start_number)
+        # blocks far enough behind the head have their logs fetched a range at a time
+        head = web3.eth.blockNumber
+        # with few enough tracked addresses only their transfers are fetched, by topic, instead of every transfer
+        transfers_filtered = transfer_filter.enabled()
+        block_logs = BlockLogs(self.log_topics(transfers_filtered))
         block_by_height = web3.eth.getBlock(start_number, True)
         while block_by_height is not None:
+            logs = block_logs.for_block(block_by_height, head)
+            if transfers_filtered:
+                logs[self.transfer_topic] = transfer_filter.get_logs(block_by_height, self.transfer_topic)
+
             # store transactions for known addresses
-            self.process_block(block_by_height)
+            self.process_block(block_by_height, logs, transfers_filtered)
             block_hash = web3.toHex(block_by_height.get('hash'))
 
             # publish block to rabbitmq
@@ -96,11 +114,18 @@ class EthereumBlockIngester:
             start_number += 1
             block_by_height = web3.eth.getBlock(start_number, True)
 
-    def process_block(self, block):
+    def log_topics(self, transfers_filtered=False):
+        if not transfers_filtered:
+            return self.LOG_TOPICS
+        return {topic: count for topic, count in self.LOG_TOPICS.items() if topic != self.transfer_topic}
+
+    def process_block(self, block, block_logs=None, transfers_filtered=False):
+        # receipts are fetched once per txid, for the thor decoders and the txs of tracked addresses
+        receipts = BlockReceipts(block)
         # extract transactions
-        by_address = self.extract_transactions(block)
+        by_address = self.extract_transactions(block, block_logs, receipts, transfers_filtered)
         # split out fees, add erc20 data
-        self.enrich(by_address)
+        self.enrich(by_address, receipts)
         # save txs
         self.save_eth_transactions(by_address)
 
@@ -124,14 +149,9 @@ class EthereumBlockIngester:
 
         return internal_transactions
 
-    def get_erc20_transactions(self, block):
+    def get_erc20_transactions(self, block, logs):
         block_hash = web3.toHex(block.get('hash'))
         block_height = block.get('number')
-        logs = web3.eth.getLogs({
-            'fromBlock': block_height,
-            'toBlock': block_height,
-            'topics': [self.transfer_topic, None, None]
-        })
 
         if len(logs) < 1:
             logger.info('No logs of type transfer found for block %s %s', block_height, block_hash)
@@ -170,14 +190,9 @@ class EthereumBlockIngester:
 
         return erc20_transactions
 
-    def get_bitgo_multisig_transactions(self, block):
+    def get_bitgo_multisig_transactions(self, block, logs):
         block_hash = web3.toHex(block.get('hash'))
         block_height = block.get('number')
-        logs = web3.eth.getLogs({
-            'fromBlock': block_height,
-            'toBlock': block_height,
-            'topics': [self.bitgo_multisig_topic]
-        })
 
         logger.debug('Found %s multisig logs in block %s', len(logs), block_height)
 
@@ -209,18 +224,65 @@ class EthereumBlockIngester:
             logger.debug('Added multisig tx %s from = %s, to = %s, amount = %s', txid, from_address, to_address, amount)
         return multisig_txs
 
-    def extract_transactions(self, block):
+    def get_untracked_erc20_txids(self, block, erc20_transactions, thor_txs, receipts):
+        """ txids of the txs of tracked addresses that transfer erc20 tokens only between untracked addresses
+
+            With transfers_filtered those transfers are not in erc20_transactions, but they still decide whether the
+            0 value eth transfer or the thor trade of the tx is recorded, so they are looked up in the receipts.
+        """
+        candidates = []
+        for tx in block.transactions:
+            txid = web3.toHex(tx.get('hash'))
+            if txid in erc20_transactions:
+                continue
+
+            thor_tx = thor_txs.get(txid)
+            if thor_tx:
+                addresses = (thor_tx.get('from_address'), thor_tx.get('to_address'))
+            elif int(tx.get('value')) == 0:
+                addresses = (tx.get('from'), tx.get('to'))
+            else:
+                continue
+
+            if any(transfer_filter.is_tracked(address) for address in addresses):
+                candidates.append(txid)
+
+        receipts.prefetch(candidates)
+
+        txids = set()
+        for txid in candidates:
+            for log in receipts.get(txid).get('logs'):
+                topics = log.get('topics')
+                if len(topics) == 3 and web3.toHex(topics[0]).lower() == self.transfer_topic:
+                    txids.add(txid)
+                    break
+
+        return txids
+
+    def extract_transactions(self, block, block_logs=None, receipts=None, transfers_filtered=False):
+        """ block_logs: {topic: [log]} of LOG_TOPICS in block, fetched when not given
+            transfers_filtered: the transfer logs of block_logs are only the ones from or to tracked addresses
+        """
         block_height = block.get('number')
         block_hash = web3.toHex(block.get('hash'))
         block_time = datetime.fromtimestamp(block.get('timestamp'), timezone.utc)
 
         logger.debug('extract_transactions for block: %s', block_hash)
 
+        if block_logs is None:
+            block_logs = BlockLogs(self.LOG_TOPICS).for_block(block)
+        if receipts is None:
+            receipts = BlockReceipts(block)
+
         internal_transactions = self.get_internal_transactions(block)
-        erc20_transactions = self.get_erc20_transactions(block)
-        thor_txs = get_thor_txs(block)
-        dex_eth_txs = get_dex_eth_txs(block)
-        multisig_transactions = self.get_bitgo_multisig_transactions(block)
+        erc20_transactions = self.get_erc20_transactions(block, block_logs[self.transfer_topic])
+        thor_txs = get_thor_txs(block, block_logs, receipts)
+        dex_eth_txs = get_dex_eth_txs(block, block_logs)
+        multisig_transactions = self.get_bitgo_multisig_transactions(block, block_logs[self.bitgo_multisig_topic])
+
+        untracked_erc20_txids = set()
+        if transfers_filtered:
+            untracked_erc20_txids = self.get_untracked_erc20_txids(block, erc20_transactions, thor_txs, receipts)
 
         transactions = []
         addresses = set()
@@ -255,11 +317,12 @@ class EthereumBlockIngester:
             thor_tx = thor_txs.get(txid)
             dex_eth_tx = dex_eth_txs.get(txid)
             multisig_tx = multisig_transactions.get(txid)
+            has_erc20_transfers = bool(erc20_txs) or txid in untracked_erc20_txids
 
             # standard eth transfer not including dex, thor, and multisig
             if not dex_eth_tx and not thor_tx and not multisig_tx:
                 # do not include 0 value eth transfers related to an erc20 token transfer
-                if not (int(tx.get('value')) == 0 and erc20_txs):
+                if not (int(tx.get('value')) == 0 and has_erc20_transfers):
                     standard_transaction = {
                         'type': ETH,
                         'to_address': web3.toChecksumAddress(tx.get('to')) if bool(tx.get('to')) else None,
@@ -305,7 +368,7 @@ class EthereumBlockIngester:
                     add_transaction(base_transaction, erc20_transaction)
 
             # Non-erc20 thor trades
-            if thor_tx and not erc20_txs:
+            if thor_tx and not has_erc20_transfers:
                 thor_transaction = {
                     'type': self.THOR_ETH_TXS,
                     'from_address': web3.toChecksumAddress(thor_tx.get('from_address')),
@@ -341,10 +404,7 @@ class EthereumBlockIngester:
                 add_transaction(base_transaction, multisig_transaction)
 
         # find intersection of addresses in block and addresses we know about
-        known_addresses = Address.objects.filter(
-            address__in=list(addresses),
-            account__network=ETH
-        ).values_list('address', flat=True)
+        known_addresses = set(get_tracked_addresses(ETH, addresses))
 
         # filter list of transactions down to those we care about
         transactions = list(filter(lambda t: t.get('from_address') in known_addresses
@@ -385,11 +445,19 @@ class EthereumBlockIngester:
 
     # determine gas used for sends, calculate balance change, split out fee tx for ERC20s, add token symbol
     # and token id to ERC20s
-    def enrich(self, by_address):
+    def enrich(self, by_address, receipts):
+        # one batch for every tx of a tracked address, a tx of two tracked addresses is fetched once
+        receipts.prefetch([txid for tx_obj in by_address.values() for txid in tx_obj])
+        # one lookup for every token of the block, unknown tokens are resolved in one batch or in the background
+        tokens, _ = token_cache.resolve([
+            tx.get('contract_address') for tx_obj in by_address.values() for txs in tx_obj.values() for tx in txs
+            if tx.get('type') == self.ERC20
+        ])
+
         erc20_fees = dict()
         for address, tx_obj in by_address.items():
             for txid, txs in tx_obj.items():
-                receipt = web3.eth.getTransactionReceipt(txid)
+                receipt = receipts.get(txid)
                 eth_send = any(address == tx.get('from_address') and tx.get('type') == ETH and int(tx.get('value')) > 0 for tx in txs)
                 eth_dex_send = any(address == tx.get('from_address') and tx.get('type') == self.DEX_ETH_TXS and int(tx.get('value')) > 0 for tx in txs)
 
@@ -472,12 +540,12 @@ class EthereumBlockIngester:
                         # get contract details
                         tx['erc20_transfer'] = True
 
-                        try:
-                            token = ERC20Token.get_or_create(contract_address)
+                        token = tokens.get(contract_address)
+                        if token is not None:
                             tx['token_symbol'] = token.symbol
-                            tx['erc20_token_id'] = token.id
-                        except Exception as e:
-                            logger.exception('error obtaining details for erc20 contract {}'.format(contract_address), e)
+                            tx['erc20_token'] = token
+                        else:
+                            tx['erc20_token_pending'] = contract_address
 
         # add any fee tx we encountered
         for txid, fees in erc20_fees.items():
@@ -489,6 +557,10 @@ class EthereumBlockIngester:
         # map txs for rabbit notifications
         rabbit_transactions = []
         network = 'ETH'
+        # {contract_address: [transaction id]} of the txs saved while their token is resolved in the background
+        pending_tokens = dict()
+        # balances touched by the block, refreshed once per (address, asset) after every row is saved
+        balance_refreshes = BalanceRefreshes()
 
         for address, tx_obj in tx_by_address.items():
             address_obj = Address.objects.get(address=address)
@@ -497,9 +569,7 @@ class EthereumBlockIngester:
             for txid, txs in tx_obj.items():
                 for tx in txs:
                     logger.info('persisting transaction and balance change for %s', tx)
-                    token_obj = None
-                    if tx.get('erc20_token_id') is not None:
-                        token_obj = ERC20Token.objects.get(id=tx.get('erc20_token_id'))
+                    token_obj = tx.get('erc20_token')
 
                     fee = None
                     numberFee = tx.get('fee', None)
@@ -509,7 +579,7 @@ class EthereumBlockIngester:
                     tx_obj, tx_created = Transaction.objects.update_or_create(
                         txid=txid,
                         account=account_object,
-                        erc20_token=token_obj,
+                        erc20_token_id=token_obj.id if token_obj is not None else None,
                         is_erc20_token_transfer=tx.get('erc20_transfer', False),
                         is_erc20_fee=tx.get('erc20_fee', False),
                         is_dex_trade=tx.get('is_dex_trade', False),
@@ -531,6 +601,9 @@ class EthereumBlockIngester:
                         amount=tx.get('balance_change')
                     )
 
+                    if tx.get('erc20_token_pending'):
+                        pending_tokens.setdefault(tx.get('erc20_token_pending'), []).append(tx_obj.id)
+
                     msg = {}
                     msg["txid"] = txid
                     msg["network"] = network
@@ -568,14 +641,16 @@ class EthereumBlockIngester:
 
                     rabbit_transactions.append(msg)
 
-                    sync_eth_account_balances.s(address, False).apply_async()
-                    if token_obj is not None:
-                        sync_eth_token_balance.s(
-                            address_obj.account.id,
-                            address,
-                            token_obj.symbol,
-                            token_obj.contract_address
-                        ).apply_async()
+                    balance_refreshes.add(address_obj.account.id, address, token_obj)
+
+        bump_account_versions(
+            Address.objects.filter(address__in=list(tx_by_address), account__network=ETH)
+            .values_list('account_id', flat=True))
+
+        balance_refreshes.schedule()
+
+        for contract_address, transaction_ids in pending_tokens.items():
+            resolve_erc20_token.s(contract_address, transaction_ids).apply_async()
 
         # Create new list where we merge 2 dex messages per dex trade into 1 message per dex trade with buy and sell asset.
         rabbit_messages = []
@@ -0,0 +1,78 @@
+"""
+Transaction receipts of one ETH block, fetched once per txid and in batches
+
+The thor decoders and enrich read receipts from here instead of calling eth_getTransactionReceipt per log or per
+(address, txid). prefetch loads the receipts of the given txids with one batched JSON-RPC request, or with
+eth_getBlockReceipts on nodes that support it (ETH_BLOCK_RECEIPTS=true). The raw receipts are then served through
+web3's own formatting middleware, so get returns exactly what web3.eth.getTransactionReceipt would.
+"""
+import logging
+import os
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+from common.services import cointainer_web3 as web3, ethereum_json_rpc
+
+logger = logging.getLogger('watchtower.ingester.eth.receipts')
+
+ETH_BLOCK_RECEIPTS = (os.environ.get('ETH_BLOCK_RECEIPTS') or 'false').lower() == 'true'
+ETH_RECEIPTS_BATCH_SIZE = int(os.environ.get('ETH_RECEIPTS_BATCH_SIZE') or '100')
+
+
+class _FetchedReceiptsProvider(BaseProvider):
+    """ Answers eth_getTransactionReceipt with receipts that were already fetched """
+    def __init__(self, receipts):
+        self.receipts = receipts
+
+    def make_request(self, method, params):
+        return {'jsonrpc': '2.0', 'id': 1, 'result': self.receipts[params[0].lower()]}
+
+    def isConnected(self):
+        return True
+
+
+class BlockReceipts:
+    def __init__(self, block):
+        self.block_number = block.get('number')
+        self.raw = dict()
+        self.fetched = Web3(_FetchedReceiptsProvider(self.raw))
+        self.block_fetched = False
+
+    def prefetch(self, txids):
+        """ Fetch the receipts of txids that were not fetched yet """
+        missing = list(dict.fromkeys(txid.lower() for txid in txids if txid.lower() not in self.raw))
+        if not missing:
+            return
+
+        if ETH_BLOCK_RECEIPTS and not self.block_fetched:
+            self.block_fetched = True
+            try:
+                receipts = ethereum_json_rpc.batch([('eth_getBlockReceipts', [hex(self.block_number)])])[0]
+                for receipt in receipts.get('result') or []:
+                    self.raw[receipt['transactionHash'].lower()] = receipt
+                missing = [txid for txid in missing if txid not in self.raw]
+            except Exception as e:
+                logger.warning('eth_getBlockReceipts failed for block %s: %s', self.block_number, str(e))
+
+        for i in range(0, len(missing), ETH_RECEIPTS_BATCH_SIZE):
+            chunk = missing[i:i + ETH_RECEIPTS_BATCH_SIZE]
+            try:
+                responses = ethereum_json_rpc.batch([('eth_getTransactionReceipt', [txid]) for txid in chunk])
+            except Exception as e:
+                # get fetches them one at a time
+                logger.warning('batched receipts request failed for block %s: %s', self.block_number, str(e))
+                continue
+
+            for txid, response in zip(chunk, responses):
+                if 'error' in response:
+                    logger.warning('failed to fetch receipt %s: %s', txid, response['error'])
+                    continue
+                self.raw[txid] = response.get('result')
+
+        logger.debug('fetched %s receipts of block %s', len(missing), self.block_number)
+
+    def get(self, txid):
+        if txid.lower() not in self.raw:
+            return web3.eth.getTransactionReceipt(txid)
+        return self.fetched.eth.getTransactionReceipt(txid)
@@ -15,25 +15,20 @@ outgoing_thor_topic = '0x' + k.hexdigest()
 
 thor_deposit_contract = web3.eth.contract(address= web3.toChecksumAddress('0x0000000000000000000000000000000000000000'), abi=THOR_ROUTER_ABI)
 
-def get_incoming_thor_txs(block):
+def get_incoming_thor_txs(block, logs, receipts):
   block_hash = web3.toHex(block.get('hash'))  
   block_height = block.get('number')
 
-  logs = web3.eth.getLogs({
-      'fromBlock': block_height,
-      'toBlock': block_height,
-      'topics': [incoming_thor_topic]
-  })
-
   incoming_thor_txs = dict()
   contract_addresses = dict()
 
   for tx in block.transactions:
       contract_addresses[tx.get('hash').hex()] = tx['to']
 
+  receipts.prefetch([str(log['transactionHash'].hex()) for log in logs])
   for log in logs:
     txid = str(log['transactionHash'].hex())
-    receipt = web3.eth.getTransactionReceipt(txid)
+    receipt = receipts.get(txid)
     transferOut = thor_deposit_contract.events.TransferOut()
 
     try:
@@ -59,16 +54,10 @@ def get_incoming_thor_txs(block):
 
   return incoming_thor_txs
 
-def get_outgoing_thor_txs(block):
+def get_outgoing_thor_txs(block, logs, receipts):
   block_hash = web3.toHex(block.get('hash'))  
   block_height = block.get('number')
 
-  logs = web3.eth.getLogs({
-      'fromBlock': block_height,
-      'toBlock': block_height,
-      'topics': [outgoing_thor_topic]
-  })
-
   outgoing_thor_txs = dict()
   contract_addresses = dict()
   from_addresses = dict()
@@ -77,9 +66,10 @@ def get_outgoing_thor_txs(block):
       contract_addresses[tx.get('hash').hex()] = tx['to']
       from_addresses[tx.get('hash').hex()] = tx['from']
 
+  receipts.prefetch([str(log['transactionHash'].hex()) for log in logs])
   for log in logs:
     txid = str(log['transactionHash'].hex())
-    receipt = web3.eth.getTransactionReceipt(txid)
+    receipt = receipts.get(txid)
     deposit = thor_deposit_contract.events.Deposit()
 
     try:
@@ -106,9 +96,12 @@ def get_outgoing_thor_txs(block):
 
   return outgoing_thor_txs
 
-def get_thor_txs(block):
-  incoming = get_incoming_thor_txs(block)
-  outgoing = get_outgoing_thor_txs(block)
+# topics of the logs get_thor_txs decodes, see ingester/eth/block_logs.py
+LOG_TOPICS = {incoming_thor_topic: 1, outgoing_thor_topic: 1}
+
+def get_thor_txs(block, block_logs, receipts):
+  incoming = get_incoming_thor_txs(block, block_logs[incoming_thor_topic], receipts)
+  outgoing = get_outgoing_thor_txs(block, block_logs[outgoing_thor_topic], receipts)
   all = incoming.copy()
   all.update(outgoing)
   return all
\ No newline at end of file
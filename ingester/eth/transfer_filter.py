@@ -0,0 +1,111 @@
+"""
+ERC20 Transfer logs of the tracked ETH addresses only
+
+Instead of every Transfer log of a block, getLogs is asked for the Transfers whose from (topic1) or to (topic2) is a
+tracked address, with the addresses padded to 32 byte topics and split in chunks of ETH_TRANSFER_FILTER_CHUNK_SIZE to
+stay under the node's filter limits. Each chunk costs two calls, so once more than ETH_TRANSFER_FILTER_MAX_ADDRESSES
+are tracked a full scan of the block is cheaper and enabled() turns the filter off.
+
+The tracked set is kept like the bloom filters of tracker/address_filter.py: rebuilt from postgres every
+REBUILD_INTERVAL and synced in between from the redis log of addresses registered by other processes. The topic
+chunks are rebuilt whenever the set changes.
+"""
+import logging
+import os
+import time
+
+from common.services import cointainer_web3 as web3
+from common.services.launchdarkly import is_feature_enabled, ERC20_TOPIC_FILTER
+from common.services.redis import redisClient, ADDRESS_FILTER_PREFIX
+from common.utils.networks import ETH
+from tracker.address_filter import REBUILD_INTERVAL, CLOCK_SKEW_MARGIN
+
+logger = logging.getLogger('watchtower.ingester.eth.transfer_filter')
+
+ETH_TRANSFER_FILTER_CHUNK_SIZE = int(os.environ.get('ETH_TRANSFER_FILTER_CHUNK_SIZE') or '500')
+ETH_TRANSFER_FILTER_MAX_ADDRESSES = int(os.environ.get('ETH_TRANSFER_FILTER_MAX_ADDRESSES') or '2000')
+
+
+def address_topic(address):
+    return '0x' + address[2:].lower().rjust(64, '0')
+
+
+class TrackedTransferFilter:
+    def __init__(self):
+        self.addresses = set()
+        self.built_at = None
+        self.synced_at = None
+        self.chunks = None
+
+    def refresh(self):
+        if self.built_at is None or (time.time() - self.built_at) > REBUILD_INTERVAL:
+            self.rebuild()
+        else:
+            self.sync()
+
+    def rebuild(self):
+        from tracker.models import Address
+
+        started_at = time.time()
+        addresses = Address.objects.filter(account__network=ETH).values_list('address', flat=True)
+        addresses = {address.lower() for address in addresses.iterator()}
+        if addresses != self.addresses:
+            self.addresses = addresses
+            self.chunks = None
+        self.built_at = started_at
+        self.synced_at = started_at
+
+    def sync(self):
+        """ Add the addresses registered by other processes since the last sync """
+        now = time.time()
+        entries = redisClient.zrangebyscore(ADDRESS_FILTER_PREFIX + ETH, self.synced_at - CLOCK_SKEW_MARGIN, '+inf')
+        added = {address.lower() for address in entries} - self.addresses
+        if added:
+            self.addresses |= added
+            self.chunks = None
+        self.synced_at = now
+
+    def enabled(self):
+        """ Whether the Transfer logs of tracked addresses should be fetched instead of all of them """
+        if not is_feature_enabled(ERC20_TOPIC_FILTER):
+            return False
+
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error('tracked ETH addresses unavailable, scanning all transfers: %s', str(e))
+            return False
+
+        return len(self.addresses) <= ETH_TRANSFER_FILTER_MAX_ADDRESSES
+
+    def is_tracked(self, address):
+        return bool(address) and address.lower() in self.addresses
+
+    def topic_chunks(self):
+        if self.chunks is None:
+            topics = sorted(address_topic(address) for address in self.addresses)
+            self.chunks = [
+                topics[i:i + ETH_TRANSFER_FILTER_CHUNK_SIZE] for i in range(0, len(topics), ETH_TRANSFER_FILTER_CHUNK_SIZE)
+            ]
+            logger.info('rebuilt %s transfer topic chunks of %s tracked addresses', len(self.chunks), len(topics))
+        return self.chunks
+
+    def get_logs(self, block, transfer_topic):
+        """ Transfer logs of block from or to a tracked address, in block order like a full scan returns them
+
+            Logs are requested by block hash (EIP-234), so they can not be from another block at the same height.
+            A transfer between two tracked addresses matches both filters and is kept once.
+        """
+        block_hash = web3.toHex(block.get('hash'))
+
+        logs = dict()
+        for chunk in self.topic_chunks():
+            for topics in ([transfer_topic, chunk, None], [transfer_topic, None, chunk]):
+                for log in web3.eth.getLogs({'blockHash': block_hash, 'topics': topics}):
+                    logs[log.get('logIndex')] = log
+
+        logger.debug('fetched %s tracked transfer logs of block %s', len(logs), block_hash)
+        return [logs[log_index] for log_index in sorted(logs)]
+
+
+transfer_filter = TrackedTransferFilter()
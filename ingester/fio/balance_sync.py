@@ -2,6 +2,7 @@ from celery import task
 from celery_once import QueueOnce
 
 from tracker.models import AccountBalance, Address
+from common.services.account_versions import bump_account_versions
 from common.services import fio
 from common.utils.networks import FIO
 from common.utils.utils import current_time_millis
@@ -30,6 +31,7 @@ def sync_fio_account_balances(address):
             'balance': balance
         }
     )
+    bump_account_versions([account.id])
 
     logger.info('synced fio balances for %s, balance = %s in %sms',
                 address, balance, (current_time_millis() - start))
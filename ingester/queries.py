@@ -0,0 +1,164 @@
+# Set-based upsert of utxo transactions, one statement per block.
+#
+# tracker_transaction has no unique constraint on (txid, account_id) to use as an ON CONFLICT target, so the
+# upsert is expressed as a data-modifying CTE: update the rows that already exist, insert the ones that don't,
+# and return the ids of both so balance changes can be linked in a second statement.
+BULK_UPSERT_TRANSACTIONS_SQL = """
+            WITH v (txid, account_id, block_hash, block_time, block_height, thor_memo, fee) AS (
+                VALUES {values}
+            ),
+            updated AS (
+                UPDATE tracker_transaction tx
+                SET block_hash = v.block_hash,
+                    block_time = v.block_time,
+                    block_height = v.block_height,
+                    thor_memo = v.thor_memo,
+                    fee = v.fee
+                FROM v
+                WHERE tx.txid = v.txid
+                  AND tx.account_id = v.account_id
+                RETURNING tx.id, tx.txid, tx.account_id
+            ),
+            inserted AS (
+                INSERT INTO tracker_transaction (txid, account_id, block_hash, block_time, block_height, thor_memo,
+                                                 fee, raw, is_erc20_token_transfer, is_erc20_fee, is_dex_trade,
+                                                 success)
+                SELECT v.txid, v.account_id, v.block_hash, v.block_time, v.block_height, v.thor_memo,
+                       v.fee, '', false, false, false, true
+                FROM v
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM updated u WHERE u.txid = v.txid AND u.account_id = v.account_id
+                )
+                RETURNING id, txid, account_id
+            )
+            SELECT id, txid, account_id FROM updated
+            UNION ALL
+            SELECT id, txid, account_id FROM inserted
+        """
+
+BULK_UPSERT_TRANSACTIONS_VALUES = "(%s, %s::integer, %s, %s::timestamptz, %s::integer, %s, %s)"
+
+# Balance changes are matched on all of their columns (the same lookup BalanceChange.objects.update_or_create uses)
+BULK_INSERT_BALANCE_CHANGES_SQL = """
+            INSERT INTO tracker_balancechange (account_id, address_id, transaction_id, amount)
+            SELECT v.account_id, v.address_id, v.transaction_id, v.amount
+            FROM (VALUES {values}) AS v (account_id, address_id, transaction_id, amount)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM tracker_balancechange bal
+                WHERE bal.account_id = v.account_id
+                  AND bal.address_id = v.address_id
+                  AND bal.transaction_id = v.transaction_id
+                  AND bal.amount = v.amount
+            )
+        """
+
+BULK_INSERT_BALANCE_CHANGES_VALUES = "(%s::integer, %s::integer, %s::integer, %s::numeric)"
+
+
+def values_sql(sql, template, rows):
+    """ Format a VALUES list of len(rows) placeholders into sql and flatten rows into the matching params """
+    values = ', '.join([template] * len(rows))
+    params = [value for row in rows for value in row]
+    return sql.format(values=values), params
+
+
+# Outputs paying tracked addresses, a block hash or height that is already known is never cleared by a copy of the tx
+# fetched while it was still unconfirmed. Spent rows keep the spend whatever order outputs and spends arrive in.
+UPSERT_UTXOS_SQL = """
+            INSERT INTO tracker_utxo (account_id, address_id, txid, vout, satoshis, block_hash, block_height)
+            VALUES {values}
+            ON CONFLICT (account_id, txid, vout) DO UPDATE
+            SET block_hash = COALESCE(EXCLUDED.block_hash, tracker_utxo.block_hash),
+                block_height = COALESCE(EXCLUDED.block_height, tracker_utxo.block_height)
+        """
+
+UPSERT_UTXOS_VALUES = "(%s::integer, %s::integer, %s, %s::integer, %s::numeric, %s, %s::integer)"
+
+# A spend can be seen before the output it spends (e.g. a block synced while the account is still being scanned),
+# in which case the row is created already spent and completed by the output upsert later.
+SPEND_UTXOS_SQL = """
+            INSERT INTO tracker_utxo (account_id, address_id, txid, vout, satoshis, spent_txid, spent_block_hash,
+                                      spent_block_height)
+            VALUES {values}
+            ON CONFLICT (account_id, txid, vout) DO UPDATE
+            SET spent_txid = EXCLUDED.spent_txid,
+                spent_block_hash = COALESCE(EXCLUDED.spent_block_hash, tracker_utxo.spent_block_hash),
+                spent_block_height = COALESCE(EXCLUDED.spent_block_height, tracker_utxo.spent_block_height)
+        """
+
+SPEND_UTXOS_VALUES = "(%s::integer, %s::integer, %s, %s::integer, %s::numeric, %s, %s, %s::integer)"
+
+# Spent outputs are only kept while the block that spent them could still be orphaned
+PRUNE_SPENT_UTXOS_SQL = """
+            DELETE FROM tracker_utxo
+            WHERE account_id = ANY(%s)
+              AND spent_block_height < %s
+        """
+
+# Txs of unconfirmed outputs and spends, reconciled against upstream by fix_pending_txs
+UNCONFIRMED_UTXO_TXIDS_SQL = """
+            SELECT u.txid
+            FROM tracker_utxo u
+            JOIN tracker_account a ON a.id = u.account_id
+            WHERE a.network = %s
+              AND u.block_height IS NULL
+            UNION
+            SELECT u.spent_txid
+            FROM tracker_utxo u
+            JOIN tracker_account a ON a.id = u.account_id
+            WHERE a.network = %s
+              AND u.spent_txid IS NOT NULL
+              AND u.spent_block_height IS NULL
+        """
+
+# Block info of txs that confirmed since their outputs and spends were recorded, params: values..., network
+CONFIRM_UTXOS_SQL = """
+            UPDATE tracker_utxo u
+            SET block_hash = v.block_hash,
+                block_height = v.block_height
+            FROM (VALUES {values}) AS v (txid, block_hash, block_height), tracker_account a
+            WHERE a.id = u.account_id
+              AND a.network = %s
+              AND u.txid = v.txid
+              AND u.block_height IS NULL
+            RETURNING u.account_id
+        """
+
+CONFIRM_UTXO_SPENDS_SQL = """
+            UPDATE tracker_utxo u
+            SET spent_block_hash = v.block_hash,
+                spent_block_height = v.block_height
+            FROM (VALUES {values}) AS v (txid, block_hash, block_height), tracker_account a
+            WHERE a.id = u.account_id
+              AND a.network = %s
+              AND u.spent_txid = v.txid
+              AND u.spent_block_height IS NULL
+            RETURNING u.account_id
+        """
+
+CONFIRM_UTXOS_VALUES = "(%s, %s, %s::integer)"
+
+# Txs dropped from the mempool or replaced (RBF): their outputs never existed and the outputs they spent are unspent
+# again, params: network, txids
+DROP_UNCONFIRMED_UTXOS_SQL = """
+            DELETE FROM tracker_utxo u
+            USING tracker_account a
+            WHERE a.id = u.account_id
+              AND a.network = %s
+              AND u.txid = ANY(%s)
+              AND u.block_height IS NULL
+            RETURNING u.account_id
+        """
+
+RESTORE_UNCONFIRMED_SPENDS_SQL = """
+            UPDATE tracker_utxo u
+            SET spent_txid = NULL,
+                spent_block_hash = NULL,
+                spent_block_height = NULL
+            FROM tracker_account a
+            WHERE a.id = u.account_id
+              AND a.network = %s
+              AND u.spent_txid = ANY(%s)
+              AND u.spent_block_height IS NULL
+            RETURNING u.account_id
+        """
@@ -1,7 +1,7 @@
 from datetime import datetime, timezone
-from decimal import Decimal
 
 from celery import task
+from celery.signals import worker_process_init
 from celery_once import QueueOnce
 
 from api.rest.v1.data.transactions import fetcher as tx_fetcher
@@ -18,13 +18,20 @@ from ingester.eos import eos_block_ingester
 from ingester.eos.balance_sync import sync_eos_account_balances
 from ingester.fio import fio_block_ingester
 from ingester.fio.balance_sync import sync_fio_account_balances
+from ingester.block_prefetcher import BlockPrefetcher
+from ingester.xpub_scanner import AddressScanner
 from tracker.models import Account, Address, Transaction, BalanceChange, ProcessedBlock, ERC20Token
+from tracker.address_filter import build_filters as build_address_filters, get_tracked_addresses
+from tracker.header_chain import record_block as record_header
 from common.services import thorchain
+from common.services.account_versions import bump_account_versions, bump_chain_version
 from common.services.coinquery import get_client as get_coinquery_client
 from common.services.gaia_tendermint import get_client as get_gaia_client
-from common.services.redis import redisClient, WATCH_ADDRESS_PREFIX, WATCH_ADDRESS_SET_KEY, WATCH_TX_SET_KEY
+from common.services.redis import redisClient, WATCH_ADDRESS_PREFIX, WATCH_ADDRESS_SET_KEY, WATCH_TX_SET_KEY, \
+    UTXO_MISSING_TXS_PREFIX
 from common.services.rabbitmq import RabbitConnection, EXCHANGE_TXS, EXCHANGE_BLOCKS, EXCHANGE_NOTIFICATIONS
 from common.utils.bip32 import GAP_LIMIT
+from common.utils.utxo import decode_tx, map_txs_by_address, parse_satoshis
 from common.utils.ethereum import calculate_balance_change, calculate_dex_balance_change, \
     calculate_ethereum_transaction_fee
 from common.utils.ethereum import gen_get_all_ethereum_transactions, gen_get_all_internal_ethereum_transactions, \
@@ -32,21 +39,69 @@ from common.utils.ethereum import gen_get_all_ethereum_transactions, gen_get_all
 from common.utils.ethereum import get_balance as get_eth_balance
 from common.utils.ethereum import get_token_balance as get_eth_token_balance
 from common.utils.ethereum import ETHEREUM_DECIMAL_PRECISION, ETH_MAX_TXS
-from common.utils.networks import ATOM, ETH, DOGE, BNB, XRP, EOS, FIO, RUNE, KAVA, SCRT, OSMO
+from common.utils.networks import ATOM, ETH, DOGE, BNB, XRP, EOS, FIO, RUNE, KAVA, SCRT, OSMO, BTC, BCH, LTC, DASH, DGB
+from common.utils.blockchain import get_latest_block_height
 from common.services import binance_client, eos_client, ripple, fio
 from common.utils.cosmos import calculate_balance_change as cosmos_calculate_balance_change
 from common.utils.fio import calculate_balance_change as fio_calculate_balance_change
 from common.services import cointainer_web3 as web3
 from common.utils.ethereum import THOR_ROUTER_ABI
-from django.db import connection
+from common.utils.utils import current_time_millis
+from common.services.launchdarkly import is_feature_enabled, BULK_SAVE_RESULTS, INCREMENTAL_RESYNC
+from ingester.queries import (
+    BULK_UPSERT_TRANSACTIONS_SQL,
+    BULK_UPSERT_TRANSACTIONS_VALUES,
+    BULK_INSERT_BALANCE_CHANGES_SQL,
+    BULK_INSERT_BALANCE_CHANGES_VALUES,
+    UPSERT_UTXOS_SQL,
+    UPSERT_UTXOS_VALUES,
+    SPEND_UTXOS_SQL,
+    SPEND_UTXOS_VALUES,
+    PRUNE_SPENT_UTXOS_SQL,
+    UNCONFIRMED_UTXO_TXIDS_SQL,
+    CONFIRM_UTXOS_SQL,
+    CONFIRM_UTXO_SPENDS_SQL,
+    CONFIRM_UTXOS_VALUES,
+    DROP_UNCONFIRMED_UTXOS_SQL,
+    RESTORE_UNCONFIRMED_SPENDS_SQL,
+    values_sql,
+)
+from django.db import connection, transaction as db_transaction
 
 import logging
 import json
+import os
+import time
 
 logger = logging.getLogger('watchtower.ingester.tasks')
 
 ZX_PROXY_CONTRACT = '0xdef1c0ded9bec7f1a1670819833240f027b25eff'
 
+# number of blocks sync_blocks fetches ahead of the block being saved, 0 walks the chain one block at a time
+SYNC_BLOCKS_PREFETCH_DEPTH = int(os.environ.get('SYNC_BLOCKS_PREFETCH_DEPTH') or '0')
+
+UTXO_NETWORKS = (BTC, BCH, LTC, DOGE, DASH, DGB)
+
+# blocks after which a spent output can no longer be restored by a reorg and is dropped from tracker_utxo
+UTXO_PRUNE_DEPTH = int(os.environ.get('UTXO_PRUNE_DEPTH') or '100')
+
+# seconds an unconfirmed tx has to be missing upstream before it is treated as dropped or replaced, so a failed
+# lookup does not remove outputs that still exist
+UTXO_DROPPED_TX_GRACE = int(os.environ.get('UTXO_DROPPED_TX_GRACE') or 60 * 30)
+
+# blocks below an account's sync checkpoint that a resync fetches again, in case they were reorged
+RESYNC_REORG_MARGIN = 6
+RESYNC_CHUNK_SIZE = 50
+
+# concurrent CoinQuery requests per sync_xpub gap limit window, 0 scans chunks of 10 addresses one at a time
+SYNC_XPUB_SCAN_WORKERS = int(os.environ.get('SYNC_XPUB_SCAN_WORKERS') or '0')
+SYNC_XPUB_CHUNK_SIZE = int(os.environ.get('SYNC_XPUB_CHUNK_SIZE') or str(2 * GAP_LIMIT))
+
+
+@worker_process_init.connect
+def init_address_filters(**kwargs):
+    build_address_filters()
+
 
 @task(base=QueueOnce, once={'graceful': True})
 def sync_blocks(network, from_hash=None):
@@ -65,35 +120,46 @@ def sync_blocks(network, from_hash=None):
         else:
             next_hash = coinquery.get_last_block_hash()
 
-    while next_hash:
-        sync_block(network, next_hash)
-        info = {"hash": next_hash, "network": network}
-        RabbitConnection().publish(
-            exchange=EXCHANGE_BLOCKS,
-            routing_key='',
-            message_type='block',
-            body=json.dumps(info)
-        )
-        next_hash = coinquery.get_next_block_hash(next_hash)
+    if SYNC_BLOCKS_PREFETCH_DEPTH > 0:
+        # fetch blocks and their transactions ahead of the writer, blocks are still saved and published in order
+        for block_hash, block, block_txs in BlockPrefetcher(coinquery, next_hash, SYNC_BLOCKS_PREFETCH_DEPTH):
+            _sync_block(network, block_hash, block_txs=block_txs, block=block)
+            _publish_block(network, block_hash)
+    else:
+        while next_hash:
+            sync_block(network, next_hash)
+            _publish_block(network, next_hash)
+            next_hash = coinquery.get_next_block_hash(next_hash)
 
     logger.info('finished syncing blocks for %s, from_hash = %s', network, from_hash)
 
 
+def _publish_block(network, block_hash):
+    info = {"hash": block_hash, "network": network}
+    RabbitConnection().publish(
+        exchange=EXCHANGE_BLOCKS,
+        routing_key='',
+        message_type='block',
+        body=json.dumps(info)
+    )
+
+
 @task(base=QueueOnce, once={'graceful': True})
 def sync_block(network, block_hash):
+    _sync_block(network, block_hash)
+
+
+def _sync_block(network, block_hash, block_txs=None, block=None):
     logger.info('syncing block for %s with hash %s', network, block_hash)
 
     coinquery = get_coinquery_client(network)
 
     try:
-        block_txs = coinquery.get_transactions_by_block_hash(block_hash)
+        if block_txs is None:
+            block_txs = coinquery.get_transactions_by_block_hash(block_hash)
         block_txs_by_txid = {tx.get('txid'): tx for tx in block_txs}
         block_txs_by_address = map_txs_by_address(block_txs, txs_by_address={})
-        block_tx_addresses = list(block_txs_by_address.keys())
-        tracked_addresses = list(Address.objects.filter(
-            address__in=block_tx_addresses,
-            account__network=network
-        ).values_list('address', flat=True))
+        tracked_addresses = get_tracked_addresses(network, block_txs_by_address.keys())
 
         # thor trade rewards should happen with this call
         save_results(
@@ -103,7 +169,8 @@ def sync_block(network, block_hash):
             block_txs_by_txid,
             publish=True,
             thor_trade_reward=True)
-        ProcessedBlock.get_or_create(block_hash, network)
+        processed_block = ProcessedBlock.get_or_create(block_hash, network, block=block)
+        record_header(network, processed_block.block_height, block_hash, processed_block.previous_hash)
 
         logger.info('finished syncing block for %s with hash %s', network, block_hash)
     except Exception as e:
@@ -155,12 +222,87 @@ def fix_pending_txs(network):
                         where tracker_transaction.id = {}
                         """.format(block_height, block_hash, block_time, dbTxMap.get(txid))
                 )
+            bump_account_versions(Transaction.objects.filter(id=dbTxMap.get(txid)).values_list('account_id', flat=True))
+
+    if network in UTXO_NETWORKS:
+        reconcile_unconfirmed_utxos(network, coinquery)
+
+
+def reconcile_unconfirmed_utxos(network, coinquery):
+    """ Settle the unconfirmed outputs and spends of tracker_utxo against upstream
+
+        Txs that confirmed get their block copied in. Txs upstream has answered 404 for during UTXO_DROPPED_TX_GRACE
+        seconds were dropped from the mempool or replaced, their outputs are removed and the outputs they spent are
+        unspent again. Nothing is dropped by a run in which any lookup failed, an outage is not a missing tx.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(UNCONFIRMED_UTXO_TXIDS_SQL, [network, network])
+        txids = [txid for txid, in cursor.fetchall()]
+
+    missing_key = UTXO_MISSING_TXS_PREFIX + network
+    if not txids:
+        redisClient.delete(missing_key)
+        return
+
+    txmap, missing, failed = coinquery.lookup_transactions(txids)
+
+    confirmed = []
+    for txid, tx in txmap.items():
+        block_hash = tx.get('blockhash')
+        if not block_hash:
+            continue
+
+        # doge does not have block_height information in tx details
+        if network == DOGE:
+            block_height = coinquery.get_block_by_hash(block_hash).get('height')
+        else:
+            block_height = tx.get('blockheight')
+
+        if block_height is not None and block_height > 0:
+            confirmed.append((txid, block_hash, block_height))
+
+    now = time.time()
+    missing_since = redisClient.hgetall(missing_key)
+    if failed:
+        logger.warning('failed to look up %s of %s unconfirmed %s txs, not dropping any', len(failed), len(txids),
+                       network)
+        dropped = []
+    else:
+        dropped = [txid for txid in missing
+                   if txid in missing_since and now - float(missing_since[txid]) > UTXO_DROPPED_TX_GRACE]
+
+    account_ids = set()
+    with db_transaction.atomic(), connection.cursor() as cursor:
+        if confirmed:
+            for query in (CONFIRM_UTXOS_SQL, CONFIRM_UTXO_SPENDS_SQL):
+                sql, params = values_sql(query, CONFIRM_UTXOS_VALUES, confirmed)
+                cursor.execute(sql, params + [network])
+                account_ids.update(account_id for account_id, in cursor.fetchall())
+
+        if dropped:
+            logger.warning('removing utxos of %s %s txs dropped from the mempool: %s', len(dropped), network, dropped)
+            for query in (DROP_UNCONFIRMED_UTXOS_SQL, RESTORE_UNCONFIRMED_SPENDS_SQL):
+                cursor.execute(query, [network, dropped])
+                account_ids.update(account_id for account_id, in cursor.fetchall())
+
+    # only the txs still missing are remembered, with the time they were first missed
+    pipe = redisClient.pipeline(transaction=False)
+    pipe.delete(missing_key)
+    pending = {txid: missing_since.get(txid, now) for txid in missing if txid not in dropped}
+    pending.update((txid, missing_since[txid]) for txid in failed if txid in missing_since)
+    if pending:
+        pipe.hmset(missing_key, pending)
+    pipe.execute()
+
+    bump_account_versions(account_ids)
 
 
 @task(base=QueueOnce, once={'graceful': True})
 def refresh_chainheights():
     with connection.cursor() as cursor:
         cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY tracker_chainheight")
+    # confirmations of every cached transactions response are computed from the chain heights
+    bump_chain_version()
 
 
 def _coallate(list_a, list_b):
@@ -172,7 +314,7 @@ def _coallate(list_a, list_b):
 
 # wrapper around sync_xpub that tracks the status of the sync process
 @task(base=QueueOnce, once={'graceful': True})
-def initial_sync_xpub(xpub, network, script_type, hard_refresh, publish):
+def initial_sync_xpub(xpub, network, script_type, hard_refresh, publish, incremental=None):
     account_object, created = Account.objects.get_or_create(xpub=xpub, network=network, script_type=script_type)
     time_since_last_update = (datetime.now(timezone.utc) - account_object.updated_at).total_seconds()
 
@@ -181,10 +323,27 @@ def initial_sync_xpub(xpub, network, script_type, hard_refresh, publish):
         return
     account_object.update_sync_status('SYNCING')
 
+    # only utxo accounts with a sync checkpoint can be resynced incrementally, a hard refresh of one catches it up
+    # from the checkpoint instead of deleting its history, every other account is still refreshed from scratch
+    if incremental is None:
+        incremental = is_feature_enabled(INCREMENTAL_RESYNC)
+    incremental = incremental and network in UTXO_NETWORKS and account_object.has_sync_checkpoint()
+
     # Remove addresses, transactions, and associated data from db on hard refresh
-    if hard_refresh:
+    if hard_refresh and not incremental:
         Address.objects.filter(account=account_object).delete()
         Transaction.objects.filter(account=account_object).delete()
+        account_object.clear_sync_checkpoint()
+        Account.objects.filter(id=account_object.id).update(utxos_synced=False)
+        bump_account_versions([account_object.id])
+
+    # everything confirmed before the sync starts is covered by it, later blocks are picked up by the next one
+    sync_height = None
+    if network in UTXO_NETWORKS:
+        try:
+            sync_height = get_latest_block_height(network, ignore_cache=True)
+        except Exception as e:
+            logger.error('failed to get %s height, not checkpointing this sync: %s', network, str(e))
 
     msg = {
         'type': 'sync_xpub',
@@ -199,7 +358,16 @@ def initial_sync_xpub(xpub, network, script_type, hard_refresh, publish):
     RabbitConnection().publish(exchange=EXCHANGE_NOTIFICATIONS, routing_key='', body=json.dumps(msg))
 
     try:
-        sync_xpub(xpub, network, script_type, publish)
+        if incremental and sync_height is not None:
+            resync_xpub(account_object, sync_height, publish)
+        else:
+            sync_xpub(xpub, network, script_type, publish)
+            if network in UTXO_NETWORKS:
+                # every tx of the account went through save_utxos
+                Account.objects.filter(id=account_object.id).update(utxos_synced=True)
+
+        if sync_height is not None:
+            account_object.save_sync_checkpoint(sync_height)
     except Exception as e:
         # mark the sync as failed and rethrow the exception
         account_object = Account.objects.get(xpub=xpub, network=network, script_type=script_type)
@@ -220,6 +388,47 @@ def initial_sync_xpub(xpub, network, script_type, hard_refresh, publish):
     RabbitConnection().publish(exchange=EXCHANGE_NOTIFICATIONS, routing_key='', body=json.dumps(msg))
 
 
+def resync_xpub(account_object, sync_height, publish):
+    """ Catch a utxo account up from its sync checkpoint instead of rescanning its whole history
+
+        Only transactions confirmed after the checkpoint (less a reorg margin) are fetched for the addresses up to
+        the highest used index, then the gap limit scan continues past that index like sync_xpub does.
+    """
+    network = account_object.network
+    coinquery = get_coinquery_client(network)
+
+    max_confirmations = sync_height - account_object.synced_height + RESYNC_REORG_MARGIN
+    used_indexes = [i for i in (account_object.max_receive_index, account_object.max_change_index) if i is not None]
+    max_index = max(used_indexes) if used_indexes else -1
+
+    known_addresses = list(
+        Address.objects.filter(account=account_object, index__lte=max_index)
+        .order_by('index', 'type')
+        .values_list('address', flat=True)
+    )
+    logger.info('resyncing %s xpub %s from height %s: %s known addresses, max index %s', network,
+                account_object.id, account_object.synced_height, len(known_addresses), max_index)
+
+    raw_txs = {}
+    txs_by_address = {}
+    for x in range(0, len(known_addresses), RESYNC_CHUNK_SIZE):
+        addrs = known_addresses[x:x + RESYNC_CHUNK_SIZE]
+        transactions = coinquery.get_recent_transactions(addrs, max_confirmations)
+
+        for addr in addrs:
+            txs_by_address[addr] = {}
+
+        for tx in transactions:
+            raw_txs[tx.get('txid')] = tx
+
+        map_txs_by_address(transactions, txs_by_address=txs_by_address, filter_addresses=addrs)
+
+    # thor trade rewards should not happen with this call
+    save_results(network, known_addresses, txs_by_address, raw_txs, publish=publish)
+
+    sync_xpub(account_object.xpub, network, account_object.script_type, publish, start_index=max_index + 1)
+
+
 @task(base=QueueOnce, once={'graceful': True})
 def sync_xpub(xpub, network, script_type, publish, start_index=0):
     logger.info('syncing xpub for network %s', network)
@@ -246,6 +455,31 @@ def sync_xpub(xpub, network, script_type, publish, start_index=0):
     max_idx = start_index
     addr_chunk_size = 10
 
+    scanner = None
+    if SYNC_XPUB_SCAN_WORKERS > 0:
+        scanner = AddressScanner(coinquery, SYNC_XPUB_SCAN_WORKERS, SYNC_XPUB_CHUNK_SIZE)
+
+    try:
+        _sync_xpub_windows(network, account_object, coinquery, scanner, publish, from_index, to_index, max_idx,
+                           addr_chunk_size)
+    finally:
+        if scanner is not None:
+            scanner.close()
+
+
+def _get_window_transactions(coinquery, scanner, addresses, addr_chunk_size):
+    """ Yield (chunk of addresses, their transactions) for a gap limit window, in address order """
+    if scanner is not None:
+        yield from scanner.scan(addresses)
+        return
+
+    for x in range(0, len(addresses), addr_chunk_size):
+        addrs = addresses[x:x + addr_chunk_size]
+        yield addrs, coinquery.get_transactions(addrs, page_size=20)
+
+
+def _sync_xpub_windows(network, account_object, coinquery, scanner, publish, from_index, to_index, max_idx,
+                       addr_chunk_size):
     while True:
         addresses_to_track = {}
         raw_txs = {}
@@ -262,10 +496,7 @@ def sync_xpub(xpub, network, script_type, publish, start_index=0):
         # Pull out the first element of all the tuples into their own list:
         addresses = [ac[0] for ac in addr_change]
 
-        for x in range(0, len(addresses), addr_chunk_size):
-            addrs = addresses[x:x + addr_chunk_size]
-            transactions = coinquery.get_transactions(addrs, page_size=20)
-
+        for addrs, transactions in _get_window_transactions(coinquery, scanner, addresses, addr_chunk_size):
             for addr in addrs:
                 txs_by_address[addr] = {}
 
@@ -395,11 +626,7 @@ def watch_tx(network):
 
         txs_list = list(txs_by_txid.values())
         txs_by_address = map_txs_by_address(txs_list, txs_by_address={})
-        tx_addresses = list(txs_by_address.keys())
-        tracked_addresses = list(Address.objects.filter(
-            address__in=tx_addresses,
-            account__network=network
-        ).values_list('address', flat=True))
+        tracked_addresses = get_tracked_addresses(network, txs_by_address.keys())
 
         # thor trade rewards should not happen with this call
         save_results(network, tracked_addresses, txs_by_address, txs_by_txid)
@@ -462,6 +689,8 @@ def sync_tendermint_account(network, account_object):
     for tx in gaia.get_transactions(address):
         save_tx(tx)
 
+    bump_account_versions([account_object.id])
+
 
 # Assumptions:
 # no transactions occurred after sync started and before it finished
@@ -497,6 +726,8 @@ def sync_binance_account(account_object):
     for tx in binance_client.get_txs_for_address(address):
         save_tx(tx)
 
+    bump_account_versions([account_object.id])
+
 
 # Assumptions:
 # no transactions occurred after sync started and before it finished
@@ -529,6 +760,8 @@ def sync_ripple_account(account_object):
     for tx in ripple.get_transactions_by_account(address):
         save_tx(tx)
 
+    bump_account_versions([account_object.id])
+
 
 # Assumptions:
 # no transactions occurred after sync started and before it finished
@@ -561,6 +794,8 @@ def sync_fio_account(account_object):
     for tx in fio.get_transactions_by_pubkey(address):
         save_tx(tx)
 
+    bump_account_versions([account_object.id])
+
 
 # Assumptions:
 # no transactions occurred after sync started and before it finished
@@ -593,6 +828,8 @@ def sync_eos_account(account_object):
     for tx in eos_client.get_account_tx(address):
         save_tx(tx)
 
+    bump_account_versions([account_object.id])
+
 
 # Assumptions:
 # no transactions occurred after sync started and before it finished
@@ -830,109 +1067,75 @@ def sync_ethereum_account(account_object):
                     amount=initial_balance
                 )
 
+    bump_account_versions([account_object.id])
 
-def get_fee(tx):
-    vin = tx.get('vin')
-    vout = tx.get('vout')
-    total_in = 0
-    total_out = 0
-
-    if vin is not None:
-        for tx_in in vin:
-            satoshis = tx_in.get('valueSat', 0)
-            total_in += satoshis
-    if vout is not None:
-        for tx_out in vout:
-            satoshis = int(Decimal(tx_out.get('value', 0)).quantize(Decimal(10) ** -8) * (10 ** 8))
-            total_out += satoshis
-    return total_in - total_out
-
-
-def map_txs_by_address(txs, txs_by_address={}, filter_addresses=[]):
-    for tx in txs:
-        txid = tx.get('txid')
-        vin = tx.get('vin')
-        vout = tx.get('vout')
-
-        for tx_in in vin:
-            address = tx_in.get('addr')
-            satoshis = tx_in.get('valueSat', 0)
-
-            if not address:  # skip coinbase inputs
-                continue
 
-            should_include_address = (not filter_addresses) or address in filter_addresses
-            if address not in txs_by_address and should_include_address:
-                txs_by_address[address] = {}
+def get_fee(tx):
+    return decode_tx(tx).fee
 
-            if (filter_addresses and address in filter_addresses) or (
-                    not filter_addresses and address in txs_by_address):  # noqa
-                txs_by_address[address][txid] = txs_by_address[address].setdefault(txid, 0) - satoshis  # noqa
 
-        for tx_out in vout:
-            for address in tx_out['scriptPubKey'].get('addresses', []):
-                if (not filter_addresses) or address in filter_addresses:
-                    if address not in txs_by_address:
-                        txs_by_address[address] = {}
+def _get_tx_fields(network, raw_tx):
+    """ Extract the tracker_transaction columns for a raw insight tx """
+    # if we have a block_hash but not the blockheight (coinquery doge does not return blockheight)
+    # then we need to look up the height
+    if raw_tx.get('blockhash') and not raw_tx.get('blockheight'):
+        try:
+            coinquery = get_coinquery_client(network)
+            block = coinquery.get_block_by_hash(raw_tx.get('blockhash'))
+            raw_tx['blockheight'] = block.get('height')
+        except Exception as e:
+            logger.error("Unable to fetch blockheight for block: %s", str(raw_tx.get('blockhash')), extra=e)
+
+    # Extract thor memo from bitcoin op_return output if it exists on the transaction
+    thor_memo = None
+    try:
+        if raw_tx['vout'] is not None:
+            for i in raw_tx['vout']:
+                if 'OP_RETURN' in i['scriptPubKey']['asm']:
+                    hex_data = i['scriptPubKey']['asm'].split()[1]
+                    thor_memo = str(bytearray.fromhex(hex_data).decode())
+    except Exception as e:
+        logger.error("Exception decoding thor memo: %s", e)
 
-                    satoshis = int(Decimal(tx_out.get('value')).quantize(Decimal(10) ** -8) * (10 ** 8))  # noqa
-                    txs_by_address[address][txid] = txs_by_address[address].setdefault(txid, 0) + satoshis  # noqa
+    fee = get_fee(raw_tx)
 
-    return txs_by_address
+    try:
+        if thor_memo is None or thor_memo.startswith('omni'):
+            thor_memo= ''
+    except Exception as e:
+        logger.error("Exception omni thor memo: %s", e)
+        thor_memo= ''
+
+    return {
+        'block_hash': raw_tx.get('blockhash'),
+        'block_time': datetime.fromtimestamp(raw_tx.get('blocktime'), timezone.utc) if raw_tx.get(
+            'blocktime') else None,
+        'block_height': raw_tx.get('blockheight', 0),
+        'thor_memo': thor_memo,
+        'fee': str(fee)
+    }
 
 
-def save_results(network, addresses, txs_by_address, raw_txs, publish=True, thor_trade_reward=False):
-    # map txs for rabbit notifications
-    rabbitTransactions = {}
+def _save_results_per_row(network, addresses, txs_by_address, raw_txs):
+    """ Upsert each (address, txid) with the orm, returns the saved rows and (txs upserted, balance changes inserted)
+    """
+    saved = []
+    tx_written = set()
+    balance_changes_inserted = 0
+    tx_fields = {}
 
     for address in addresses:
         address_obj = Address.objects.get(address=address, account__network=network)
         account = address_obj.account
 
         for txid, balance_change in txs_by_address[address].items():
-
-            raw_tx = raw_txs[txid]
-            # if we have a block_hash but not the blockheight (coinquery doge does not return blockheight)
-            # then we need to look up the height
-            if raw_tx.get('blockhash') and not raw_tx.get('blockheight'):
-                try:
-                    coinquery = get_coinquery_client(network)
-                    block = coinquery.get_block_by_hash(raw_tx.get('blockhash'))
-                    raw_tx['blockheight'] = block.get('height')
-                except Exception as e:
-                    logger.error("Unable to fetch blockheight for block: %s", str(raw_tx.get('blockhash')), extra=e)
-
-            # Extract thor memo from bitcoin op_return output if it exists on the transaction
-            thor_memo = None
-            try:
-                if raw_tx['vout'] is not None:
-                    for i in raw_tx['vout']:
-                        if 'OP_RETURN' in i['scriptPubKey']['asm']:
-                            hex_data = i['scriptPubKey']['asm'].split()[1]
-                            thor_memo = str(bytearray.fromhex(hex_data).decode())
-            except Exception as e:
-                logger.error("Exception decoding thor memo: %s", e)
-
-            fee = get_fee(raw_tx)
-
-            try:
-                if thor_memo is None or thor_memo.startswith('omni'):
-                    thor_memo= ''
-            except Exception as e:
-                logger.error("Exception omni thor memo: %s", e)
-                thor_memo= ''
+            if txid not in tx_fields:
+                tx_fields[txid] = _get_tx_fields(network, raw_txs[txid])
 
             tx_obj, tx_created = Transaction.objects.update_or_create(
                 txid=txid,
                 account=account,
-                defaults={
-                    'block_hash': raw_tx.get('blockhash'),
-                    'block_time': datetime.fromtimestamp(raw_tx.get('blocktime'), timezone.utc) if raw_tx.get(
-                        'blocktime') else None,
-                    'block_height': raw_tx.get('blockheight', 0),
-                    'thor_memo': thor_memo,
-                    'fee': str(fee)
-                }
+                defaults=tx_fields[txid]
             )
 
             balance_change_obj, bc_created = BalanceChange.objects.update_or_create(
@@ -942,46 +1145,189 @@ def save_results(network, addresses, txs_by_address, raw_txs, publish=True, thor
                 amount=balance_change
             )
 
-            if publish:
-                # keep track of what messages we need to push to rabbit
-                # need combined dict key in case of multiple tx's in same block with same xpub
-                key = account.xpub + txid
-                if rabbitTransactions.get(key, None) is None:
-                    msg = {}
-                    msg["txid"] = txid
-                    msg["network"] = network
-                    msg["symbol"] = network
-                    msg["xpub"] = account.xpub
-                    msg["balance_change"] = balance_change
-                    msg["blockheight"] = raw_txs[txid].get('blockheight', 0)
-                    msg["blocktime"] = raw_txs[txid].get('blocktime')
-                    msg["confirmations"] = raw_txs[txid].get('confirmations', 0)
-                    # add thor trade details if reward is enabled
-                    if thor_trade_reward:
-                        memo_prefix_out = 'OUT:'
-                        if thor_memo and memo_prefix_out in thor_memo:
-                            sell_txid = thor_memo[len(memo_prefix_out):]
-                            thor_tx = thorchain.get_valid_transaction(txid=sell_txid)
-                            if thor_tx:
-                                msg = {**msg, **thor_tx}
-                    rabbitTransactions[key] = msg
-                else:
-                    # merge the balance_changes so that we don't double notify for change addresses
-                    rabbitTransactions[key]["balance_change"] += balance_change
-
-    if publish:
-        # publish to rabbit
-        logger.info("Rabbit messages: %s", list(rabbitTransactions.values()))
-        for k, v in rabbitTransactions.items():
-            msg = v
-            txType = "receive" if msg["balance_change"] > 0 else "send"
-            msg['type'] = txType
-            RabbitConnection().publish(
-                exchange=EXCHANGE_TXS,
-                routing_key='',
-                message_type='event.platform.transaction',
-                body=json.dumps(msg)
-            )
+            tx_written.add(tx_obj.id)
+            balance_changes_inserted += int(bc_created)
+            saved.append((account, txid, balance_change, tx_fields[txid]['thor_memo']))
+
+    return saved, (len(tx_written), balance_changes_inserted)
+
+
+def _save_results_bulk(network, addresses, txs_by_address, raw_txs):
+    """ Upsert all (address, txid) pairs with one statement per table in a single db transaction,
+        returns the saved rows and (txs upserted, balance changes inserted)
+    """
+    saved = []
+    tx_fields = {}
+    tx_rows = {}  # {(<txid>, <account_id>): <row>}, an account can see the same txid on several addresses
+    balance_change_rows = []
+
+    address_objs = {}
+    for address_obj in Address.objects.filter(address__in=list(addresses), account__network=network) \
+            .select_related('account'):
+        if address_obj.address in address_objs:
+            raise Address.MultipleObjectsReturned('{} is tracked by multiple {} accounts'.format(
+                address_obj.address, network))
+        address_objs[address_obj.address] = address_obj
+
+    for address in addresses:
+        address_obj = address_objs.get(address)
+        if address_obj is None:
+            raise Address.DoesNotExist('{} is not tracked for {}'.format(address, network))
+        account = address_obj.account
+
+        for txid, balance_change in txs_by_address[address].items():
+            if txid not in tx_fields:
+                tx_fields[txid] = _get_tx_fields(network, raw_txs[txid])
+
+            fields = tx_fields[txid]
+            tx_rows[(txid, account.id)] = (txid, account.id, fields['block_hash'], fields['block_time'],
+                                           fields['block_height'], fields['thor_memo'], fields['fee'])
+            balance_change_rows.append((account.id, address_obj.id, txid, balance_change))
+            saved.append((account, txid, balance_change, fields['thor_memo']))
+
+    if not tx_rows:
+        return saved, (0, 0)
+
+    with db_transaction.atomic(), connection.cursor() as cursor:
+        sql, params = values_sql(BULK_UPSERT_TRANSACTIONS_SQL, BULK_UPSERT_TRANSACTIONS_VALUES,
+                                 list(tx_rows.values()))
+        cursor.execute(sql, params)
+        tx_ids = {(txid, account_id): tx_id for tx_id, txid, account_id in cursor.fetchall()}
+        sql, params = values_sql(BULK_INSERT_BALANCE_CHANGES_SQL, BULK_INSERT_BALANCE_CHANGES_VALUES,
+                                 [(account_id, address_id, tx_ids[(txid, account_id)], balance_change)
+                                  for account_id, address_id, txid, balance_change in balance_change_rows])
+        cursor.execute(sql, params)
+        rows_written = (len(tx_ids), cursor.rowcount)
+
+    return saved, rows_written
+
+
+def save_utxos(network, addresses, raw_txs):
+    """ Record the outputs raw_txs pay to addresses in tracker_utxo and mark the ones their inputs spend """
+    address_ids = {
+        address: (address_id, account_id)
+        for address, address_id, account_id in Address.objects.filter(
+            address__in=list(addresses), account__network=network
+        ).values_list('address', 'id', 'account_id')
+    }
+    if not address_ids:
+        return
+
+    outputs = {}  # {(<account_id>, <txid>, <vout>): <row>}, keyed so each row is upserted once per statement
+    spends = {}
+    max_height = None
+    for txid, tx in raw_txs.items():
+        block_hash = tx.get('blockhash')
+        block_height = tx.get('blockheight') if block_hash else None
+        if block_height is not None:
+            max_height = max(max_height or block_height, block_height)
+
+        for tx_in in tx.get('vin') or []:
+            ids = address_ids.get(tx_in.get('addr'))
+            if ids and tx_in.get('txid'):
+                address_id, account_id = ids
+                spends[(account_id, tx_in['txid'], tx_in['vout'])] = (
+                    account_id, address_id, tx_in['txid'], tx_in['vout'], tx_in.get('valueSat', 0), txid, block_hash,
+                    block_height)
+
+        for n, tx_out in enumerate(tx.get('vout') or []):
+            # multisig outputs are credited to every address by map_txs_by_address but none can spend them alone
+            out_addresses = tx_out['scriptPubKey'].get('addresses', [])
+            ids = address_ids.get(out_addresses[0]) if len(out_addresses) == 1 else None
+            if ids:
+                address_id, account_id = ids
+                vout = tx_out.get('n', n)
+                outputs[(account_id, txid, vout)] = (
+                    account_id, address_id, txid, vout, parse_satoshis(tx_out.get('value')), block_hash, block_height)
+
+    if not outputs and not spends:
+        return
+
+    # sorted so concurrent writers lock rows in the same order
+    with db_transaction.atomic(), connection.cursor() as cursor:
+        if outputs:
+            sql, params = values_sql(UPSERT_UTXOS_SQL, UPSERT_UTXOS_VALUES,
+                                     [row for _, row in sorted(outputs.items())])
+            cursor.execute(sql, params)
+
+        if spends:
+            sql, params = values_sql(SPEND_UTXOS_SQL, SPEND_UTXOS_VALUES, [row for _, row in sorted(spends.items())])
+            cursor.execute(sql, params)
+
+        if max_height is not None:
+            account_ids = sorted({account_id for _, account_id in address_ids.values()})
+            cursor.execute(PRUNE_SPENT_UTXOS_SQL, [account_ids, max_height - UTXO_PRUNE_DEPTH])
+
+
+def save_results(network, addresses, txs_by_address, raw_txs, publish=True, thor_trade_reward=False):
+    start = current_time_millis()
+    mode = 'per-row'
+
+    # the utxos are written with the txs they come from, a sync that completes has recorded every output of its txs
+    with db_transaction.atomic():
+        saved = None
+        if is_feature_enabled(BULK_SAVE_RESULTS):
+            try:
+                saved, rows_written = _save_results_bulk(network, addresses, txs_by_address, raw_txs)
+                mode = 'bulk'
+            except Exception as e:
+                logger.error('bulk save_results failed for %s, falling back to per-row: %s', network, str(e))
+
+        if saved is None:
+            saved, rows_written = _save_results_per_row(network, addresses, txs_by_address, raw_txs)
+
+        save_utxos(network, addresses, raw_txs)
+
+    # both modes count each (txid, account) transaction upserted once and only the balance changes inserted
+    logger.info('save_results (%s) upserted %s txs and inserted %s balance changes for %s in %sms', mode,
+                rows_written[0], rows_written[1], network, (current_time_millis() - start))
+    bump_account_versions({account.id for account, _, _, _ in saved})
+
+    if not publish:
+        return
+
+    # map txs for rabbit notifications
+    rabbitTransactions = {}
+
+    for account, txid, balance_change, thor_memo in saved:
+        # keep track of what messages we need to push to rabbit
+        # need combined dict key in case of multiple tx's in same block with same xpub
+        key = account.xpub + txid
+        if rabbitTransactions.get(key, None) is None:
+            msg = {}
+            msg["txid"] = txid
+            msg["network"] = network
+            msg["symbol"] = network
+            msg["xpub"] = account.xpub
+            msg["balance_change"] = balance_change
+            msg["blockheight"] = raw_txs[txid].get('blockheight', 0)
+            msg["blocktime"] = raw_txs[txid].get('blocktime')
+            msg["confirmations"] = raw_txs[txid].get('confirmations', 0)
+            # add thor trade details if reward is enabled
+            if thor_trade_reward:
+                memo_prefix_out = 'OUT:'
+                if thor_memo and memo_prefix_out in thor_memo:
+                    sell_txid = thor_memo[len(memo_prefix_out):]
+                    thor_tx = thorchain.get_valid_transaction(txid=sell_txid)
+                    if thor_tx:
+                        msg = {**msg, **thor_tx}
+            rabbitTransactions[key] = msg
+        else:
+            # merge the balance_changes so that we don't double notify for change addresses
+            rabbitTransactions[key]["balance_change"] += balance_change
+
+    # publish to rabbit
+    logger.info("Rabbit messages: %s", list(rabbitTransactions.values()))
+    for k, v in rabbitTransactions.items():
+        msg = v
+        txType = "receive" if msg["balance_change"] > 0 else "send"
+        msg['type'] = txType
+        RabbitConnection().publish(
+            exchange=EXCHANGE_TXS,
+            routing_key='',
+            message_type='event.platform.transaction',
+            body=json.dumps(msg)
+        )
 
 @task(base=QueueOnce, once={'graceful': True})
 def sync_blocks_eth():
@@ -2,6 +2,7 @@ from celery import task
 from celery_once import QueueOnce
 
 from tracker.models import AccountBalance, Address
+from common.services.account_versions import bump_account_versions
 from common.services import get_gaia_client
 from common.utils.utils import current_time_millis
 
@@ -29,6 +30,7 @@ def sync_account_balances(network, address):
             'balance': balance
         }
     )
+    bump_account_versions([account.id])
 
     logger.info('synced %s balances for %s, balance = %s in %sms',
                 network, address, balance, (current_time_millis() - start))
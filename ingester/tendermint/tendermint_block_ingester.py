@@ -1,5 +1,7 @@
 from common.utils.ethereum import format_address as to_checksum_address
 from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock
+from common.services.account_versions import bump_account_versions
+from tracker.address_filter import get_tracked_addresses
 from common.utils.utils import timestamp_to_unix
 from common.services.gaia_tendermint import get_client as get_gaia_client
 from common.services.rabbitmq import RabbitConnection, EXCHANGE_BLOCKS, EXCHANGE_TXS
@@ -185,9 +187,8 @@ class TendermintBlockIngester:
                 addresses.add(parsed_tx.get('to'))
 
         # find intersection of addresses in block and addresses we know about
-        known_addresses = Address.objects.filter(
-            address__in=list(addresses)
-        ).values_list('address', flat=True)
+        # only addresses tracked on this network are saved, so the network's prefilter applies
+        known_addresses = set(get_tracked_addresses(self.network, addresses, queryset=Address.objects.all()))
 
         # filter list of transactions down to those we care about
         transactions = list(filter(lambda t: t.get('from') in known_addresses
@@ -290,6 +291,9 @@ class TendermintBlockIngester:
 
                 rabbit_transactions.append(msg)
 
+        bump_account_versions(
+            Address.objects.filter(address__in=list(tx_by_address)).values_list('account_id', flat=True))
+
         # publish to rabbit
         for msg in rabbit_transactions:
             RabbitConnection().publish(exchange=EXCHANGE_TXS, routing_key='', message_type='event.platform.transaction',
@@ -1,12 +1,24 @@
 import json
 
 from django.test import TestCase
+from hexbytes import HexBytes
 from unittest import mock
-from common.services.rabbitmq import RabbitConnection, EXCHANGE_TXS
-
-from ingester.tasks import sync_blocks, sync_block, sync_xpub, initial_sync_xpub
-from tracker.models import ProcessedBlock, Account, Address, ERC20Token, BalanceChange, Transaction
+from common.services.chain_cache import ChainCache
+from common.services.coinquery import CoinQueryClient
+from common.services.rabbitmq import RabbitConnection, EXCHANGE_TXS, EXCHANGE_BLOCKS
+from common.services.redis import UTXO_MISSING_TXS_PREFIX
+
+from ingester.tasks import sync_blocks, sync_block, sync_xpub, initial_sync_xpub, resync_xpub, save_results, \
+    save_utxos, map_txs_by_address, reconcile_unconfirmed_utxos
+from ingester.xpub_scanner import AddressScanner
+from ingester.eth.block_logs import BlockLogs
+from ingester.eth.receipts import BlockReceipts
+from ingester.eth.transfer_filter import TrackedTransferFilter, address_topic
+from ingester.eth.erc20_tokens import TokenCache, TokenMetadata
+from ingester.eth.balance_refresh import BalanceRefreshes, BALANCE_REFRESH_DEBOUNCE
+from tracker.models import ProcessedBlock, Account, Address, ERC20Token, BalanceChange, Transaction, Utxo
 from common.utils.networks import SUPPORTED_NETWORKS, ETH, BCH
+from common.utils.requests import HTTPError
 
 ROOT_582697 =   '000000000000000000b727132c210aa2ec9ccdcc9f17e8a4dda4cdc7400add71'
 ORPHAN_582698 = '0000000000000000013821c4378e842401ac54371a8afa81777327266bf418af'
@@ -69,7 +81,7 @@ VALID_ETH_FIXTURES = {
 
 
 # Define mock responses for coinquery get_block_by_hash API calls:
-def mocked_blocks_by_hash(block_hash):
+def mocked_blocks_by_hash(block_hash, cached=True):
     with open(VALID_BLOCK_FIXTURES[block_hash]) as block_file:
         block = json.load(block_file)
         return block
@@ -171,6 +183,288 @@ class SyncBlocksWithNoProcessedBlocksTest(TestCase):
                 block.block_hash, starting_hash)
 
 
+class SyncBlocksPrefetchTest(TestCase):
+    @mock.patch('ingester.tasks.SYNC_BLOCKS_PREFETCH_DEPTH', 2)
+    @mock.patch('ingester.tasks.RabbitConnection')
+    @mock.patch('common.services.coinquery.CoinQueryClient.get_block_by_hash')
+    @mock.patch('common.services.coinquery.CoinQueryClient.get_transactions_by_block_hash')
+    def test_sync_blocks_in_order(self, mock_get_transactions_by_block_hash, mock_get_block_by_hash, mock_rabbit):
+        block_hashes = [
+            '0000000000000000001153f0e26631565d174286327a2afd50f6f5103985c687',
+            '0000000000000000001567e1f77d087d56e991c5abfdfaeb6fa06059953780c8',
+            '0000000000000000000567a7ca994a0a5749344142325d4c6e90e6b8835ed835',
+        ]
+
+        # link the btc fixtures into a chain that ends at the last one
+        def mocked_chain(block_hash, cached=True):
+            block = mocked_blocks_by_hash(block_hash)
+            idx = block_hashes.index(block_hash)
+            block['nextblockhash'] = block_hashes[idx + 1] if idx + 1 < len(block_hashes) else None
+            return block
+
+        mock_get_transactions_by_block_hash.side_effect = mocked_txs_by_hash
+        mock_get_block_by_hash.side_effect = mocked_chain
+
+        sync_blocks('BTC', block_hashes[0])
+
+        # each block is fetched once by the prefetcher and reused for the ProcessedBlock
+        self.assertEqual(mock_get_block_by_hash.call_count, len(block_hashes))
+
+        published = [json.loads(c[1]['body'])['hash'] for c in mock_rabbit.return_value.publish.call_args_list
+                     if c[1]['exchange'] == EXCHANGE_BLOCKS]
+        self.assertListEqual(published, block_hashes)
+
+        processed = ProcessedBlock.objects.filter(network='BTC').order_by('block_height')
+        self.assertListEqual([block.block_hash for block in processed], block_hashes)
+
+
+class BlockLogsTest(TestCase):
+    TRANSFER = '0x' + 'aa' * 32
+    DEPOSIT = '0x' + 'bb' * 32
+
+    @staticmethod
+    def _log(height, topics, block_hash=None):
+        return {
+            'blockNumber': height,
+            'blockHash': HexBytes(block_hash or '0x{:064x}'.format(height)),
+            'topics': [HexBytes(topic) for topic in topics],
+        }
+
+    @staticmethod
+    def _block(height, block_hash=None):
+        return {'number': height, 'hash': HexBytes(block_hash or '0x{:064x}'.format(height))}
+
+    def setUp(self):
+        self.block_logs = BlockLogs({self.TRANSFER: 3, self.DEPOSIT: 1})
+        patcher = mock.patch('ingester.eth.block_logs.web3.eth')
+        self.eth = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_call_per_block_split_by_topic(self):
+        address = '0x' + '00' * 32
+        transfer, short_transfer, deposit = (
+            self._log(5, [self.TRANSFER, address, address]),
+            self._log(5, [self.TRANSFER]),
+            self._log(5, [self.DEPOSIT]),
+        )
+        self.eth.getLogs.return_value = [transfer, short_transfer, deposit]
+
+        logs = self.block_logs.for_block(self._block(5))
+
+        self.eth.getLogs.assert_called_once_with({
+            'fromBlock': 5, 'toBlock': 5, 'topics': [[self.TRANSFER, self.DEPOSIT]]
+        })
+        # transfers indexing fewer than 3 topics never matched the erc20 filter
+        self.assertDictEqual(logs, {self.TRANSFER: [transfer], self.DEPOSIT: [deposit]})
+
+    @mock.patch('ingester.eth.block_logs.ETH_LOGS_RANGE', 3)
+    @mock.patch('ingester.eth.block_logs.ETH_LOGS_RANGE_CONFIRMATIONS', 2)
+    def test_range_during_catch_up(self):
+        deposits = {height: self._log(height, [self.DEPOSIT]) for height in range(10, 13)}
+        self.eth.getLogs.return_value = list(deposits.values())
+
+        for height in range(10, 13):
+            self.assertListEqual(self.block_logs.for_block(self._block(height), head=20)[self.DEPOSIT], [deposits[height]])
+        self.eth.getLogs.assert_called_once_with({
+            'fromBlock': 10, 'toBlock': 12, 'topics': [[self.TRANSFER, self.DEPOSIT]]
+        })
+
+        # blocks close to the head are fetched one at a time
+        self.eth.getLogs.reset_mock()
+        self.eth.getLogs.return_value = []
+        self.block_logs.for_block(self._block(19), head=20)
+        self.eth.getLogs.assert_called_once_with({
+            'fromBlock': 19, 'toBlock': 19, 'topics': [[self.TRANSFER, self.DEPOSIT]]
+        })
+
+    @mock.patch('ingester.eth.block_logs.ETH_LOGS_RANGE', 3)
+    @mock.patch('ingester.eth.block_logs.ETH_LOGS_RANGE_CONFIRMATIONS', 2)
+    def test_prefetched_logs_of_another_block_are_fetched_again(self):
+        other_hash = '0x' + 'cc' * 32
+        self.eth.getLogs.side_effect = [[self._log(10, [self.DEPOSIT], other_hash)], []]
+
+        logs = self.block_logs.for_block(self._block(10), head=20)
+
+        self.assertListEqual(logs[self.DEPOSIT], [])
+        self.assertEqual(self.eth.getLogs.call_count, 2)
+
+
+class BlockReceiptsTest(TestCase):
+    TXIDS = ['0x' + 'aa' * 32, '0x' + 'bb' * 32]
+
+    @staticmethod
+    def _receipt(txid):
+        return {'transactionHash': txid, 'status': '0x1', 'gasUsed': '0x5208', 'from': '0x' + '11' * 20, 'logs': []}
+
+    @mock.patch('ingester.eth.receipts.web3')
+    @mock.patch('ingester.eth.receipts.ethereum_json_rpc')
+    def test_receipts_fetched_once_in_one_batch(self, mock_json_rpc, mock_web3):
+        mock_json_rpc.batch.return_value = [{'result': self._receipt(txid)} for txid in self.TXIDS]
+        receipts = BlockReceipts({'number': 10})
+
+        receipts.prefetch(self.TXIDS + [self.TXIDS[0].upper().replace('0X', '0x')])
+        receipts.prefetch(self.TXIDS)
+
+        mock_json_rpc.batch.assert_called_once_with([('eth_getTransactionReceipt', [txid]) for txid in self.TXIDS])
+        receipt = receipts.get(self.TXIDS[1])
+        # formatted by web3 like a receipt it fetched itself
+        self.assertEqual(receipt.status, 1)
+        self.assertEqual(receipt.get('gasUsed'), 21000)
+        mock_web3.eth.getTransactionReceipt.assert_not_called()
+
+    @mock.patch('ingester.eth.receipts.web3')
+    @mock.patch('ingester.eth.receipts.ethereum_json_rpc')
+    def test_failed_receipts_are_fetched_one_at_a_time(self, mock_json_rpc, mock_web3):
+        mock_json_rpc.batch.return_value = [{'result': self._receipt(self.TXIDS[0])}, {'error': {'code': -32000}}]
+        receipts = BlockReceipts({'number': 10})
+
+        receipts.prefetch(self.TXIDS)
+
+        self.assertEqual(receipts.get(self.TXIDS[1]), mock_web3.eth.getTransactionReceipt.return_value)
+        mock_web3.eth.getTransactionReceipt.assert_called_once_with(self.TXIDS[1])
+
+
+class TrackedTransferFilterTest(TestCase):
+    TRANSFER = '0x' + 'aa' * 32
+    TRACKED = ['0x' + 'A1' * 20, '0x' + 'B2' * 20, '0x' + 'C3' * 20]
+
+    def setUp(self):
+        account = Account.objects.create(xpub='xpub-transfers', network=ETH, script_type='eth')
+        for idx, address in enumerate(self.TRACKED):
+            Address.objects.create(address=address, account=account, type=Address.RECEIVE,
+                                   relpath='0/{}'.format(idx), index=idx)
+
+        patcher = mock.patch('ingester.eth.transfer_filter.is_feature_enabled', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.transfer_filter = TrackedTransferFilter()
+
+    @mock.patch('ingester.eth.transfer_filter.ETH_TRANSFER_FILTER_CHUNK_SIZE', 2)
+    @mock.patch('ingester.eth.transfer_filter.web3.eth')
+    def test_logs_of_tracked_addresses_in_chunks(self, mock_eth):
+        between_tracked, to_tracked = {'logIndex': 4}, {'logIndex': 1}
+        mock_eth.getLogs.side_effect = [[between_tracked], [between_tracked, to_tracked], [], []]
+        block_hash = '0x' + 'dd' * 32
+
+        self.assertTrue(self.transfer_filter.enabled())
+        logs = self.transfer_filter.get_logs({'hash': HexBytes(block_hash)}, self.TRANSFER)
+
+        topics = sorted(address_topic(address) for address in self.TRACKED)
+        self.assertEqual(topics[0], '0x' + '00' * 12 + 'a1' * 20)
+        mock_eth.getLogs.assert_has_calls([
+            mock.call({'blockHash': block_hash, 'topics': [self.TRANSFER, topics[:2], None]}),
+            mock.call({'blockHash': block_hash, 'topics': [self.TRANSFER, None, topics[:2]]}),
+            mock.call({'blockHash': block_hash, 'topics': [self.TRANSFER, topics[2:], None]}),
+            mock.call({'blockHash': block_hash, 'topics': [self.TRANSFER, None, topics[2:]]}),
+        ])
+        # deduplicated and in block order
+        self.assertListEqual(logs, [to_tracked, between_tracked])
+        self.assertTrue(self.transfer_filter.is_tracked(self.TRACKED[0].lower()))
+
+    @mock.patch('ingester.eth.transfer_filter.ETH_TRANSFER_FILTER_MAX_ADDRESSES', 2)
+    def test_full_scan_when_too_many_addresses_are_tracked(self):
+        self.assertFalse(self.transfer_filter.enabled())
+
+
+class TokenCacheTest(TestCase):
+    KNOWN = '0x' + 'aa' * 20
+    UNKNOWN = '0x' + 'bb' * 20
+    BROKEN = '0x' + 'cc' * 20
+
+    @staticmethod
+    def _string(value):
+        data = value.encode('utf-8')
+        return '0x' + '{:064x}'.format(32) + '{:064x}'.format(len(data)) + data.hex().ljust(64, '0')
+
+    def setUp(self):
+        ERC20Token.objects.create(contract_address=self.KNOWN, name='Known', symbol='KNW', precision=18)
+
+        patcher = mock.patch('ingester.eth.erc20_tokens.redisClient')
+        self.redis = patcher.start()
+        self.redis.mget.side_effect = lambda keys: [None] * len(keys)
+        self.addCleanup(patcher.stop)
+
+        self.token_cache = TokenCache()
+
+    def test_known_tokens_are_served_from_memory(self):
+        token = self.token_cache.get_many([self.KNOWN.upper().replace('0X', '0x')])[self.KNOWN]
+        self.assertEqual((token.symbol, token.precision), ('KNW', 18))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.token_cache.get_many([self.KNOWN]), {self.KNOWN: token})
+        self.redis.mget.assert_called_once()
+
+    @mock.patch('ingester.eth.erc20_tokens.ethereum_json_rpc')
+    def test_unknown_tokens_are_resolved_in_one_batch(self, mock_json_rpc):
+        mock_json_rpc.batch.return_value = [
+            {'result': self._string('Unknown')}, {'result': self._string('UNK')}, {'result': '0x' + '{:064x}'.format(6)},
+            {'error': {'code': -32000}}, {'result': '0x'}, {'result': '0x'},
+        ]
+
+        tokens, unresolved = self.token_cache.resolve([self.KNOWN, self.UNKNOWN, self.BROKEN])
+
+        self.assertEqual(mock_json_rpc.batch.call_count, 1)
+        self.assertEqual(len(mock_json_rpc.batch.call_args[0][0]), 6)
+        self.assertEqual((tokens[self.UNKNOWN].name, tokens[self.UNKNOWN].symbol, tokens[self.UNKNOWN].precision),
+                         ('Unknown', 'UNK', 6))
+        self.assertTrue(ERC20Token.objects.filter(contract_address=self.UNKNOWN).exists())
+        # left to resolve_erc20_token
+        self.assertListEqual(unresolved, [self.BROKEN])
+        self.assertNotIn(self.BROKEN, tokens)
+
+
+@mock.patch('ingester.eth.balance_refresh.is_feature_enabled', return_value=True)
+@mock.patch('ingester.eth.balance_refresh.sync_eth_token_balance')
+@mock.patch('ingester.eth.balance_refresh.sync_eth_account_balances')
+@mock.patch('ingester.eth.balance_refresh.redisClient')
+class BalanceRefreshesTest(TestCase):
+    ADDRESS = '0x' + 'A1' * 20
+    TOKEN = TokenMetadata(1, '0x' + 'bb' * 20, 'Token', 'TKN', 18)
+
+    def test_one_refresh_per_pair_and_window(self, mock_redis, mock_eth_sync, mock_token_sync, mock_enabled):
+        pipe = mock_redis.pipeline.return_value
+        # eth is refreshed right away, the token already was in this window and gets a trailing refresh
+        pipe.execute.side_effect = [[True, None], [True], [2, 2]]
+
+        refreshes = BalanceRefreshes()
+        for _ in range(2):
+            refreshes.add(7, self.ADDRESS, self.TOKEN)
+
+        self.assertEqual(refreshes.schedule(), 2)
+        mock_eth_sync.s.assert_called_once_with(self.ADDRESS, False)
+        mock_eth_sync.s.return_value.apply_async.assert_called_once_with()
+        mock_token_sync.s.assert_called_once_with(7, self.ADDRESS, 'TKN', self.TOKEN.contract_address)
+        mock_token_sync.s.return_value.apply_async.assert_called_once_with(countdown=BALANCE_REFRESH_DEBOUNCE)
+        pipe.set.assert_any_call('watchtower:balance_refresh:{}:{}:trailing'.format(
+            self.ADDRESS, self.TOKEN.contract_address), 1, nx=True, ex=BALANCE_REFRESH_DEBOUNCE)
+        pipe.incrby.assert_any_call('watchtower:metrics:balance_refreshes:suppressed', 2)
+
+    def test_pairs_refreshed_in_the_window_are_suppressed(self, mock_redis, mock_eth_sync, mock_token_sync, mock_enabled):
+        mock_redis.pipeline.return_value.execute.side_effect = [[None], [None], [0, 1]]
+
+        refreshes = BalanceRefreshes()
+        refreshes.add(7, self.ADDRESS)
+
+        self.assertEqual(refreshes.schedule(), 0)
+        mock_eth_sync.s.return_value.apply_async.assert_not_called()
+        mock_token_sync.s.assert_not_called()
+
+    def test_deduplicated_syncs_are_counted_without_the_flag(self, mock_redis, mock_eth_sync, mock_token_sync,
+                                                            mock_enabled):
+        mock_enabled.return_value = False
+        pipe = mock_redis.pipeline.return_value
+
+        refreshes = BalanceRefreshes()
+        for _ in range(3):
+            refreshes.add(7, self.ADDRESS, self.TOKEN)
+
+        self.assertEqual(refreshes.schedule(), 2)
+        pipe.set.assert_not_called()
+        pipe.incrby.assert_any_call('watchtower:metrics:balance_refreshes:scheduled', 2)
+        pipe.incrby.assert_any_call('watchtower:metrics:balance_refreshes:suppressed', 4)
+
+
 class SyncBlockTest(TestCase):
     @mock.patch('common.services.coinquery.CoinQueryClient.get_block_by_hash')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_transactions_by_block_hash')
@@ -205,10 +499,12 @@ class SyncBlockTest(TestCase):
 
 
 class SyncBlocksReorgTest(TestCase):
+    @mock.patch('common.services.coinquery.CoinQueryClient.get_last_block_hash')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_block_by_hash')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_transactions_by_block_hash')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_next_block_hash')
-    def test_sync_bch_reorg(self, mock_get_next_block_hash, mock_get_transactions_by_block_hash, mock_get_block_by_hash):
+    def test_sync_bch_reorg(self, mock_get_next_block_hash, mock_get_transactions_by_block_hash, mock_get_block_by_hash,
+                            mock_get_last_block_hash):
         # Test a real reorg that happened on BCH
 
         # Common ancestor of the two chains.
@@ -236,7 +532,7 @@ class SyncBlocksReorgTest(TestCase):
         ]
 
         # Pretend that the first three of these blocks are all valid.
-        def mocked_valid_blocks(block_hash):
+        def mocked_valid_blocks(block_hash, cached=True):
             with open(VALID_BLOCK_FIXTURES[block_hash]) as block_file:
                 block = json.load(block_file)
                 block['confirmations'] = 1
@@ -257,7 +553,7 @@ class SyncBlocksReorgTest(TestCase):
             self.assertFalse(block.is_orphaned)
 
         # Now, when asked about orphaned blocks, report that they're actually orphaned.
-        def mocked_orphaned_blocks(block_hash):
+        def mocked_orphaned_blocks(block_hash, cached=True):
             with open(VALID_BLOCK_FIXTURES[block_hash]) as block_file:
                 block = json.load(block_file)
                 if block_hash == ORPHAN_582698 or block_hash == ORPHAN_582699:
@@ -267,6 +563,7 @@ class SyncBlocksReorgTest(TestCase):
                 return block
 
         mock_get_block_by_hash.side_effect = mocked_orphaned_blocks
+        mock_get_last_block_hash.return_value = REORG_582700
 
         # Then sync again from where we left off, completing the reorg.
         sync_blocks(BCH, None)
@@ -292,6 +589,182 @@ class SyncBlocksReorgTest(TestCase):
             self.assertEqual(block.is_orphaned, expected_orphanness[block.block_hash])
 
 
+class SaveResultsTest(TestCase):
+    def _save_block(self, bulk):
+        network = 'BTC'
+        account = Account.objects.create(xpub='xpub-{}'.format(bulk), network=network, script_type='p2sh-p2wpkh')
+        tracked = ['39wP9MkbVa8hLQj816vUKvztNrCriEP95b', '3BrmwguZXn1iLmECCzpmM1w67ufowe9CpK']
+        for idx, address in enumerate(tracked):
+            Address.objects.create(address=address, account=account, type=Address.RECEIVE,
+                                   relpath='0/{}'.format(idx), index=idx)
+
+        block_txs = mocked_txs_by_hash('0000000000000000001153f0e26631565d174286327a2afd50f6f5103985c687')
+        txs_by_address = map_txs_by_address(block_txs, txs_by_address={})
+
+        with mock.patch('ingester.tasks.is_feature_enabled', return_value=bulk), \
+                mock.patch('ingester.tasks.logger') as mock_logger:
+            # saving twice must not duplicate any rows
+            for _ in range(2):
+                save_results(network, tracked, txs_by_address, {tx['txid']: tx for tx in block_txs}, publish=False)
+        rows_written = [c[0][2:4] for c in mock_logger.info.call_args_list if c[0][0].startswith('save_results')]
+
+        saved = sorted(
+            (bc.address.address, bc.transaction.txid, int(bc.amount), bc.transaction.fee)
+            for bc in BalanceChange.objects.filter(account=account)
+        )
+        tx_count = Transaction.objects.filter(account=account).count()
+        Address.objects.filter(account=account).delete()
+        return saved, tx_count, rows_written
+
+    def test_bulk_matches_per_row(self):
+        per_row, per_row_tx_count, per_row_written = self._save_block(bulk=False)
+        bulk, bulk_tx_count, bulk_written = self._save_block(bulk=True)
+
+        self.assertTrue(per_row)
+        self.assertListEqual(per_row, bulk)
+        self.assertEqual(per_row_tx_count, bulk_tx_count)
+        # the second save upserts the same txs and inserts no balance changes
+        self.assertListEqual(per_row_written, [(per_row_tx_count, len(per_row)), (per_row_tx_count, 0)])
+        self.assertListEqual(bulk_written, per_row_written)
+
+    def test_failed_utxo_write_rolls_back_the_block(self):
+        account = Account.objects.create(xpub='xpub-rollback', network='BTC', script_type='p2sh-p2wpkh')
+        tracked = ['39wP9MkbVa8hLQj816vUKvztNrCriEP95b', '3BrmwguZXn1iLmECCzpmM1w67ufowe9CpK']
+        for idx, address in enumerate(tracked):
+            Address.objects.create(address=address, account=account, type=Address.RECEIVE,
+                                   relpath='0/{}'.format(idx), index=idx)
+
+        block_txs = mocked_txs_by_hash('0000000000000000001153f0e26631565d174286327a2afd50f6f5103985c687')
+        txs_by_address = map_txs_by_address(block_txs, txs_by_address={})
+
+        with mock.patch('ingester.tasks.save_utxos', side_effect=ValueError('utxo write failed')):
+            with self.assertRaises(ValueError):
+                save_results('BTC', tracked, txs_by_address, {tx['txid']: tx for tx in block_txs}, publish=False)
+
+        # the txs are not saved without their utxos, the sync fails and utxos_synced stays unset
+        self.assertFalse(Transaction.objects.filter(account=account).exists())
+
+
+class SaveUtxosTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(xpub='xpub-utxos', network='BTC', script_type='p2pkh')
+        for idx, address in enumerate(['tracked0', 'tracked1']):
+            Address.objects.create(address=address, account=self.account, type=Address.RECEIVE,
+                                   relpath='0/{}'.format(idx), index=idx)
+
+    @staticmethod
+    def _tx(txid, block_hash, block_height, vin=(), vout=()):
+        return {
+            'txid': txid,
+            'blockhash': block_hash,
+            'blockheight': block_height,
+            'vin': [{'txid': prev_txid, 'vout': n, 'addr': addr, 'valueSat': sats} for prev_txid, n, addr, sats in vin],
+            'vout': [{'n': n, 'value': value, 'scriptPubKey': {'addresses': addresses}}
+                     for n, (addresses, value) in enumerate(vout)],
+        }
+
+    def _unspent(self):
+        return sorted((utxo.txid, utxo.vout, int(utxo.satoshis), utxo.address.address)
+                      for utxo in Utxo.objects.filter(account=self.account, spent_txid__isnull=True))
+
+    @mock.patch('ingester.tasks.redisClient')
+    def test_unconfirmed_rows_are_reconciled(self, mock_redis):
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'funding': self._tx('funding', None, None, vout=[
+            (['tracked0'], '0.00050000')])})
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'replaced': self._tx('replaced', None, None, vin=[
+            ('funding', 0, 'tracked0', 50000)], vout=[(['tracked1'], '0.00040000')])})
+        self.assertListEqual(self._unspent(), [('replaced', 0, 40000, 'tracked1')])
+
+        coinquery = mock.Mock()
+        coinquery.lookup_transactions.return_value = (
+            {'funding': {'txid': 'funding', 'blockhash': 'block5', 'blockheight': 5}}, ['replaced'], []
+        )
+        # missed by an earlier run, longer ago than the grace period
+        mock_redis.hgetall.return_value = {'replaced': '0'}
+
+        reconcile_unconfirmed_utxos('BTC', coinquery)
+
+        self.assertCountEqual(coinquery.lookup_transactions.call_args[0][0], ['funding', 'replaced'])
+        self.assertListEqual(self._unspent(), [('funding', 0, 50000, 'tracked0')])
+        self.assertEqual(Utxo.objects.get(account=self.account, txid='funding').block_height, 5)
+
+    @mock.patch('common.services.coinquery.http')
+    @mock.patch('ingester.tasks.redisClient')
+    def test_failed_lookups_drop_nothing(self, mock_redis, mock_http):
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'funding': self._tx('funding', None, None, vout=[
+            (['tracked0'], '0.00050000')])})
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'replaced': self._tx('replaced', None, None, vin=[
+            ('funding', 0, 'tracked0', 50000)], vout=[(['tracked1'], '0.00040000')])})
+
+        # both missed by an earlier run, longer ago than the grace period
+        mock_redis.hgetall.return_value = {'funding': '0', 'replaced': '0'}
+
+        def lookup(url, **kwargs):
+            if '/tx/replaced' in url:
+                raise HTTPError('404 Client Error: Not found', status=404)
+            raise HTTPError('429 Client Error: Too Many Requests', status=429)
+        mock_http.get.side_effect = lookup
+
+        reconcile_unconfirmed_utxos('BTC', CoinQueryClient('BTC', cache=ChainCache(None, 0, 6)))
+
+        self.assertListEqual(self._unspent(), [('replaced', 0, 40000, 'tracked1')])
+        # both keep the time they were first missed
+        mock_redis.pipeline.return_value.hmset.assert_called_once_with(
+            UTXO_MISSING_TXS_PREFIX + 'BTC', {'funding': '0', 'replaced': '0'})
+
+    def test_outputs_spends_and_orphans(self):
+        funding = self._tx('funding', 'block1', 1, vout=[
+            (['tracked0'], '0.00050000'), (['someone'], '1.00000000'), (['tracked0', 'tracked1'], '0.00001000')])
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'funding': funding})
+        self.assertListEqual(self._unspent(), [('funding', 0, 50000, 'tracked0')])
+
+        ProcessedBlock.objects.create(network='BTC', block_height=2, block_hash='block2', previous_hash='block1',
+                                      block_time='2021-01-01T00:00:00Z')
+        spending = self._tx('spending', 'block2', 2, vin=[('funding', 0, 'tracked0', 50000)],
+                            vout=[(['tracked1'], '0.00040000')])
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'spending': spending})
+        self.assertListEqual(self._unspent(), [('spending', 0, 40000, 'tracked1')])
+
+        # seeing the unconfirmed copy of a tx again must not forget its block
+        save_utxos('BTC', ['tracked0', 'tracked1'], {'funding': self._tx('funding', None, -1, vout=funding['vout'])})
+        self.assertEqual(Utxo.objects.get(txid='funding').block_hash, 'block1')
+
+        ProcessedBlock.orphan_blocks('BTC', ['block2'])
+        self.assertListEqual(self._unspent(), [('funding', 0, 50000, 'tracked0')])
+
+    def test_spend_before_output(self):
+        spending = self._tx('spending', 'block2', 2, vin=[('funding', 0, 'tracked0', 50000)])
+        funding = self._tx('funding', 'block1', 1, vout=[(['tracked0'], '0.00050000')])
+        save_utxos('BTC', ['tracked0'], {'spending': spending})
+        save_utxos('BTC', ['tracked0'], {'funding': funding})
+
+        self.assertListEqual(self._unspent(), [])
+        self.assertEqual(Utxo.objects.get(txid='funding').block_hash, 'block1')
+
+    def test_spent_outputs_are_pruned(self):
+        save_utxos('BTC', ['tracked0'], {
+            'funding': self._tx('funding', 'block1', 1, vout=[(['tracked0'], '0.00050000')]),
+            'spending': self._tx('spending', 'block2', 2, vin=[('funding', 0, 'tracked0', 50000)]),
+        })
+        self.assertEqual(Utxo.objects.filter(account=self.account).count(), 1)
+
+        with mock.patch('ingester.tasks.UTXO_PRUNE_DEPTH', 10):
+            save_utxos('BTC', ['tracked0'], {'later': self._tx('later', 'block13', 13, vout=[(['tracked0'], '0.1')])})
+        self.assertListEqual(self._unspent(), [('later', 0, 10000000, 'tracked0')])
+        self.assertEqual(Utxo.objects.filter(account=self.account).count(), 1)
+
+    @mock.patch('tracker.models.get_latest_block_height', return_value=10)
+    def test_local_utxos(self, mock_height):
+        save_utxos('BTC', ['tracked0'], {
+            'confirmed': self._tx('confirmed', 'block8', 8, vout=[(['tracked0'], '0.00050000')]),
+            'pending': self._tx('pending', None, -1, vout=[(['tracked0'], '0.00020000')]),
+        })
+
+        utxos = sorted(self.account.get_local_utxos(), key=lambda utxo: utxo['txid'])
+        self.assertListEqual([(utxo['txid'], utxo['satoshis'], utxo['confirmations']) for utxo in utxos],
+                             [('confirmed', 50000, 3), ('pending', 20000, 0)])
+
+
 class SyncXpubTest(TestCase):
     def test_xpub_sync_status(self):
         network = "BTC"
@@ -318,6 +791,131 @@ class SyncXpubTest(TestCase):
             self.assertEqual(account_object.sync_status, 'FAILED')
 
 
+class ResyncXpubTest(TestCase):
+    XPUB = 'xpub6Chd4kunDV37PJANQzakXojBEUvjfvWk9ZoPuKdc5bDUwFbnA1dd9aScszzcNqzTEMXN9Qor5v9opipuNQf1EVxjdZPs5A5YwuyxFGe4AGu'
+
+    def setUp(self):
+        self.account = Account.objects.create(xpub=self.XPUB, network='BTC', script_type='p2pkh')
+        for index in range(3):
+            Address.objects.create(account=self.account, address='receive{}'.format(index), index=index, type='receive')
+            Address.objects.create(account=self.account, address='change{}'.format(index), index=index, type='change')
+        Account.objects.filter(id=self.account.id).update(synced_height=600000, max_receive_index=1, max_change_index=0)
+        self.account.refresh_from_db()
+
+    @mock.patch('ingester.tasks.sync_xpub')
+    @mock.patch('ingester.tasks.save_results')
+    @mock.patch('ingester.tasks.get_coinquery_client')
+    def test_resync_fetches_recent_txs_of_used_addresses(self, mock_client, mock_save_results, mock_sync_xpub):
+        tx = {
+            'txid': 'new',
+            'vin': [],
+            'vout': [{'value': '0.00010000', 'scriptPubKey': {'addresses': ['receive1']}}],
+        }
+        mock_client.return_value.get_recent_transactions.return_value = [tx]
+
+        resync_xpub(self.account, 600010, publish=False)
+
+        addresses, max_confirmations = mock_client.return_value.get_recent_transactions.call_args[0]
+        self.assertListEqual(addresses, ['change0', 'receive0', 'change1', 'receive1'])
+        self.assertEqual(max_confirmations, 16)
+
+        _, saved_addresses, txs_by_address, raw_txs = mock_save_results.call_args[0][:4]
+        self.assertDictEqual(txs_by_address['receive1'], {'new': 10000})
+        self.assertDictEqual(txs_by_address['change0'], {})
+        self.assertIn('new', raw_txs)
+
+        mock_sync_xpub.assert_called_once_with(self.XPUB, 'BTC', 'p2pkh', False, start_index=2)
+
+    @mock.patch('ingester.tasks.resync_xpub')
+    @mock.patch('ingester.tasks.sync_xpub')
+    @mock.patch('ingester.tasks.get_latest_block_height', return_value=600010)
+    @mock.patch('ingester.tasks.RabbitConnection')
+    def test_hard_refresh_clears_checkpoint(self, mock_rabbit, mock_height, mock_sync_xpub, mock_resync_xpub):
+        initial_sync_xpub(self.XPUB, 'BTC', 'p2pkh', True, False, incremental=False)
+
+        mock_resync_xpub.assert_not_called()
+        mock_sync_xpub.assert_called_once()
+        account = Account.objects.get(id=self.account.id)
+        self.assertEqual(account.synced_height, 600010)
+        self.assertEqual(account.sync_status, 'COMPLETE')
+
+    @mock.patch('ingester.tasks.resync_xpub')
+    @mock.patch('ingester.tasks.sync_xpub')
+    @mock.patch('ingester.tasks.get_latest_block_height', return_value=600010)
+    @mock.patch('ingester.tasks.RabbitConnection')
+    def test_mandated_hard_refresh_of_checkpointed_account_is_incremental(self, mock_rabbit, mock_height,
+                                                                           mock_sync_xpub, mock_resync_xpub):
+        addresses = Address.objects.filter(account=self.account).count()
+
+        initial_sync_xpub(self.XPUB, 'BTC', 'p2pkh', True, False, incremental=True)
+
+        mock_sync_xpub.assert_not_called()
+        mock_resync_xpub.assert_called_once()
+        self.assertEqual(Address.objects.filter(account=self.account).count(), addresses)
+
+    @mock.patch('ingester.tasks.resync_xpub')
+    @mock.patch('ingester.tasks.sync_xpub')
+    @mock.patch('ingester.tasks.get_latest_block_height', return_value=600010)
+    @mock.patch('ingester.tasks.RabbitConnection')
+    def test_checkpointed_account_is_resynced(self, mock_rabbit, mock_height, mock_sync_xpub, mock_resync_xpub):
+        initial_sync_xpub(self.XPUB, 'BTC', 'p2pkh', False, False, incremental=True)
+
+        mock_sync_xpub.assert_not_called()
+        mock_resync_xpub.assert_called_once()
+        self.assertEqual(Account.objects.get(id=self.account.id).synced_height, 600010)
+
+
+class AddressScannerTest(TestCase):
+    class FakeCoinQuery:
+        """ insight addrs/txs over a fixed set of txs, newest first """
+        def __init__(self, txs):
+            self.txs = txs
+            self.calls = 0
+
+        def get_transactions_page(self, addresses, _from, _to):
+            self.calls += 1
+            addresses = set(addresses)
+            items = [tx for tx in self.txs if addresses & set(tx['vout'][0]['scriptPubKey']['addresses'])]
+            return {'items': items[_from:_to], 'totalItems': len(items)}
+
+    def test_scan_matches_serial_chunks(self):
+        addresses = ['addr-{}'.format(i) for i in range(40)]
+        # addr-3 is busy, a handful of others have one tx each
+        busy = [('addr-3', i) for i in range(120)]
+        quiet = [('addr-{}'.format(i), 0) for i in (0, 17, 25, 39)]
+        txs = [
+            {'txid': '{}-{}'.format(address, n), 'vin': [],
+             'vout': [{'value': '0.00001000', 'scriptPubKey': {'addresses': [address]}}]}
+            for address, n in busy + quiet
+        ]
+        coinquery = self.FakeCoinQuery(txs)
+
+        scanner = AddressScanner(coinquery, workers=4, chunk_size=40)
+        try:
+            chunks = scanner.scan(addresses)
+        finally:
+            scanner.close()
+
+        self.assertEqual([address for chunk, _ in chunks for address in chunk], addresses)
+
+        scanned = {}
+        for chunk, transactions in chunks:
+            map_txs_by_address(transactions, txs_by_address=scanned, filter_addresses=chunk)
+
+        expected = map_txs_by_address(txs)
+        self.assertDictEqual(scanned, expected)
+        self.assertLess(scanner.chunk_size, 40)
+
+        # an unused window is a single request
+        coinquery.calls = 0
+        scanner = AddressScanner(coinquery, workers=4, chunk_size=40)
+        try:
+            scanner.scan(['unused-{}'.format(i) for i in range(40)])
+        finally:
+            scanner.close()
+        self.assertEqual(coinquery.calls, 1)
+
+
 class RabbitTestCase(TestCase):
     def test_publish_consume(self):
         rabbitChannel = RabbitConnection().get_channel()
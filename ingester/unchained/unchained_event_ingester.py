@@ -1,6 +1,7 @@
 from tracker.models import Account, Address, BalanceChange, ERC20Token, Transaction
 from common.services.rabbitmq import RabbitConnection, QUEUE_WATCHTOWER_TX_BACKFILL
 from common.services.redis import redisClient
+from common.services.account_versions import bump_account_versions
 from datetime import datetime, timezone
 import os
 from time import sleep
@@ -65,6 +66,7 @@ class UnchainedEventIngester:
                     transaction_id=t.id,
                     amount=body_json["balance_change"],
                 )
+                bump_account_versions([body_json["account_id"]])
 
                 break
 
@@ -0,0 +1,108 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('watchtower.ingester.xpub_scanner')
+
+MAX_PAGE_SIZE = 50  # most items insight returns for one addrs/txs request
+
+
+class AddressScanner:
+    """ Fetch every transaction of a window of addresses from CoinQuery with a bounded pool of workers
+
+        A window starts out as chunks of chunk_size addresses that are probed concurrently. A chunk whose
+        transactions fit in one page is done after that probe, so an unused address range costs one request. A busy
+        chunk is split in half and both halves are probed again, down to min_chunk_size addresses, after which its
+        remaining pages are fetched concurrently. The chunk size for the next window follows what this one saw: it
+        halves after a split and doubles after a window with less than a page of transactions.
+
+        Pages are always as large as insight allows, a larger page never costs an extra request on a quiet chunk
+        and saves one on a busy chunk.
+
+        scan returns (addresses, transactions) per chunk in address order, independent of how requests were
+        scheduled or how chunks were split. Every transaction touching an address is in its chunk's list.
+    """
+
+    def __init__(self, coinquery, workers, chunk_size, min_chunk_size=5, page_size=MAX_PAGE_SIZE):
+        self.coinquery = coinquery
+        self.workers = max(int(workers), 1)
+        self.max_chunk_size = max(int(chunk_size), 1)
+        self.min_chunk_size = max(min(int(min_chunk_size), self.max_chunk_size), 1)
+        self.chunk_size = self.max_chunk_size
+        self.page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+        self.requests = 0
+        self.splits = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _get_page(self, args):
+        addresses, page = args
+        _from = page * self.page_size
+        resp = self.coinquery.get_transactions_page(addresses, _from, _from + self.page_size)
+        return resp.get('items') or [], resp.get('totalItems') or 0
+
+    def scan(self, addresses):
+        self.requests = self.splits = 0
+        segments = [[addresses[i:i + self.chunk_size], None] for i in range(0, len(addresses), self.chunk_size)]
+
+        while True:
+            pending = [segment for segment in segments if segment[1] is None]
+            if not pending:
+                break
+
+            probes = self._executor.map(self._get_page, [(segment[0], 0) for segment in pending])
+            self.requests += len(pending)
+
+            split = {}
+            paged = []
+            for segment, (items, total) in zip(pending, probes):
+                if total <= len(items):
+                    segment[1] = items
+                elif len(segment[0]) > self.min_chunk_size:
+                    half = (len(segment[0]) + 1) // 2
+                    split[id(segment)] = [[segment[0][:half], None], [segment[0][half:], None]]
+                    self.splits += 1
+                else:
+                    segment[1] = items
+                    paged.append((segment, total))
+
+            self._fetch_remaining_pages(paged)
+            segments = [part for segment in segments for part in split.get(id(segment), [segment])]
+
+        self._adapt(addresses, segments)
+        return [(chunk, self._dedupe(transactions)) for chunk, transactions in segments]
+
+    def _fetch_remaining_pages(self, paged):
+        requests = [
+            (segment, page)
+            for segment, total in paged
+            for page in range(1, (total + self.page_size - 1) // self.page_size)
+        ]
+        pages = self._executor.map(self._get_page, [(segment[0], page) for segment, page in requests])
+        self.requests += len(requests)
+
+        for (segment, _), (items, _) in zip(requests, pages):
+            segment[1] = segment[1] + items
+
+    @staticmethod
+    def _dedupe(transactions):
+        # pages of a live address can shift while they are fetched, keep the first copy of each tx
+        seen = set()
+        unique = []
+        for tx in transactions:
+            txid = tx.get('txid')
+            if txid not in seen:
+                seen.add(txid)
+                unique.append(tx)
+        return unique
+
+    def _adapt(self, addresses, segments):
+        tx_count = sum(len(transactions) for _, transactions in segments)
+        if self.splits:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+        elif tx_count < self.page_size:
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+
+        logger.debug('scanned %s addresses with %s requests, %s splits, %s txs; next chunk size %s',
+                     len(addresses), self.requests, self.splits, tx_count, self.chunk_size)
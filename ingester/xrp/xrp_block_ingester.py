@@ -1,4 +1,6 @@
 from tracker.models import Address, Transaction, BalanceChange, ProcessedBlock
+from common.services.account_versions import bump_account_versions
+from tracker.address_filter import get_tracked_addresses
 from common.utils.blockchain import XRP
 from common.utils.utils import timestamp_to_unix
 from common.services import ripple
@@ -81,10 +83,7 @@ class RippleBlockIngester:
                 addresses.add(tx.get('to'))
 
         # find intersection of addresses in block and addresses we know about
-        known_addresses = Address.objects.filter(
-            address__in=list(addresses),
-            account__network=XRP
-        ).values_list('address', flat=True)
+        known_addresses = set(get_tracked_addresses(XRP, addresses))
 
         # filter list of transactions down to those we care about
         transactions = list(filter(lambda t: t.get('from') in known_addresses
@@ -184,6 +183,9 @@ class RippleBlockIngester:
 
                 rabbit_transactions.append(msg)
 
+        bump_account_versions(
+            Address.objects.filter(address__in=list(tx_by_address)).values_list('account_id', flat=True))
+
         # publish to rabbit
         for msg in rabbit_transactions:
             RabbitConnection().publish(exchange=EXCHANGE_TXS, routing_key='', message_type='event.platform.transaction', body=json.dumps(msg))
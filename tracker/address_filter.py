@@ -0,0 +1,225 @@
+"""
+Per-network in-memory prefilter of tracked addresses
+
+Block ingesters intersect every address seen in a block with the Address table. Almost none of those addresses
+are tracked, so each process keeps a bloom filter of the tracked addresses per network and only asks postgres
+about addresses that pass it.
+
+A bloom filter has no false negatives, so the only way to miss a tracked address is for the filter to not know
+about it yet. Addresses created in this process are added directly. Addresses created in any other process
+(api, other workers) are logged to a redis sorted set scored by time, which every process reads before it
+filters a block. The filter is rebuilt from postgres every REBUILD_INTERVAL seconds, which also drops deleted
+addresses and bounds how long the redis log needs to be kept.
+"""
+import hashlib
+import logging
+import math
+import time
+
+from common.services.launchdarkly import is_feature_enabled, TRACKED_ADDRESS_PREFILTER
+from common.services.redis import redisClient, ADDRESS_FILTER_PREFIX
+from common.utils.networks import SUPPORTED_NETWORKS
+
+logger = logging.getLogger('watchtower.tracker.address_filter')
+
+ERROR_RATE = 0.001
+MIN_CAPACITY = 10000
+GROWTH_FACTOR = 2  # size for twice the current number of tracked addresses to leave room for new registrations
+
+REBUILD_INTERVAL = 60 * 10  # seconds
+CLOCK_SKEW_MARGIN = 60  # seconds, re-read redis log entries this far back to tolerate clock skew between hosts
+LOG_RETENTION = REBUILD_INTERVAL * 2  # seconds
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing (Kirsch-Mitzenmacher) from a single 128 bit digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        """ Add item, returns True if it was not already (probably) present """
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size_bytes(self):
+        return len(self.bits)
+
+    def estimated_false_positive_rate(self):
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class TrackedAddressFilter:
+    def __init__(self, network):
+        self.network = network
+        self.bloom = None
+        self.built_at = None
+        self.synced_at = None
+        self.checked = 0
+        self.passed = 0
+        self.false_positives = 0
+
+    @property
+    def log_key(self):
+        return ADDRESS_FILTER_PREFIX + self.network
+
+    def is_stale(self):
+        return self.bloom is None or (time.time() - self.built_at) > REBUILD_INTERVAL \
+            or len(self.bloom) > self.bloom.capacity
+
+    def rebuild(self):
+        from tracker.models import Address
+
+        started_at = time.time()
+        addresses = Address.objects.filter(account__network=self.network).values_list('address', flat=True)
+
+        bloom = BloomFilter(max(addresses.count() * GROWTH_FACTOR, MIN_CAPACITY))
+        for address in addresses.iterator():
+            bloom.add(address)
+
+        self.bloom = bloom
+        self.built_at = started_at
+        self.synced_at = started_at
+        self.checked = self.passed = self.false_positives = 0
+
+        logger.info('rebuilt %s tracked address filter in %sms: %s', self.network,
+                    int((time.time() - started_at) * 1000), self.stats())
+
+    def sync(self):
+        """ Apply addresses registered by other processes since the last sync """
+        now = time.time()
+        entries = redisClient.zrangebyscore(self.log_key, self.synced_at - CLOCK_SKEW_MARGIN, '+inf')
+        for address in entries:
+            self.bloom.add(address)
+        self.synced_at = now
+
+    def refresh(self):
+        if self.is_stale():
+            self.rebuild()
+        else:
+            self.sync()
+
+    def add(self, address):
+        if self.bloom is not None:
+            self.bloom.add(address)
+
+    def candidates(self, addresses):
+        """ Return the addresses that may be tracked """
+        self.refresh()
+        candidates = [address for address in addresses if address in self.bloom]
+        self.checked += len(addresses)
+        self.passed += len(candidates)
+        return candidates
+
+    def record_matches(self, candidates, matches):
+        self.false_positives += len(candidates) - len(matches)
+
+    def stats(self):
+        if self.bloom is None:
+            return {'network': self.network, 'built': False}
+
+        observed_false_positive_rate = None
+        negatives = self.checked - (self.passed - self.false_positives)
+        if negatives > 0:
+            observed_false_positive_rate = self.false_positives / negatives
+
+        return {
+            'network': self.network,
+            'built': True,
+            'addresses': len(self.bloom),
+            'capacity': self.bloom.capacity,
+            'size_bytes': self.bloom.size_bytes,
+            'hash_count': self.bloom.num_hashes,
+            'estimated_false_positive_rate': self.bloom.estimated_false_positive_rate(),
+            'observed_false_positive_rate': observed_false_positive_rate,
+            'checked': self.checked,
+            'passed': self.passed,
+            'false_positives': self.false_positives,
+            'age_seconds': int(time.time() - self.built_at),
+        }
+
+
+filters = {network: TrackedAddressFilter(network) for network in SUPPORTED_NETWORKS}
+
+
+def get_filter(network):
+    if network not in filters:
+        filters[network] = TrackedAddressFilter(network)
+    return filters[network]
+
+
+def build_filters():
+    if not is_feature_enabled(TRACKED_ADDRESS_PREFILTER):
+        return
+
+    for address_filter in filters.values():
+        try:
+            address_filter.rebuild()
+        except Exception as e:
+            logger.error('failed to build %s tracked address filter: %s', address_filter.network, str(e))
+
+
+def record_address(network, address):
+    """ Make a newly tracked address visible to the filters of every process """
+    get_filter(network).add(address)
+
+    now = time.time()
+    key = ADDRESS_FILTER_PREFIX + network
+    redisClient.zadd(key, {address: now})
+    redisClient.zremrangebyscore(key, '-inf', now - LOG_RETENTION)
+
+
+def get_tracked_addresses(network, addresses, queryset=None):
+    """ Intersect addresses with the tracked addresses of network, returns a list of the tracked ones
+
+        queryset can narrow or widen the Address lookup, it defaults to the addresses tracked on network
+    """
+    from tracker.models import Address
+
+    if queryset is None:
+        queryset = Address.objects.filter(account__network=network)
+
+    addresses = list(addresses)
+    address_filter = None
+    if is_feature_enabled(TRACKED_ADDRESS_PREFILTER):
+        try:
+            address_filter = get_filter(network)
+            addresses = address_filter.candidates(addresses)
+        except Exception as e:
+            logger.error('%s tracked address filter unavailable, querying all addresses: %s', network, str(e))
+            address_filter = None
+
+    if not addresses:
+        return []
+
+    tracked = list(queryset.filter(address__in=addresses).values_list('address', flat=True))
+
+    if address_filter is not None:
+        address_filter.record_matches(addresses, set(tracked))
+
+    return tracked
@@ -0,0 +1,101 @@
+"""
+Per-network ring buffer of the most recently processed block headers
+
+invalidate_orphans used to fetch the latest processed block from CoinQuery and then walk back one request per
+block until it found one that was still on the main chain. Each process now keeps the last HEADER_CHAIN_SIZE
+processed (height, hash) pairs per network, appended by the ingester as blocks are saved and re-seeded from
+ProcessedBlock whenever it no longer ends at the latest processed block (e.g. another worker synced since).
+
+With the chain in memory, an unchanged upstream tip is recognised with a single comparison, and the fork point
+of a reorg is found by binary search over the buffered headers instead of a linear walk.
+"""
+import logging
+import os
+from collections import deque, namedtuple
+
+logger = logging.getLogger('watchtower.tracker.header_chain')
+
+HEADER_CHAIN_SIZE = int(os.environ.get('HEADER_CHAIN_SIZE') or '100')
+
+Header = namedtuple('Header', ['height', 'hash', 'previous_hash'])
+
+
+class HeaderChain:
+    def __init__(self, network, size=HEADER_CHAIN_SIZE):
+        self.network = network
+        self.headers = deque(maxlen=size)
+
+    @property
+    def tip(self):
+        return self.headers[-1] if self.headers else None
+
+    def __len__(self):
+        return len(self.headers)
+
+    def append(self, height, block_hash, previous_hash):
+        tip = self.tip
+        if tip is not None and tip.hash == block_hash:
+            return
+        if tip is not None and tip.hash != previous_hash:
+            # not a child of the tip, start a new chain rather than buffer a gap
+            self.headers.clear()
+        self.headers.append(Header(height, block_hash, previous_hash))
+
+    def seed(self, latest_blocks):
+        """ Reset from ProcessedBlocks ordered newest first, keeping only the unbroken chain below the newest """
+        self.headers.clear()
+        headers = []
+        for block in latest_blocks:
+            if headers and headers[-1].previous_hash != block.block_hash:
+                break
+            headers.append(Header(block.block_height, block.block_hash, block.previous_hash))
+            if len(headers) == self.headers.maxlen:
+                break
+        self.headers.extend(reversed(headers))
+
+    def ensure(self, latest):
+        """ Make sure the chain ends at the latest processed block, re-seeding it from the database if not """
+        from tracker.models import ProcessedBlock
+
+        if self.tip is not None and self.tip.hash == latest.block_hash:
+            return
+
+        blocks = ProcessedBlock.objects.filter(network=self.network, is_orphaned=False) \
+            .order_by('-block_height')[:self.headers.maxlen]
+        self.seed(blocks)
+
+    def find_fork(self, is_main_chain):
+        """ Split the buffered headers into (ancestor, orphans)
+
+            Headers on the main chain always precede orphaned ones, so is_main_chain(block_hash) is binary searched.
+            ancestor is the newest header still on the main chain, or None when every buffered header is orphaned.
+        """
+        headers = list(self.headers)
+        low, high = 0, len(headers)  # headers[:low] are on the main chain, headers[high:] are orphaned
+        while low < high:
+            middle = (low + high) // 2
+            if is_main_chain(headers[middle].hash):
+                low = middle + 1
+            else:
+                high = middle
+
+        ancestor = headers[low - 1] if low > 0 else None
+        return ancestor, headers[low:]
+
+    def truncate(self, ancestor):
+        """ Drop every header after ancestor, or all of them if ancestor is None """
+        while self.headers and (ancestor is None or self.headers[-1].hash != ancestor.hash):
+            self.headers.pop()
+
+
+chains = {}
+
+
+def get_chain(network):
+    if network not in chains:
+        chains[network] = HeaderChain(network)
+    return chains[network]
+
+
+def record_block(network, block_height, block_hash, previous_hash):
+    get_chain(network).append(block_height, block_hash, previous_hash)
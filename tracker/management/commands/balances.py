@@ -0,0 +1,81 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction as db_transaction
+
+from common.services.account_versions import bump_account_versions
+from tracker.models import Account
+from tracker.queries import LOCK_BALANCE_SOURCES_SQL, REBUILD_ADDRESS_BALANCES_SQL, REBUILD_ACCOUNT_TOTALS_SQL, \
+    VERIFY_BALANCES_SQL, REBUILD_BALANCE_ROLLUPS_SQL, VERIFY_BALANCE_ROLLUPS_SQL
+
+logger = logging.getLogger('watchtower.tracker.balances')
+
+
+def rebuild(account_ids):
+    """ Replace the address balances, account totals and balance rollups of account_ids with the raw sums """
+    with db_transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LOCK_BALANCE_SOURCES_SQL)
+        cursor.execute(REBUILD_ADDRESS_BALANCES_SQL, {'account_ids': account_ids})
+        cursor.execute(REBUILD_ACCOUNT_TOTALS_SQL, {'account_ids': account_ids})
+        cursor.execute(REBUILD_BALANCE_ROLLUPS_SQL, {'account_ids': account_ids})
+        bump_account_versions(account_ids)
+
+
+def verify(account_ids):
+    """ Return the rows of account_ids where the read model disagrees with the raw sums, see VERIFY_BALANCES_SQL,
+        and the ones where the rollups do, see VERIFY_BALANCE_ROLLUPS_SQL
+    """
+    with db_transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LOCK_BALANCE_SOURCES_SQL)
+        cursor.execute(VERIFY_BALANCES_SQL, {'account_ids': account_ids})
+        balances = cursor.fetchall()
+        cursor.execute(VERIFY_BALANCE_ROLLUPS_SQL, {'account_ids': account_ids})
+        return balances, cursor.fetchall()
+
+
+class Command(BaseCommand):
+    help = 'Rebuild or verify the balance read model and balance history rollups against the raw balance changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild', 'verify'])
+        parser.add_argument('--account', type=int, action='append', dest='accounts',
+                            help='account id to process, repeatable, defaults to every account')
+        parser.add_argument('--batch-size', type=int, default=500, help='accounts per transaction')
+        parser.add_argument('--repair', action='store_true', help='rebuild the accounts that fail verification')
+
+    def handle(self, *args, **options):
+        account_ids = options['accounts'] or list(Account.objects.order_by('id').values_list('id', flat=True))
+        batch_size = max(options['batch_size'], 1)
+
+        mismatched = set()
+        for x in range(0, len(account_ids), batch_size):
+            batch = account_ids[x:x + batch_size]
+
+            if options['action'] == 'rebuild':
+                rebuild(batch)
+                self.stdout.write('rebuilt {} of {} accounts'.format(x + len(batch), len(account_ids)))
+                continue
+
+            balances, rollups = verify(batch)
+            for account_id, address_id, expected_balance, balance, expected_tx_count, tx_count in balances:
+                mismatched.add(account_id)
+                self.stdout.write('account {} address {}: balance {} expected {}, tx_count {} expected {}'.format(
+                    account_id, address_id or '-', balance, expected_balance, tx_count, expected_tx_count))
+
+            for account_id, erc20_token_id, bucket, expected_amount, amount in rollups:
+                mismatched.add(account_id)
+                self.stdout.write('account {} token {} rollup {}: {} expected {}'.format(
+                    account_id, erc20_token_id, bucket or 'total', amount, expected_amount))
+
+        if options['action'] == 'rebuild':
+            return
+
+        if mismatched and options['repair']:
+            rebuild(sorted(mismatched))
+            logger.info('repaired balances of %s accounts', len(mismatched))
+            self.stdout.write('repaired {} accounts'.format(len(mismatched)))
+        elif mismatched:
+            raise CommandError('{} of {} accounts do not match their balance changes'.format(
+                len(mismatched), len(account_ids)))
+        else:
+            self.stdout.write('all {} accounts match their balance changes'.format(len(account_ids)))
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.7 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0047_auto_20210406_1618'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DerivedAddresses',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('xpub', models.CharField(max_length=255)),
+                ('network', models.CharField(choices=[('BTC', 'BTC'), ('BCH', 'BCH'), ('LTC', 'LTC'), ('DOGE', 'DOGE'), ('DASH', 'DASH'), ('DGB', 'DGB'), ('ETH', 'ETH'), ('ATOM', 'ATOM'), ('BNB', 'BNB'), ('EOS', 'EOS'), ('FIO', 'FIO'), ('RUNE', 'RUNE'), ('XRP', 'XRP'), ('SCRT', 'SCRT'), ('KAVA', 'KAVA'), ('OSMO', 'OSMO')], max_length=100)),
+                ('script_type', models.CharField(choices=[('eth', 'eth'), ('p2pkh', 'p2pkh'), ('p2sh-p2wpkh', 'p2sh-p2wpkh'), ('p2wpkh', 'p2wpkh')], max_length=16)),
+                ('chain', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('addresses', models.TextField(default='')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='derivedaddresses',
+            unique_together={('xpub', 'network', 'script_type', 'chain')},
+        ),
+    ]
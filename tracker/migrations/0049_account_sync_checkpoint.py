@@ -0,0 +1,28 @@
+# Generated by Django 2.0.7 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0048_derivedaddresses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='synced_height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='max_receive_index',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='max_change_index',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.0.7 on 2026-10-18 12:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from tracker.queries import CREATE_BALANCE_TRIGGERS_SQL, DROP_BALANCE_TRIGGERS_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0049_account_sync_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountTotals',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='tracker.Account')),
+                ('balance', models.DecimalField(decimal_places=0, default=0, max_digits=78)),
+                ('tx_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AddressBalance',
+            fields=[
+                ('address', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='tracker.Address')),
+                ('balance', models.DecimalField(decimal_places=0, default=0, max_digits=78)),
+                ('tx_count', models.IntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.Account')),
+            ],
+        ),
+        # totals start out empty, run `manage.py balances rebuild` before enabling the balancereadmodel flag
+        migrations.RunSQL(CREATE_BALANCE_TRIGGERS_SQL, DROP_BALANCE_TRIGGERS_SQL),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.0.7 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0050_addressbalance_accounttotals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='utxos_synced',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='Utxo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('txid', models.CharField(max_length=500)),
+                ('vout', models.IntegerField()),
+                ('satoshis', models.DecimalField(decimal_places=0, max_digits=78)),
+                ('block_hash', models.CharField(max_length=500, null=True)),
+                ('block_height', models.IntegerField(null=True)),
+                ('spent_txid', models.CharField(max_length=500, null=True)),
+                ('spent_block_hash', models.CharField(max_length=500, null=True)),
+                ('spent_block_height', models.IntegerField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.Account')),
+                ('address', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.Address')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='utxo',
+            unique_together={('account', 'txid', 'vout')},
+        ),
+        migrations.AddIndex(
+            model_name='utxo',
+            index=models.Index(fields=['block_hash'], name='utxo_block_hash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='utxo',
+            index=models.Index(fields=['spent_block_hash'], name='utxo_spent_block_hash_idx'),
+        ),
+    ]
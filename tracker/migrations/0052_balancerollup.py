@@ -0,0 +1,45 @@
+# Generated by Django 2.0.7 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from tracker.queries import CREATE_ROLLUP_TRIGGERS_SQL, DROP_ROLLUP_TRIGGERS_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0051_utxo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('erc20_token_id', models.IntegerField(default=0)),
+                ('bucket', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=0, default=0, max_digits=78)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.Account')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceRollupTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('erc20_token_id', models.IntegerField(default=0)),
+                ('balance', models.DecimalField(decimal_places=0, default=0, max_digits=78)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.Account')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancerollup',
+            unique_together={('account', 'erc20_token_id', 'bucket')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancerolluptotal',
+            unique_together={('account', 'erc20_token_id')},
+        ),
+        # rollups start out empty, run `manage.py balances rebuild` before enabling the balancerollups flag
+        migrations.RunSQL(CREATE_ROLLUP_TRIGGERS_SQL, DROP_ROLLUP_TRIGGERS_SQL),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.0.7 on 2026-10-18 16:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0052_balancerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DerivedAddress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('address', models.CharField(max_length=255)),
+                ('derived', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.DerivedAddresses')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='derivedaddress',
+            unique_together={('derived', 'index')},
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO tracker_derivedaddress (derived_id, index, address)
+            SELECT derived.id, entry.ordinality - 1, entry.address
+            FROM tracker_derivedaddresses derived,
+                 unnest(string_to_array(derived.addresses, ',')) WITH ORDINALITY AS entry (address, ordinality)
+            WHERE derived.count > 0
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RemoveField(
+            model_name='derivedaddresses',
+            name='addresses',
+        ),
+    ]
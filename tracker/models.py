@@ -4,13 +4,19 @@ from django.db import models
 
 from common.services.coinquery import get_client as get_coinquery_client
 from common.utils.networks import SUPPORTED_NETWORK_CHOICES, ETH, ATOM, BNB, XRP, EOS, FIO, RUNE, KAVA, SCRT, OSMO
-from common.utils.bip32 import derive_addresses, derive_ethereum_address, SUPPORTED_ADDR_KIND_CHOICES
+from common.utils.bip32 import derive_addresses, derive_ethereum_address, SUPPORTED_ADDR_KIND_CHOICES, \
+    ACCOUNT_BASED_NETWORKS
+from common.utils.bip32_batch import derive_range
+from common.services.account_versions import bump_account_versions
+from common.services.launchdarkly import is_feature_enabled, BATCH_DERIVATION, BALANCE_READ_MODEL, LOCAL_UTXOS, \
+    VERIFY_LOCAL_UTXOS
 from common.utils.blockchain import get_latest_block_height
 from common.services import cointainer_web3 as web3
 from common.utils.ethereum import ERC20_ABI
+from tracker.header_chain import get_chain as get_header_chain
 
 import logging
-from django.db import connection
+from django.db import connection, transaction as db_transaction
 
 logger = logging.getLogger('watchtower.tracker.models')
 
@@ -30,6 +36,12 @@ class Account(models.Model):
     script_type = models.CharField(max_length=16, choices=SUPPORTED_ADDR_KIND_CHOICES)
     sync_status = models.CharField(max_length=16, choices=SUPPORTED_SYNC_STATUS_CHOICES, default='NOT_STARTED')
     migrated = models.BooleanField(default=False)
+    # chain height the last complete utxo sync started at and the highest used index per chain at that point
+    synced_height = models.IntegerField(null=True, blank=True)
+    max_receive_index = models.IntegerField(null=True, blank=True)
+    max_change_index = models.IntegerField(null=True, blank=True)
+    # whether tracker_utxo holds every unspent output of the account, set by a complete sync
+    utxos_synced = models.BooleanField(default=False)
 
     class Meta:
         unique_together = ('xpub', 'network', 'script_type')
@@ -41,10 +53,42 @@ class Account(models.Model):
         self.sync_status = status
         self.save()
 
+    def has_sync_checkpoint(self):
+        return self.synced_height is not None
+
+    def save_sync_checkpoint(self, height):
+        """ Record that everything up to height is synced, along with the highest index with transactions per chain """
+        max_indexes = dict(
+            Address.objects.filter(account=self, balancechange__isnull=False)
+            .values_list('type')
+            .annotate(max_index=models.Max('index'))
+        )
+        self.synced_height = height
+        self.max_receive_index = max_indexes.get(Address.RECEIVE)
+        self.max_change_index = max_indexes.get(Address.CHANGE)
+        Account.objects.filter(id=self.id).update(
+            synced_height=self.synced_height,
+            max_receive_index=self.max_receive_index,
+            max_change_index=self.max_change_index,
+        )
+
+    def clear_sync_checkpoint(self):
+        self.synced_height = self.max_receive_index = self.max_change_index = None
+        Account.objects.filter(id=self.id).update(synced_height=None, max_receive_index=None, max_change_index=None)
+
     def get_addresses(self):
         return Address.objects.filter(account=self)
 
     def get_addresses_with_balance(self):
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            non_zero_balance_address_ids = []
+            balances = AddressBalance.objects.filter(account=self).exclude(balance=0).values_list('address_id', 'balance')
+            for address_id, balance in balances:
+                if balance < 0:
+                    logger.error('Address {} has a negative balance tracked in watchtower DB'.format(address_id))
+                non_zero_balance_address_ids.append(address_id)
+            return Address.objects.filter(id__in=non_zero_balance_address_ids)
+
         non_zero_balance_address_ids = []
         for address in Address.objects.filter(account=self):
             balance = address.get_balance()
@@ -65,18 +109,24 @@ class Account(models.Model):
         sync_function(self.xpub, self.network, self.script_type, False, start_index=start_index)
 
     def derive_external_addresses(self, count, from_index=0):
-        return derive_addresses(self.xpub, '0', count, from_index=from_index, network=self.network,
-                                script_type=self.script_type)
+        return DerivedAddresses.derive(self.xpub, self.network, self.script_type, 0, count, from_index=from_index)
 
     def derive_internal_addresses(self, count, from_index=0):
-        return derive_addresses(self.xpub, '1', count, from_index=from_index, network=self.network,
-                                script_type=self.script_type)
+        return DerivedAddresses.derive(self.xpub, self.network, self.script_type, 1, count, from_index=from_index)
 
     def derive_ethereum_address(self):
         assert self.network == ETH, 'Network must be ETH.'
         return derive_ethereum_address(self.xpub)
 
+    def get_totals(self):
+        """ Running balance and transaction count of the account, None if nothing was ever recorded for it """
+        return AccountTotals.objects.filter(account=self).first()
+
     def transactions_count(self):
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            totals = self.get_totals()
+            return totals.tx_count if totals else 0
+
         return Transaction.objects.filter(account=self).count()
 
     def total_received(self):
@@ -104,6 +154,10 @@ class Account(models.Model):
 
             return eth_balance
 
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            totals = self.get_totals()
+            return totals.balance if totals else 0
+
         return (BalanceChange.objects
                 .filter(account=self)
                 .aggregate(models.Sum('amount'))
@@ -183,24 +237,131 @@ class Account(models.Model):
         return addrs[:count]
 
     def get_utxos(self, account_address_n):
-        # TODO: Track utxos in db to save a network request to coinquery
+        if is_feature_enabled(LOCAL_UTXOS) and self.utxos_synced:
+            utxos = self.get_local_utxos()
+            if not is_feature_enabled(VERIFY_LOCAL_UTXOS) or self._matches_upstream_utxos(utxos):
+                return self._annotate_utxos(utxos, account_address_n)
+
         addresses = self.get_addresses_with_balance()
         coinquery = get_coinquery_client(self.network)
         utxos = coinquery.get_utxos_for_addresses([obj.address for obj in addresses])
 
+        address_objs = {obj.address: obj for obj in addresses}
+        for utxo in utxos:
+            utxo['address_obj'] = address_objs[utxo['address']]
+
+        return self._annotate_utxos(utxos, account_address_n)
+
+    def get_local_utxos(self):
+        """ Unspent outputs of the account from tracker_utxo, in the format of CoinQuery's addrs/utxo """
+        latest_height = None
+        utxos = []
+        for utxo in Utxo.objects.filter(account=self, spent_txid__isnull=True).select_related('address'):
+            confirmations = 0
+            if utxo.block_height:
+                if latest_height is None:
+                    latest_height = get_latest_block_height(self.network)
+                confirmations = max(latest_height + 1 - utxo.block_height, 0)
+
+            utxos.append({
+                'address': utxo.address.address,
+                'address_obj': utxo.address,
+                'txid': utxo.txid,
+                'vout': utxo.vout,
+                'satoshis': int(utxo.satoshis),
+                'height': utxo.block_height,
+                'confirmations': confirmations,
+            })
+        return utxos
+
+    def _matches_upstream_utxos(self, utxos):
+        upstream = get_coinquery_client(self.network).get_utxos_for_addresses(
+            list({utxo['address'] for utxo in utxos} | {obj.address for obj in self.get_addresses_with_balance()})
+        )
+        local_outpoints = {(utxo['txid'], utxo['vout']) for utxo in utxos}
+        upstream_outpoints = {(utxo['txid'], utxo['vout']) for utxo in upstream}
+        if local_outpoints == upstream_outpoints:
+            return True
+
+        logger.error('Account.get_utxos: tracked utxos of account %s differ from upstream, %s missing, %s extra',
+                     self.id, len(upstream_outpoints - local_outpoints), len(local_outpoints - upstream_outpoints))
+        return False
+
+    def _annotate_utxos(self, utxos, account_address_n):
         # Clean up after our change address selection bug.
         # See: https://www.reddit.com/r/TREZOR/comments/czo3yo/change_address_issue/
         change_index = self.get_change_address().index
 
-        for i, utxo in enumerate(utxos):
-            utxo_address = addresses.filter(address=utxo['address']).first()
-            utxos[i]['address_n'] = utxo_address.get_address_n(account_address_n)
-            utxos[i]['script_type'] = self.script_type
-            utxos[i]['spend_required'] = (utxo_address.type == Address.CHANGE and utxo_address.index > change_index)
+        for utxo in utxos:
+            utxo_address = utxo.pop('address_obj')
+            utxo['address_n'] = utxo_address.get_address_n(account_address_n)
+            utxo['script_type'] = self.script_type
+            utxo['spend_required'] = (utxo_address.type == Address.CHANGE and utxo_address.index > change_index)
 
         return utxos
 
 
+class DerivedAddresses(models.Model):
+    """ Addresses derived so far on one chain of an xpub, indices 0 to count - 1 are stored as DerivedAddress rows
+
+        Deriving a child costs an EC point multiplication, so every address is derived once and kept here. Requests
+        read only the rows of their range, and indices past count derive only the missing ones and append them.
+    """
+    xpub = models.CharField(max_length=255)
+    network = models.CharField(max_length=100, choices=SUPPORTED_NETWORK_CHOICES)
+    script_type = models.CharField(max_length=16, choices=SUPPORTED_ADDR_KIND_CHOICES)
+    chain = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('xpub', 'network', 'script_type', 'chain')
+
+    def __str__(self):
+        return '<DerivedAddresses: {}, {}, {}, {}/0-{}>'.format(self.xpub, self.network, self.script_type,
+                                                                self.chain, self.count - 1)
+
+    @classmethod
+    def derive(cls, xpub, network, script_type, chain, count, from_index=0):
+        if network in ACCOUNT_BASED_NETWORKS:
+            return derive_addresses(xpub, str(chain), count, from_index=from_index, network=network,
+                                    script_type=script_type)
+
+        derived, _ = cls.objects.get_or_create(xpub=xpub, network=network, script_type=script_type, chain=chain)
+
+        to_index = from_index + count
+        addresses = list(
+            derived.derivedaddress_set.filter(index__gte=from_index, index__lt=min(to_index, derived.count))
+            .order_by('index').values_list('address', flat=True)
+        )
+
+        if derived.count < to_index:
+            if is_feature_enabled(BATCH_DERIVATION):
+                missing = derive_range(xpub, chain, derived.count, to_index - derived.count,
+                                       script_type=script_type, network=network)
+            else:
+                missing = derive_addresses(xpub, str(chain), to_index - derived.count, from_index=derived.count,
+                                           network=network, script_type=script_type)
+            with db_transaction.atomic():
+                # only append if nobody else extended the range in the meantime, either way the result is the same
+                if cls.objects.filter(id=derived.id, count=derived.count).update(count=to_index):
+                    DerivedAddress.objects.bulk_create([
+                        DerivedAddress(derived=derived, index=derived.count + i, address=address)
+                        for i, address in enumerate(missing)
+                    ])
+            addresses += missing[max(from_index - derived.count, 0):]
+
+        return addresses
+
+
+class DerivedAddress(models.Model):
+    derived = models.ForeignKey(DerivedAddresses, on_delete=models.CASCADE)
+    index = models.IntegerField()
+    address = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('derived', 'index')
+
+
 class Address(models.Model):
     RECEIVE = 'receive'
     CHANGE = 'change'
@@ -229,6 +390,9 @@ class Address(models.Model):
         return account_address_n + [change, address_index]
 
     def get_balance(self):
+        if is_feature_enabled(BALANCE_READ_MODEL):
+            return AddressBalance.objects.filter(address=self).values_list('balance', flat=True).first()
+
         balance = BalanceChange.objects.filter(
             address=self,
             transaction__is_erc20_token_transfer=False
@@ -370,6 +534,85 @@ class BalanceChange(models.Model):
                                                          self.address.address)  # noqa
 
 
+class Utxo(models.Model):
+    """ An output paying a tracked address, kept until it is spent in a block deeper than any expected reorg
+
+        Written from the txs every utxo sync already fetches (see ingester.tasks.save_utxos). Rows are keyed per account
+        so outputs shared by forked chains (BTC and BCH) stay separate, and they remember the blocks that created and
+        spent them so orphan cleanup can roll both back.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    address = models.ForeignKey(Address, on_delete=models.CASCADE)
+    txid = models.CharField(max_length=500)
+    vout = models.IntegerField()
+    satoshis = models.DecimalField(max_digits=78, decimal_places=0)
+    block_hash = models.CharField(max_length=500, null=True)
+    block_height = models.IntegerField(null=True)
+    spent_txid = models.CharField(max_length=500, null=True)
+    spent_block_hash = models.CharField(max_length=500, null=True)
+    spent_block_height = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('account', 'txid', 'vout')
+        indexes = [
+            models.Index(fields=['block_hash'], name='utxo_block_hash_idx'),
+            models.Index(fields=['spent_block_hash'], name='utxo_spent_block_hash_idx'),
+        ]
+
+    def __str__(self):
+        return '<Utxo: {}:{} {} sats to {}>'.format(self.txid, self.vout, self.satoshis, self.address_id)
+
+
+class AddressBalance(models.Model):
+    """ Sum and count of the native (non erc20) balance changes of an address
+
+        Maintained by triggers on tracker_balancechange (see tracker/queries.py), rebuilt and checked against the
+        raw sums with the balances management command.
+    """
+    address = models.OneToOneField(Address, on_delete=models.CASCADE, primary_key=True)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    balance = models.DecimalField(max_digits=78, decimal_places=0, default=0)
+    tx_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '<AddressBalance: {} sats in {} txs for {}>'.format(self.balance, self.tx_count, self.address_id)
+
+
+class AccountTotals(models.Model):
+    """ Sum of every balance change and count of the transactions of an account, maintained like AddressBalance """
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, primary_key=True)
+    balance = models.DecimalField(max_digits=78, decimal_places=0, default=0)
+    tx_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '<AccountTotals: {} sats in {} txs for {}>'.format(self.balance, self.tx_count, self.account_id)
+
+
+class BalanceRollup(models.Model):
+    """ Net balance change of an account in one erc20 token (0 for the native asset) within one minute
+
+        Maintained by triggers on tracker_balancechange and tracker_transaction (see tracker/queries.py), balance
+        history of any interval is summed up from these buckets.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    erc20_token_id = models.IntegerField(default=0)
+    bucket = models.DateTimeField()
+    amount = models.DecimalField(max_digits=78, decimal_places=0, default=0)
+
+    class Meta:
+        unique_together = ('account', 'erc20_token_id', 'bucket')
+
+
+class BalanceRollupTotal(models.Model):
+    """ Sum of every BalanceRollup of an (account, token), the checkpoint history starting balances are taken from """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    erc20_token_id = models.IntegerField(default=0)
+    balance = models.DecimalField(max_digits=78, decimal_places=0, default=0)
+
+    class Meta:
+        unique_together = ('account', 'erc20_token_id')
+
+
 class ProcessedBlock(models.Model):
     network = models.CharField(max_length=100, choices=SUPPORTED_NETWORK_CHOICES)
     block_height = models.IntegerField()
@@ -393,12 +636,13 @@ class ProcessedBlock(models.Model):
             return None
 
     @classmethod
-    def get_or_create(cls, block_hash, network):
+    def get_or_create(cls, block_hash, network, block=None):
         existing = cls.get_or_none(block_hash, network)
         if existing:
             return existing
 
-        block = get_coinquery_client(network).get_block_by_hash(block_hash)
+        if block is None:
+            block = get_coinquery_client(network).get_block_by_hash(block_hash)
         block_height = block.get('height')
         block_time = datetime.fromtimestamp(block.get('time'), timezone.utc)
         previous_block_hash = block.get('previousblockhash')
@@ -424,8 +668,12 @@ class ProcessedBlock(models.Model):
 
     # removes all balance changes and transactions that were a result of an orphaned block
     def cleanUpOrphans(block_id):
+        ProcessedBlock.clean_up_orphans([block_id])
 
-        logger.debug('cleaning up orphans')
+    @staticmethod
+    def clean_up_orphans(block_ids):
+        """ Remove the balance changes and transactions of every orphaned block in block_ids with one delete each """
+        logger.debug('cleaning up orphans %s', block_ids)
 
         clean_all_balances_query = """
             DELETE FROM tracker_balancechange USING tracker_transaction, tracker_processedblock
@@ -436,11 +684,9 @@ class ProcessedBlock(models.Model):
             AND
             tracker_processedblock.is_orphaned = True
             AND
-            tracker_processedblock.id = {block_id};
+            tracker_processedblock.id = ANY(%s);
         """
 
-        formattted_clean_all_balances_query = clean_all_balances_query.format(block_id=block_id)
-
         clean_all_transactions_query = """
             DELETE FROM tracker_transaction USING tracker_processedblock
             WHERE
@@ -448,14 +694,47 @@ class ProcessedBlock(models.Model):
             AND
             tracker_processedblock.is_orphaned = True
             AND
-            tracker_processedblock.id = {block_id};
+            tracker_processedblock.id = ANY(%s)
+            RETURNING tracker_transaction.account_id;
         """
 
-        formattted_clean_all_transactions_query = clean_all_transactions_query.format(block_id=block_id)
+        clean_created_utxos_query = """
+            DELETE FROM tracker_utxo USING tracker_processedblock
+            WHERE
+            tracker_utxo.block_hash = tracker_processedblock.block_hash
+            AND
+            tracker_processedblock.is_orphaned = True
+            AND
+            tracker_processedblock.id = ANY(%s);
+        """
+
+        restore_spent_utxos_query = """
+            UPDATE tracker_utxo SET spent_txid = NULL, spent_block_hash = NULL, spent_block_height = NULL
+            FROM tracker_processedblock
+            WHERE
+            tracker_utxo.spent_block_hash = tracker_processedblock.block_hash
+            AND
+            tracker_processedblock.is_orphaned = True
+            AND
+            tracker_processedblock.id = ANY(%s);
+        """
 
         with connection.cursor() as cursor:
-            cursor.execute(formattted_clean_all_balances_query)
-            cursor.execute(formattted_clean_all_transactions_query)
+            cursor.execute(clean_all_balances_query, [list(block_ids)])
+            cursor.execute(clean_all_transactions_query, [list(block_ids)])
+            bump_account_versions({account_id for account_id, in cursor.fetchall()})
+            cursor.execute(clean_created_utxos_query, [list(block_ids)])
+            cursor.execute(restore_spent_utxos_query, [list(block_ids)])
+
+    @classmethod
+    def orphan_blocks(cls, network, block_hashes):
+        """ Mark block_hashes orphaned and roll back everything they wrote in a single transaction """
+        with db_transaction.atomic():
+            block_ids = list(
+                cls.objects.filter(network=network, block_hash__in=block_hashes).values_list('id', flat=True)
+            )
+            cls.objects.filter(id__in=block_ids).update(is_orphaned=True)
+            cls.clean_up_orphans(block_ids)
 
     @classmethod
     def invalidate_orphans(cls, network):
@@ -463,23 +742,40 @@ class ProcessedBlock(models.Model):
         if not latest:
             return
 
-        current = latest
-        while isinstance(current, ProcessedBlock):
-            block = get_coinquery_client(network).get_block_by_hash(current.block_hash)
+        chain = get_header_chain(network)
+        chain.ensure(latest)
 
-            if block.get('confirmations') < 0:
-                logger.info('detected orphaned %s block %s', network, current.block_hash)
+        coinquery = get_coinquery_client(network)
+        try:
+            if coinquery.get_last_block_hash() == latest.block_hash:
+                return
+        except Exception as e:
+            logger.error('failed to get %s tip, checking latest processed block instead: %s', network, str(e))
 
-                # mark orphan
-                current.is_orphaned = True
-                current.save()
+        is_main_chain = {}
 
-                # clean up transaction and balance changes from orphaned blocks
-                cls.cleanUpOrphans(current.id)
+        def on_main_chain(block_hash):
+            if block_hash not in is_main_chain:
+                block = coinquery.get_block_by_hash(block_hash, cached=False)
+                is_main_chain[block_hash] = block.get('confirmations') >= 0
+            return is_main_chain[block_hash]
 
+        if on_main_chain(latest.block_hash):
+            return
+
+        ancestor, orphans = chain.find_fork(on_main_chain)
+        orphaned_hashes = [header.hash for header in orphans]
+
+        if ancestor is None:
+            # the reorg is deeper than the header chain, keep walking back one block at a time
+            current = cls.get_or_none(orphans[0].previous_hash, network) if orphans else None
+            while isinstance(current, ProcessedBlock) and not on_main_chain(current.block_hash):
+                orphaned_hashes.append(current.block_hash)
                 current = cls.get_or_none(current.previous_hash, network)
-            else:
-                break
+
+        logger.info('detected %s orphaned %s blocks: %s', len(orphaned_hashes), network, orphaned_hashes)
+        cls.orphan_blocks(network, orphaned_hashes)
+        chain.truncate(ancestor)
 
 
 class ChainHeight(models.Model):
@@ -0,0 +1,313 @@
+# Running balance totals, kept next to tracker_balancechange by triggers.
+#
+# Balance changes are written by every ingester (update_or_create per row, the bulk upsert in ingester/queries.py)
+# and removed by orphan cleanup and account/address deletes, so the totals are maintained in the database on every
+# insert, update and delete of a balance change or transaction rather than at each of those call sites. Deletes only
+# ever update existing totals rows: a cascade may already have removed the row of the address or account going away.
+#
+# tracker_addressbalance mirrors Address.get_balance, so erc20 token transfers are left out of it.
+# tracker_accounttotals mirrors Account.final_balance and Account.transactions_count.
+CREATE_BALANCE_TRIGGERS_SQL = """
+            CREATE OR REPLACE FUNCTION tracker_balancechange_totals() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    UPDATE tracker_addressbalance
+                    SET balance = balance - OLD.amount,
+                        tx_count = tx_count - 1
+                    WHERE address_id = OLD.address_id
+                      AND NOT EXISTS (
+                          SELECT 1 FROM tracker_transaction tx
+                          WHERE tx.id = OLD.transaction_id AND tx.is_erc20_token_transfer
+                      );
+
+                    UPDATE tracker_accounttotals
+                    SET balance = balance - OLD.amount
+                    WHERE account_id = OLD.account_id;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO tracker_addressbalance (address_id, account_id, balance, tx_count)
+                    SELECT NEW.address_id, NEW.account_id, NEW.amount, 1
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM tracker_transaction tx
+                        WHERE tx.id = NEW.transaction_id AND tx.is_erc20_token_transfer
+                    )
+                    ON CONFLICT (address_id) DO UPDATE
+                    SET balance = tracker_addressbalance.balance + EXCLUDED.balance,
+                        tx_count = tracker_addressbalance.tx_count + 1;
+
+                    INSERT INTO tracker_accounttotals (account_id, balance, tx_count)
+                    VALUES (NEW.account_id, NEW.amount, 0)
+                    ON CONFLICT (account_id) DO UPDATE
+                    SET balance = tracker_accounttotals.balance + EXCLUDED.balance;
+                END IF;
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER tracker_balancechange_totals
+            AFTER INSERT OR UPDATE OF amount, address_id, account_id OR DELETE ON tracker_balancechange
+            FOR EACH ROW EXECUTE PROCEDURE tracker_balancechange_totals();
+
+            CREATE OR REPLACE FUNCTION tracker_transaction_totals() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    UPDATE tracker_accounttotals
+                    SET tx_count = tx_count - 1
+                    WHERE account_id = OLD.account_id;
+                ELSE
+                    INSERT INTO tracker_accounttotals (account_id, balance, tx_count)
+                    VALUES (NEW.account_id, 0, 1)
+                    ON CONFLICT (account_id) DO UPDATE
+                    SET tx_count = tracker_accounttotals.tx_count + 1;
+                END IF;
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER tracker_transaction_totals
+            AFTER INSERT OR DELETE ON tracker_transaction
+            FOR EACH ROW EXECUTE PROCEDURE tracker_transaction_totals();
+        """
+
+DROP_BALANCE_TRIGGERS_SQL = """
+            DROP TRIGGER IF EXISTS tracker_transaction_totals ON tracker_transaction;
+            DROP FUNCTION IF EXISTS tracker_transaction_totals();
+            DROP TRIGGER IF EXISTS tracker_balancechange_totals ON tracker_balancechange;
+            DROP FUNCTION IF EXISTS tracker_balancechange_totals();
+        """
+
+# Writers are held off for the duration of a rebuild batch so no trigger update lands between the raw sums and the
+# totals replacing them.
+LOCK_BALANCE_SOURCES_SQL = """
+            LOCK TABLE tracker_transaction, tracker_balancechange IN SHARE MODE
+        """
+
+REBUILD_ADDRESS_BALANCES_SQL = """
+            DELETE FROM tracker_addressbalance WHERE account_id = ANY(%(account_ids)s);
+
+            INSERT INTO tracker_addressbalance (address_id, account_id, balance, tx_count)
+            SELECT bal.address_id, bal.account_id, SUM(bal.amount), COUNT(*)
+            FROM tracker_balancechange bal
+            JOIN tracker_transaction tx ON tx.id = bal.transaction_id
+            WHERE bal.account_id = ANY(%(account_ids)s)
+              AND NOT tx.is_erc20_token_transfer
+            GROUP BY bal.address_id, bal.account_id;
+        """
+
+REBUILD_ACCOUNT_TOTALS_SQL = """
+            INSERT INTO tracker_accounttotals (account_id, balance, tx_count)
+            SELECT acc.id,
+                   COALESCE((SELECT SUM(bal.amount) FROM tracker_balancechange bal WHERE bal.account_id = acc.id), 0),
+                   (SELECT COUNT(*) FROM tracker_transaction tx WHERE tx.account_id = acc.id)
+            FROM tracker_account acc
+            WHERE acc.id = ANY(%(account_ids)s)
+            ON CONFLICT (account_id) DO UPDATE
+            SET balance = EXCLUDED.balance,
+                tx_count = EXCLUDED.tx_count;
+        """
+
+# Rows of (account_id, address_id, expected balance, stored balance, expected tx_count, stored tx_count) where the
+# read model disagrees with the raw sums, address_id is NULL for account totals.
+VERIFY_BALANCES_SQL = """
+            WITH raw_addresses AS (
+                SELECT bal.address_id, bal.account_id, SUM(bal.amount) AS balance, COUNT(*) AS tx_count
+                FROM tracker_balancechange bal
+                JOIN tracker_transaction tx ON tx.id = bal.transaction_id
+                WHERE bal.account_id = ANY(%(account_ids)s)
+                  AND NOT tx.is_erc20_token_transfer
+                GROUP BY bal.address_id, bal.account_id
+            ),
+            stored_addresses AS (
+                SELECT address_id, account_id, balance, tx_count
+                FROM tracker_addressbalance
+                WHERE account_id = ANY(%(account_ids)s)
+            ),
+            raw_accounts AS (
+                SELECT acc.id AS account_id,
+                       COALESCE((SELECT SUM(bal.amount) FROM tracker_balancechange bal
+                                 WHERE bal.account_id = acc.id), 0) AS balance,
+                       (SELECT COUNT(*) FROM tracker_transaction tx WHERE tx.account_id = acc.id) AS tx_count
+                FROM tracker_account acc
+                WHERE acc.id = ANY(%(account_ids)s)
+            )
+            SELECT COALESCE(r.account_id, s.account_id), COALESCE(r.address_id, s.address_id),
+                   COALESCE(r.balance, 0), COALESCE(s.balance, 0), COALESCE(r.tx_count, 0), COALESCE(s.tx_count, 0)
+            FROM raw_addresses r
+            FULL OUTER JOIN stored_addresses s ON s.address_id = r.address_id
+            WHERE COALESCE(r.balance, 0) <> COALESCE(s.balance, 0)
+               OR COALESCE(r.tx_count, 0) <> COALESCE(s.tx_count, 0)
+            UNION ALL
+            SELECT r.account_id, NULL, r.balance, COALESCE(s.balance, 0), r.tx_count, COALESCE(s.tx_count, 0)
+            FROM raw_accounts r
+            LEFT JOIN tracker_accounttotals s ON s.account_id = r.account_id
+            WHERE r.balance <> COALESCE(s.balance, 0)
+               OR r.tx_count <> COALESCE(s.tx_count, 0)
+        """
+
+# Balance history rollups: the net balance change of every (account, erc20 token) per minute its transactions were
+# confirmed in, native changes under erc20_token_id 0, plus the running total of those minutes. Every interval the
+# history endpoints offer is a whole number of minutes, so coarser buckets are sums of these. Transactions only have
+# a minute once they have a block_time, so the rollups also follow updates of the transaction's block_time or token.
+CREATE_ROLLUP_TRIGGERS_SQL = """
+            CREATE OR REPLACE FUNCTION tracker_rollup_add(account integer, token integer, block_time timestamptz,
+                                                          amount numeric) RETURNS void AS $$
+            BEGIN
+                IF block_time IS NULL OR amount IS NULL THEN
+                    RETURN;
+                END IF;
+
+                INSERT INTO tracker_balancerollup (account_id, erc20_token_id, bucket, amount)
+                VALUES (account, token, TO_TIMESTAMP(floor(extract('epoch' FROM block_time) / 60) * 60), amount)
+                ON CONFLICT (account_id, erc20_token_id, bucket) DO UPDATE
+                SET amount = tracker_balancerollup.amount + EXCLUDED.amount;
+
+                INSERT INTO tracker_balancerolluptotal (account_id, erc20_token_id, balance)
+                VALUES (account, token, amount)
+                ON CONFLICT (account_id, erc20_token_id) DO UPDATE
+                SET balance = tracker_balancerolluptotal.balance + EXCLUDED.balance;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            -- removals only touch existing rows, a cascade may already have deleted those of the account going away
+            CREATE OR REPLACE FUNCTION tracker_rollup_remove(account integer, token integer, block_time timestamptz,
+                                                             amount numeric) RETURNS void AS $$
+            BEGIN
+                IF block_time IS NULL OR amount IS NULL THEN
+                    RETURN;
+                END IF;
+
+                UPDATE tracker_balancerollup
+                SET amount = tracker_balancerollup.amount - tracker_rollup_remove.amount
+                WHERE account_id = account
+                  AND erc20_token_id = token
+                  AND bucket = TO_TIMESTAMP(floor(extract('epoch' FROM block_time) / 60) * 60);
+
+                UPDATE tracker_balancerolluptotal
+                SET balance = balance - tracker_rollup_remove.amount
+                WHERE account_id = account AND erc20_token_id = token;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION tracker_balancechange_rollups() RETURNS trigger AS $$
+            DECLARE
+                tx RECORD;
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    SELECT block_time, COALESCE(erc20_token_id, 0) AS token INTO tx
+                    FROM tracker_transaction WHERE id = OLD.transaction_id;
+                    IF FOUND THEN
+                        PERFORM tracker_rollup_remove(OLD.account_id, tx.token, tx.block_time, OLD.amount);
+                    END IF;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    SELECT block_time, COALESCE(erc20_token_id, 0) AS token INTO tx
+                    FROM tracker_transaction WHERE id = NEW.transaction_id;
+                    IF FOUND THEN
+                        PERFORM tracker_rollup_add(NEW.account_id, tx.token, tx.block_time, NEW.amount);
+                    END IF;
+                END IF;
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER tracker_balancechange_rollups
+            AFTER INSERT OR UPDATE OF amount, account_id, transaction_id OR DELETE ON tracker_balancechange
+            FOR EACH ROW EXECUTE PROCEDURE tracker_balancechange_rollups();
+
+            CREATE OR REPLACE FUNCTION tracker_transaction_rollups() RETURNS trigger AS $$
+            DECLARE
+                change RECORD;
+            BEGIN
+                FOR change IN
+                    SELECT account_id, SUM(amount) AS amount FROM tracker_balancechange
+                    WHERE transaction_id = NEW.id
+                    GROUP BY account_id
+                LOOP
+                    PERFORM tracker_rollup_remove(change.account_id, COALESCE(OLD.erc20_token_id, 0), OLD.block_time,
+                                                  change.amount);
+                    PERFORM tracker_rollup_add(change.account_id, COALESCE(NEW.erc20_token_id, 0), NEW.block_time,
+                                               change.amount);
+                END LOOP;
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER tracker_transaction_rollups
+            AFTER UPDATE OF block_time, erc20_token_id ON tracker_transaction
+            FOR EACH ROW
+            WHEN (OLD.block_time IS DISTINCT FROM NEW.block_time OR OLD.erc20_token_id IS DISTINCT FROM NEW.erc20_token_id)
+            EXECUTE PROCEDURE tracker_transaction_rollups();
+        """
+
+DROP_ROLLUP_TRIGGERS_SQL = """
+            DROP TRIGGER IF EXISTS tracker_transaction_rollups ON tracker_transaction;
+            DROP FUNCTION IF EXISTS tracker_transaction_rollups();
+            DROP TRIGGER IF EXISTS tracker_balancechange_rollups ON tracker_balancechange;
+            DROP FUNCTION IF EXISTS tracker_balancechange_rollups();
+            DROP FUNCTION IF EXISTS tracker_rollup_remove(integer, integer, timestamptz, numeric);
+            DROP FUNCTION IF EXISTS tracker_rollup_add(integer, integer, timestamptz, numeric);
+        """
+
+ROLLUP_SOURCE_SQL = """
+            SELECT bal.account_id,
+                   COALESCE(tx.erc20_token_id, 0) AS erc20_token_id,
+                   TO_TIMESTAMP(floor(extract('epoch' FROM tx.block_time) / 60) * 60) AS bucket,
+                   SUM(bal.amount) AS amount
+            FROM tracker_balancechange bal
+            JOIN tracker_transaction tx ON tx.id = bal.transaction_id
+            WHERE bal.account_id = ANY(%(account_ids)s)
+              AND tx.block_time IS NOT NULL
+            GROUP BY 1, 2, 3
+        """
+
+REBUILD_BALANCE_ROLLUPS_SQL = """
+            DELETE FROM tracker_balancerollup WHERE account_id = ANY(%(account_ids)s);
+            DELETE FROM tracker_balancerolluptotal WHERE account_id = ANY(%(account_ids)s);
+
+            INSERT INTO tracker_balancerollup (account_id, erc20_token_id, bucket, amount)
+            {source};
+
+            INSERT INTO tracker_balancerolluptotal (account_id, erc20_token_id, balance)
+            SELECT account_id, erc20_token_id, SUM(amount)
+            FROM tracker_balancerollup
+            WHERE account_id = ANY(%(account_ids)s)
+            GROUP BY account_id, erc20_token_id;
+        """.format(source=ROLLUP_SOURCE_SQL)
+
+# Rows of (account_id, erc20_token_id, bucket, expected amount, stored amount) where the rollups disagree with the raw
+# balance changes, bucket is NULL for the running totals. Empty buckets left behind by deletes are not mismatches.
+VERIFY_BALANCE_ROLLUPS_SQL = """
+            WITH raw AS ({source}),
+            stored AS (
+                SELECT account_id, erc20_token_id, bucket, amount
+                FROM tracker_balancerollup
+                WHERE account_id = ANY(%(account_ids)s)
+            ),
+            raw_totals AS (
+                SELECT account_id, erc20_token_id, SUM(amount) AS balance FROM raw GROUP BY 1, 2
+            ),
+            stored_totals AS (
+                SELECT account_id, erc20_token_id, balance
+                FROM tracker_balancerolluptotal
+                WHERE account_id = ANY(%(account_ids)s)
+            )
+            SELECT COALESCE(r.account_id, s.account_id), COALESCE(r.erc20_token_id, s.erc20_token_id),
+                   COALESCE(r.bucket, s.bucket), COALESCE(r.amount, 0), COALESCE(s.amount, 0)
+            FROM raw r
+            FULL OUTER JOIN stored s
+              ON s.account_id = r.account_id AND s.erc20_token_id = r.erc20_token_id AND s.bucket = r.bucket
+            WHERE COALESCE(r.amount, 0) <> COALESCE(s.amount, 0)
+            UNION ALL
+            SELECT COALESCE(r.account_id, s.account_id), COALESCE(r.erc20_token_id, s.erc20_token_id), NULL,
+                   COALESCE(r.balance, 0), COALESCE(s.balance, 0)
+            FROM raw_totals r
+            FULL OUTER JOIN stored_totals s
+              ON s.account_id = r.account_id AND s.erc20_token_id = r.erc20_token_id
+            WHERE COALESCE(r.balance, 0) <> COALESCE(s.balance, 0)
+        """.format(source=ROLLUP_SOURCE_SQL)
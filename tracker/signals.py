@@ -1,11 +1,15 @@
 import os
 import json
+import logging
 
 from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
-from tracker.models import Account, Address
+from tracker.models import Account, Address, ERC20Token
+from tracker.address_filter import record_address
+from common.services.account_versions import bump_account_versions, bump_registry_version
 from common.services.rabbitmq import RabbitConnection, EXCHANGE_UNCHAINED
+from common.services.redis import redisClient, ERC20_TOKEN_PREFIX
 from common.services.launchdarkly import is_feature_enabled, UNCHAINED_REGISTRY
 
 host = os.environ.get('UNCHAINED_RABBIT_HOST')
@@ -13,6 +17,8 @@ port = os.environ.get('UNCHAINED_RABBIT_PORT')
 user = os.environ.get('UNCHAINED_RABBIT_USER')
 password = os.environ.get('UNCHAINED_RABBIT_PASS')
 
+logger = logging.getLogger('watchtower.tracker.signals')
+
 is_enabled = is_feature_enabled(UNCHAINED_REGISTRY) and os.environ.get('UNCHAINED_RABBIT_ENABLED').lower() == 'true'
 
 
@@ -170,3 +176,39 @@ def unregister_address(sender, instance, **kwargs):
         message_type='unchained.registry',
         body=json.dumps(msg)
     )
+
+
+@receiver(post_save, sender=Address)
+def track_address(sender, instance, created, **kwargs):
+    # deleted addresses stay in the filters until their next rebuild, which only costs a false positive
+    if not created:
+        return
+
+    try:
+        record_address(instance.account.network, instance.address)
+    except Exception as e:
+        logger.error('failed to record %s address %s for the tracked address filter: %s',
+                     instance.account.network, instance.address, str(e))
+
+
+@receiver(post_save, sender=Account)
+def bump_account_version(sender, instance, created, **kwargs):
+    # sync status and updated_at are part of the cached responses of the account
+    bump_account_versions([instance.id])
+    if created:
+        bump_registry_version()
+
+
+@receiver(post_delete, sender=Account)
+def bump_account_registry_version(sender, instance, **kwargs):
+    bump_registry_version()
+
+
+@receiver(post_save, sender=ERC20Token)
+@receiver(post_delete, sender=ERC20Token)
+def drop_cached_erc20_token(sender, instance, **kwargs):
+    # the in-process caches of the ingesters expire on their own, see ingester/eth/erc20_tokens.py
+    try:
+        redisClient.delete(ERC20_TOKEN_PREFIX + instance.contract_address)
+    except Exception as e:
+        logger.error('failed to drop cached erc20 token %s: %s', instance.contract_address, str(e))
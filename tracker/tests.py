@@ -1,9 +1,29 @@
-from django.test import TestCase
+from django.http import JsonResponse
+from django.test import RequestFactory, TestCase, override_settings
 from unittest import mock
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from tracker.models import ProcessedBlock
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from tracker.models import ProcessedBlock, DerivedAddresses, Account, Address, Transaction, BalanceChange, \
+    AddressBalance, AccountTotals, BalanceRollup, BalanceRollupTotal
+from common.utils.bip32 import derive_addresses
+from tracker.address_filter import BloomFilter
+from tracker.header_chain import HeaderChain
 from common.utils.networks import SUPPORTED_NETWORKS
+from api.rest.v1.data.balance_history import fetcher as balance_history_fetcher
+from api.rest.v1.data.accounts import AccountResolver
+from api.rest.v1.data.transactions import fetcher as tx_fetcher
+from api.rest.v1.async_views import SendTransactionConsumer
+from api.rest.v1.views import BalancePage, SendTransactionPage
+from api.rest.v1.response_cache import cached_response
+from common.exceptions import XPubNotRegisteredError
 
 
 class ProcessedBlockWithNoProcessedBlocksTest(TestCase):
@@ -96,8 +116,9 @@ class ProcessedBlockWithExistingDatabase(TestCase):
             # Confirm that the expected block_hash is returned from the test database
             self.assertEqual(latest.block_hash, latest_block_hash)
 
+    @mock.patch('common.services.coinquery.CoinQueryClient.get_last_block_hash', return_value='upstream-tip')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_block_by_hash')
-    def test_processed_block_invalidate_orphans_with_valid_block(self, mock_get_block_by_hash):
+    def test_processed_block_invalidate_orphans_with_valid_block(self, mock_get_block_by_hash, mock_get_last_block_hash):
         network = 'BTC'
         json_data = open(
             'ingester/fixtures/valid_blocks/btc/block_537818.json')
@@ -115,8 +136,9 @@ class ProcessedBlockWithExistingDatabase(TestCase):
 
 
 class ProcessedBlockWithOrphansTest(TestCase):
+    @mock.patch('common.services.coinquery.CoinQueryClient.get_last_block_hash', return_value='upstream-tip')
     @mock.patch('common.services.coinquery.CoinQueryClient.get_block_by_hash')
-    def test_processed_block_invalidate_orphan_chain(self, mock_get_block_by_hash):
+    def test_processed_block_invalidate_orphan_chain(self, mock_get_block_by_hash, mock_get_last_block_hash):
         # Define block hashes to mark as orphan
         expected_orphans = {
             '000000000000000000_ORPHAN_BLOCKY_5': True,
@@ -127,7 +149,7 @@ class ProcessedBlockWithOrphansTest(TestCase):
         }
 
         # Mock out Coinquery response for get current block by block hash
-        def mocked_get_block_by_hash_responses(block_hash):
+        def mocked_get_block_by_hash_responses(block_hash, cached=True):
             should_be_orphaned = expected_orphans.get(block_hash, None)
 
             # If block is orphaned cq returns -1 for confirmations
@@ -202,3 +224,493 @@ class ProcessedBlockWithOrphansTest(TestCase):
         for block_hash, should_be_orphaned in expected_orphans.items():
             block = ProcessedBlock.objects.get(block_hash=block_hash)
             self.assertEqual(block.is_orphaned, should_be_orphaned)
+
+
+class DerivedAddressesTest(TestCase):
+    xpub = 'xpub6Chd4kunDV37PJANQzakXojBEUvjfvWk9ZoPuKdc5bDUwFbnA1dd9aScszzcNqzTEMXN9Qor5v9opipuNQf1EVxjdZPs5A5YwuyxFGe4AGu'
+
+    @mock.patch('tracker.models.is_feature_enabled', return_value=False)
+    def test_derives_each_index_once(self, mock_is_feature_enabled):
+        expected = derive_addresses(self.xpub, '1', 30, network='BTC', script_type='p2pkh')
+
+        self.assertEqual(DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 20), expected[:20])
+        with mock.patch('tracker.models.derive_addresses', wraps=derive_addresses) as mock_derive:
+            self.assertEqual(DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 10, from_index=5), expected[5:15])
+            self.assertFalse(mock_derive.called)
+
+            self.assertEqual(DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 15, from_index=15), expected[15:30])
+            mock_derive.assert_called_once_with(self.xpub, '1', 10, from_index=20, network='BTC', script_type='p2pkh')
+
+        derived = DerivedAddresses.objects.get(xpub=self.xpub, network='BTC', script_type='p2pkh', chain=1)
+        self.assertEqual(derived.count, 30)
+        self.assertEqual(list(derived.derivedaddress_set.order_by('index').values_list('address', flat=True)), expected)
+
+    @mock.patch('tracker.models.is_feature_enabled', return_value=False)
+    def test_window_past_the_derived_range(self, mock_is_feature_enabled):
+        expected = derive_addresses(self.xpub, '1', 30, network='BTC', script_type='p2pkh')
+
+        DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 5)
+        # the gap between the derived range and the window is derived and stored too
+        self.assertEqual(DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 10, from_index=20), expected[20:30])
+        self.assertEqual(DerivedAddresses.derive(self.xpub, 'BTC', 'p2pkh', 1, 25, from_index=3), expected[3:28])
+
+
+class BalanceReadModelTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(xpub='xpub-totals', network='BTC', script_type='p2pkh')
+        self.receive = Address.objects.create(account=self.account, address='receive0', type='receive', index=0)
+        self.change = Address.objects.create(account=self.account, address='change0', type='change', index=0)
+
+    def _tx(self, txid, changes, block_hash=None):
+        tx = Transaction.objects.create(account=self.account, txid=txid, block_hash=block_hash)
+        for address, amount in changes:
+            BalanceChange.objects.create(account=self.account, address=address, transaction=tx, amount=amount)
+        return tx
+
+    def test_totals_follow_balance_changes(self):
+        self._tx('a', [(self.receive, 5000)])
+        spend = self._tx('b', [(self.receive, -5000), (self.change, 3000)])
+
+        self.assertEqual(AddressBalance.objects.get(address=self.receive).balance, 0)
+        self.assertEqual(AddressBalance.objects.get(address=self.receive).tx_count, 2)
+        self.assertEqual(AddressBalance.objects.get(address=self.change).balance, 3000)
+        totals = AccountTotals.objects.get(account=self.account)
+        self.assertEqual((totals.balance, totals.tx_count), (3000, 2))
+
+        spend.delete()
+        self.assertEqual(AddressBalance.objects.get(address=self.receive).balance, 5000)
+        self.assertEqual(AddressBalance.objects.get(address=self.change).tx_count, 0)
+        totals = AccountTotals.objects.get(account=self.account)
+        self.assertEqual((totals.balance, totals.tx_count), (5000, 1))
+
+        with mock.patch('tracker.models.is_feature_enabled', return_value=True):
+            self.assertEqual(self.account.final_balance(), 5000)
+            self.assertEqual(self.account.transactions_count(), 1)
+            self.assertListEqual(list(self.account.get_addresses_with_balance()), [self.receive])
+            self.assertEqual(self.receive.get_balance(), 5000)
+
+    def test_orphan_cleanup_reverses_totals(self):
+        self._tx('a', [(self.receive, 5000)])
+        self._tx('b', [(self.receive, 7000)], block_hash='orphaned')
+        ProcessedBlock.objects.create(network='BTC', block_height=1, block_hash='orphaned', previous_hash='parent',
+                                      block_time='2021-01-01T00:00:00Z')
+
+        ProcessedBlock.orphan_blocks('BTC', ['orphaned'])
+
+        self.assertEqual(AddressBalance.objects.get(address=self.receive).balance, 5000)
+        totals = AccountTotals.objects.get(account=self.account)
+        self.assertEqual((totals.balance, totals.tx_count), (5000, 1))
+
+    def test_verify_and_rebuild(self):
+        self._tx('a', [(self.receive, 5000), (self.change, 1000)])
+        call_command('balances', 'verify')
+
+        AddressBalance.objects.filter(address=self.receive).delete()
+        AccountTotals.objects.filter(account=self.account).update(balance=1, tx_count=7)
+        with self.assertRaises(CommandError):
+            call_command('balances', 'verify')
+
+        call_command('balances', 'rebuild', '--account', str(self.account.id))
+        call_command('balances', 'verify')
+        self.assertEqual(AddressBalance.objects.get(address=self.receive).balance, 5000)
+        self.assertEqual(AccountTotals.objects.get(account=self.account).balance, 6000)
+
+
+class BalanceRollupTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(xpub='xpub-rollups', network='BTC', script_type='p2pkh')
+        self.address = Address.objects.create(account=self.account, address='receive0', type='receive', index=0)
+
+    def _tx(self, txid, block_time, amount):
+        tx = Transaction.objects.create(account=self.account, txid=txid, block_time=block_time)
+        BalanceChange.objects.create(account=self.account, address=self.address, transaction=tx, amount=amount)
+        return tx
+
+    def _buckets(self):
+        return [
+            (bucket.strftime('%Y-%m-%dT%H:%M'), int(amount))
+            for bucket, amount in BalanceRollup.objects.filter(account=self.account).exclude(amount=0)
+            .order_by('bucket').values_list('bucket', 'amount')
+        ]
+
+    def _history(self, start, end, rollups=True):
+        with mock.patch('api.rest.v1.data.balance_history.fetcher.is_feature_enabled', return_value=rollups):
+            start, end = balance_history_fetcher.window('daily', 1000, end, start, 'asc')
+            history, _ = balance_history_fetcher.fetch([(self.account.id, None)], 'daily', start, end, 'asc')
+        return [(time.strftime('%Y-%m-%d'), int(balance)) for time, balance in history[(self.account.id, None)]]
+
+    def test_rollups_follow_balance_changes(self):
+        self._tx('a', '2021-01-01T00:00:10Z', 5000)
+        self._tx('b', '2021-01-01T00:00:50Z', 1000)
+        late = self._tx('c', '2021-01-03T12:00:00Z', -2000)
+
+        self.assertListEqual(self._buckets(), [('2021-01-01T00:00', 6000), ('2021-01-03T12:00', -2000)])
+        self.assertEqual(BalanceRollupTotal.objects.get(account=self.account, erc20_token_id=0).balance, 4000)
+
+        late.block_time = '2021-01-02T12:00:00Z'
+        late.save()
+        self.assertListEqual(self._buckets(), [('2021-01-01T00:00', 6000), ('2021-01-02T12:00', -2000)])
+
+        expected = [('2021-01-02', 4000), ('2021-01-03', 4000), ('2021-01-04', 4000)]
+        self.assertListEqual(self._history('2021-01-02', '2021-01-04'), expected)
+        self.assertListEqual(self._history('2021-01-02', '2021-01-04', rollups=False), expected)
+
+        late.delete()
+        self.assertListEqual(self._buckets(), [('2021-01-01T00:00', 6000)])
+        self.assertEqual(BalanceRollupTotal.objects.get(account=self.account, erc20_token_id=0).balance, 6000)
+
+    def test_fetch_every_series_at_once(self):
+        other = Account.objects.create(xpub='xpub-rollups-2', network='BTC', script_type='p2pkh')
+        other_address = Address.objects.create(account=other, address='receive1', type='receive', index=0)
+        self._tx('a', '2021-01-01T00:00:10Z', 5000)
+        tx = Transaction.objects.create(account=other, txid='b', block_time='2021-01-02T00:00:10Z')
+        BalanceChange.objects.create(account=other, address=other_address, transaction=tx, amount=700)
+
+        start, end = balance_history_fetcher.window('daily', 1000, '2021-01-02', '2021-01-01', 'desc')
+        with mock.patch('api.rest.v1.data.balance_history.fetcher.is_feature_enabled', return_value=False):
+            history, _ = balance_history_fetcher.fetch(
+                [(other.id, None), (self.account.id, None), (other.id, None)], 'daily', start, end, 'desc')
+
+        self.assertListEqual(list(history), [(other.id, None), (self.account.id, None)])
+        self.assertListEqual([int(balance) for _, balance in history[(other.id, None)]], [700, 0])
+        self.assertListEqual([int(balance) for _, balance in history[(self.account.id, None)]], [5000, 5000])
+
+    def test_rebuild_restores_rollups(self):
+        self._tx('a', '2021-01-01T00:00:10Z', 5000)
+        BalanceRollup.objects.filter(account=self.account).delete()
+        with self.assertRaises(CommandError):
+            call_command('balances', 'verify')
+
+        call_command('balances', 'rebuild', '--account', str(self.account.id))
+        call_command('balances', 'verify')
+        self.assertListEqual(self._buckets(), [('2021-01-01T00:00', 5000)])
+
+
+class AccountResolverTest(TestCase):
+    def setUp(self):
+        self.btc = Account.objects.create(xpub='xpub-resolver', network='BTC', script_type='p2pkh')
+        self.ltc = Account.objects.create(xpub='xpub-resolver', network='LTC', script_type='p2pkh')
+        self.resolver = AccountResolver(size=10)
+        patcher = mock.patch('api.rest.v1.data.accounts.resolver.get_registry_version', return_value=1)
+        self.registry_version = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resolve_in_requested_order(self):
+        requested = [('xpub-resolver', 'LTC', 'p2pkh'), ('xpub-resolver', 'BTC', 'p2pkh'), ('xpub-resolver', 'LTC', 'p2pkh')]
+        self.assertListEqual(self.resolver.resolve(requested), [self.ltc, self.btc])
+
+        # known keys are answered from the cache
+        with self.assertNumQueries(1):
+            self.assertListEqual(self.resolver.resolve(requested), [self.ltc, self.btc])
+
+    def test_unregistered(self):
+        with self.assertRaisesMessage(XPubNotRegisteredError, 'Account is not registered: BTC xpub-resolver p2wpkh'):
+            self.resolver.resolve([('xpub-resolver', 'BTC', 'p2pkh'), ('xpub-resolver', 'BTC', 'p2wpkh')])
+
+    def test_unregistered_since_cached(self):
+        key = ('xpub-resolver', 'BTC', 'p2pkh')
+        self.resolver.resolve([key])
+        self.btc.delete()
+
+        with self.assertRaises(XPubNotRegisteredError):
+            self.resolver.resolve([key])
+
+        registered_again = Account.objects.create(xpub='xpub-resolver', network='BTC', script_type='p2pkh')
+        self.assertListEqual(self.resolver.resolve([key]), [registered_again])
+
+    def test_registry_version_clears_cache(self):
+        key = ('xpub-resolver', 'BTC', 'p2pkh')
+        self.resolver.resolve_ids([key])
+        self.registry_version.return_value = 2
+        self.assertDictEqual(self.resolver.resolve_ids([]), {})
+        self.assertNotIn(key, self.resolver.ids)
+
+
+class TransactionExportTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(xpub='xpub-export', network='BTC', script_type='p2pkh')
+        address = Address.objects.create(account=self.account, address='receive0', type='receive', index=0)
+        for txid, block_time, amount in [('a', '2021-01-01T00:00:00Z', 5000), ('b', '2021-01-02T00:00:00Z', -1000),
+                                         ('c', '2021-01-03T00:00:00Z', 2000)]:
+            tx = Transaction.objects.create(account=self.account, txid=txid, block_time=block_time, block_height=1)
+            BalanceChange.objects.create(account=self.account, address=address, transaction=tx, amount=amount)
+        self.xpubs = [{'xpub': 'xpub-export', 'network': 'BTC', 'script_type': 'p2pkh'}]
+
+    @mock.patch('api.rest.v1.data.accounts.resolver.get_registry_version', return_value=0)
+    def test_export_streams_every_page_in_order(self, _):
+        chunks = list(tx_fetcher.export(self.xpubs, fetch_size=2))
+        self.assertListEqual([len(chunk) for chunk in chunks], [2, 1])
+
+        exported = [tx for chunk in chunks for tx in chunk]
+        self.assertListEqual([tx['txid'] for tx in exported], ['c', 'b', 'a'])
+        self.assertListEqual([tx['type'] for tx in exported], ['receive', 'send', 'receive'])
+
+        with mock.patch('api.rest.v1.data.transactions.fetcher.is_feature_enabled', return_value=False):
+            page = tx_fetcher.fetch(self.xpubs, page_size=10)
+        self.assertListEqual(exported, page['data'])
+
+    @mock.patch('api.rest.v1.data.accounts.resolver.get_registry_version', return_value=0)
+    def test_cursor_keeps_every_copy_of_a_tx(self, _):
+        # every tx matches both requested pairs, so it is a row of each
+        Transaction.objects.filter(account=self.account).update(thor_memo='memo')
+        xpubs = self.xpubs + [dict(self.xpubs[0], thor_trades=True)]
+
+        txids = []
+        cursor = None
+        with mock.patch('api.rest.v1.data.transactions.fetcher.is_feature_enabled', return_value=False):
+            for _ in range(10):
+                page = tx_fetcher.fetch(xpubs, page_size=1, cursor=cursor)
+                txids += [tx['txid'] for tx in page['data']]
+                cursor = page['pagination']['next_cursor']
+                if cursor is None:
+                    break
+
+        self.assertListEqual(txids, ['c', 'c', 'b', 'b', 'a', 'a'])
+
+    @mock.patch('api.rest.v1.data.accounts.resolver.get_registry_version', return_value=0)
+    def test_export_of_unregistered_xpub_is_empty(self, _):
+        self.assertListEqual(list(tx_fetcher.export([{'xpub': 'xpub-other', 'network': 'BTC', 'script_type': 'p2pkh'}])), [])
+
+
+class HeaderChainTest(TestCase):
+    def test_find_fork(self):
+        chain = HeaderChain('BTC', size=64)
+        for height in range(100):
+            chain.append(height, 'hash-{}'.format(height), 'hash-{}'.format(height - 1))
+        self.assertEqual(len(chain), 64)
+
+        checked = []
+
+        def on_main_chain(block_hash):
+            checked.append(block_hash)
+            return int(block_hash.split('-')[1]) <= 90
+
+        ancestor, orphans = chain.find_fork(on_main_chain)
+        self.assertEqual(ancestor.hash, 'hash-90')
+        self.assertEqual([header.hash for header in orphans], ['hash-{}'.format(h) for h in range(91, 100)])
+        self.assertLessEqual(len(checked), 7)
+
+        chain.truncate(ancestor)
+        self.assertEqual(chain.tip.hash, 'hash-90')
+
+        # a block that does not extend the tip starts a new chain
+        chain.append(200, 'hash-200', 'hash-199')
+        self.assertEqual(len(chain), 1)
+
+
+class BloomFilterTest(TestCase):
+    def test_no_false_negatives(self):
+        addresses = ['address-{}'.format(i) for i in range(5000)]
+
+        bloom = BloomFilter(len(addresses) * 2, error_rate=0.001)
+        for address in addresses:
+            self.assertTrue(bloom.add(address))
+
+        self.assertEqual(len(bloom), len(addresses))
+        for address in addresses:
+            self.assertIn(address, bloom)
+
+        # re-adding a present address doesn't count it twice
+        self.assertFalse(bloom.add(addresses[0]))
+        self.assertEqual(len(bloom), len(addresses))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add('tracked-{}'.format(i))
+
+        false_positives = sum(1 for i in range(10000) if 'untracked-{}'.format(i) in bloom)
+
+        self.assertLess(false_positives / 10000, 0.02)
+        self.assertLess(bloom.estimated_false_positive_rate(), 0.02)
+
+
+class AsyncConsumerTest(TestCase):
+    @staticmethod
+    def _request(consumer, method, path, body=b'', headers=()):
+        communicator = HttpCommunicator(consumer, method, path, body=body, headers=list(headers))
+        response = async_to_sync(communicator.get_response)()
+        response['headers'] = {name.decode().lower(): value.decode() for name, value in response['headers']}
+        return response
+
+    @mock.patch.object(SendTransactionPage, 'start_watching_tx')
+    @mock.patch('api.rest.v1.async_views.get_coinquery_client')
+    def test_send(self, mock_get_client, mock_start_watching_tx):
+        async def send_async(rawtx):
+            return 'txid'
+        mock_get_client.return_value.send_async.side_effect = send_async
+
+        body = json.dumps({'network': 'BTC', 'rawtx': '0100'}).encode()
+        response = self._request(SendTransactionConsumer, 'POST', '/api/v1/send', body=body)
+
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(json.loads(response['body']), {'success': True, 'txid': 'txid'})
+        mock_get_client.return_value.send_async.assert_called_once_with('0100')
+        mock_start_watching_tx.assert_called_once_with('BTC', 'txid')
+
+        response = self._request(SendTransactionConsumer, 'GET', '/api/v1/send')
+        self.assertEqual(response['status'], 405)
+
+    @override_settings(CORS_ORIGIN_ALLOW_ALL=False, CORS_ORIGIN_WHITELIST=('wallet.example.com',),
+                       CORS_URLS_REGEX=r'^/api/.*$')
+    def test_cors_preflight(self):
+        preflight = [(b'access-control-request-method', b'POST')]
+
+        response = self._request(SendTransactionConsumer, 'OPTIONS', '/api/v1/send',
+                                 headers=preflight + [(b'origin', b'https://wallet.example.com')])
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(response['headers']['access-control-allow-origin'], 'https://wallet.example.com')
+        self.assertIn('POST', response['headers']['access-control-allow-methods'])
+        self.assertIn('Origin', response['headers']['vary'])
+
+        response = self._request(SendTransactionConsumer, 'OPTIONS', '/api/v1/send',
+                                 headers=preflight + [(b'origin', b'https://elsewhere.example.com')])
+        self.assertNotIn('access-control-allow-origin', response['headers'])
+        self.assertIn('Origin', response['headers']['vary'])
+
+        # outside CORS_URLS_REGEX
+        response = self._request(SendTransactionConsumer, 'OPTIONS', '/send',
+                                 headers=preflight + [(b'origin', b'https://wallet.example.com')])
+        self.assertNotIn('access-control-allow-origin', response['headers'])
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        self.store = {}
+        self.versions = [1]
+        self.status = 200
+        self.no_store = False
+        self.computed = 0
+
+        mock_redis = self._patch('api.rest.v1.response_cache.redisClient')
+        mock_redis.get.side_effect = self.store.get
+        mock_redis.setex.side_effect = lambda key, ttl, value: self.store.__setitem__(key, value)
+        self._patch('api.rest.v1.response_cache.is_feature_enabled', return_value=True)
+        self._patch('api.rest.v1.response_cache.account_resolver.resolve_ids',
+                    side_effect=lambda requested: {key: 7 for key in requested})
+        self._patch('api.rest.v1.response_cache.get_versions', side_effect=lambda ids, chain=False: self.versions)
+
+        @cached_response('balance')
+        def handler(view, request):
+            self.computed += 1
+            response = JsonResponse({'computed': self.computed}, status=self.status)
+            if self.no_store:
+                response['Cache-Control'] = 'no-store'
+            return response
+        self.handler = handler
+
+    def _patch(self, target, **kwargs):
+        patch = mock.patch(target, **kwargs)
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+    def _post(self, **extra):
+        body = json.dumps({'data': [{'xpub': 'xpub1', 'network': 'BTC', 'script_type': 'p2pkh'}]})
+        request = RequestFactory().post('/api/v1/balance', data=body, content_type='application/json', **extra)
+        return self.handler(None, request)
+
+    def test_hit_is_served_from_redis(self):
+        first = self._post()
+        second = self._post()
+
+        self.assertEqual(self.computed, 1)
+        self.assertEqual(json.loads(second.content), {'computed': 1})
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_if_none_match(self):
+        etag = self._post()['ETag']
+
+        response = self._post(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.computed, 1)
+
+        self.assertEqual(self._post(HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_errors_and_no_store_are_not_cached(self):
+        self.status = 500
+        self._post()
+        self._post()
+        self.assertEqual(self.computed, 2)
+
+        self.status = 200
+        self.no_store = True
+        response = self._post()
+        self._post()
+        self.assertEqual(self.computed, 4)
+        self.assertNotIn('ETag', response)
+        self.assertDictEqual(self.store, {})
+
+    def test_version_bump_changes_the_key(self):
+        first = self._post()
+        self.versions = [2]
+        second = self._post()
+
+        self.assertEqual(self.computed, 2)
+        self.assertEqual(json.loads(second.content), {'computed': 2})
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(self.store), 2)
+
+
+@mock.patch('api.rest.v1.views.BALANCE_DEADLINE', 0.2)
+class BalanceFanOutTest(TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.page = BalancePage()
+        self.page.failed_branches = set()
+
+    def _fan_out(self, branches, workers=2):
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self.addCleanup(executor.shutdown, wait=False)
+        with mock.patch('api.rest.v1.views._balance_executor', executor):
+            return self.page.fan_out(branches, False)
+
+    def _slow(self):
+        self.release.wait(5)
+        return 'late'
+
+    def test_failed_branch_gets_its_fallback(self):
+        def fail():
+            raise ValueError('upstream down')
+
+        results = self._fan_out([
+            ('utxo', [1], lambda: ['utxo'], []),
+            ('cosmos', [1], fail, ['cosmos fallback']),
+            ('eos', [], fail, ['eos fallback']),
+        ])
+        self.assertListEqual(results, [['utxo'], ['cosmos fallback'], ['eos fallback']])
+        # branches without accounts are not run at all
+        self.assertSetEqual(self.page.failed_branches, {'cosmos'})
+
+    def test_branch_past_the_deadline(self):
+        results = self._fan_out([('utxo', [1], lambda: ['utxo'], []), ('ripple', [1], self._slow, [])])
+        self.assertListEqual(results, [['utxo'], []])
+        self.assertSetEqual(self.page.failed_branches, {'ripple'})
+
+    def test_queued_branch_is_cancelled(self):
+        queued = mock.Mock(return_value=['binance'])
+
+        results = self._fan_out([('ripple', [1], self._slow, []), ('binance', [1], queued, [])], workers=1)
+        self.assertListEqual(results, [[], []])
+        self.assertSetEqual(self.page.failed_branches, {'ripple', 'binance'})
+        self.release.set()
+        queued.assert_not_called()
+
+    @mock.patch('api.rest.v1.views.is_feature_enabled', return_value=False)
+    @mock.patch('api.rest.v1.response_cache.is_feature_enabled', return_value=False)
+    @mock.patch('api.rest.v1.views._unpack_and_validate_xpubs', return_value=[])
+    @mock.patch('api.rest.v1.views._fetch_xpubs_from_db')
+    @mock.patch.object(BalancePage, 'utxo_balances', side_effect=ValueError('upstream down'))
+    def test_partial_response_is_not_stored(self, mock_utxo_balances, mock_fetch_xpubs, *_):
+        mock_fetch_xpubs.return_value = [Account(id=1, xpub='xpub1', network='BTC', script_type='p2pkh')]
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown, wait=False)
+        request = RequestFactory().post('/api/v1/balance', data='{}', content_type='application/json')
+        with mock.patch('api.rest.v1.views._balance_executor', executor):
+            response = BalancePage().post(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(json.loads(response.content), {'success': True, 'data': [], 'failed': ['utxo']})
+        self.assertEqual(response['Cache-Control'], 'no-store')
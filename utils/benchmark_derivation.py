@@ -0,0 +1,69 @@
+#!/bin/env python3
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.utils import bip32, bip32_batch  # noqa: E402
+
+usage = """
+Usage:
+    python3 benchmark_derivation.py [count]
+Example:
+    python3 benchmark_derivation.py 2000 """
+
+XPUB = 'xpub6Chd4kunDV37PJANQzakXojBEUvjfvWk9ZoPuKdc5bDUwFbnA1dd9aScszzcNqzTEMXN9Qor5v9opipuNQf1EVxjdZPs5A5YwuyxFGe4AGu'
+
+CASES = [
+    ('BTC', 'p2pkh'),
+    ('BTC', 'p2sh-p2wpkh'),
+    ('BTC', 'p2wpkh'),
+    ('LTC', 'p2sh-p2wpkh'),
+    ('DOGE', 'p2pkh'),
+    ('BCH', 'p2pkh'),
+]
+
+
+def rate(func, count):
+    started = time.time()
+    addresses = func()
+    return addresses, count / (time.time() - started)
+
+
+def main():
+    if len(sys.argv) > 2:
+        print(usage)
+        exit()
+    count = int(sys.argv[1]) if len(sys.argv) == 2 else 1000
+
+    # build the G table outside of the timings
+    bip32_batch._generator_table()
+    backends = [('native', bip32_batch._NativePublicKey), ('python', None)] if bip32_batch._NativePublicKey \
+        else [('python', None)]
+
+    print('{:<6} {:<12} {:>16} {}'.format('net', 'script', 'legacy addr/s', ' '.join(
+        '{:>22}'.format(name + ' addr/s') for name, _ in backends)))
+
+    for network, script_type in CASES:
+        expected, legacy = rate(
+            lambda: bip32.derive_addresses(XPUB, '0', count, network=network, script_type=script_type), count)
+
+        row = []
+        for name, backend in backends:
+            bip32_batch._NativePublicKey = backend
+            addresses, batched = rate(
+                lambda: bip32_batch.derive_range(XPUB, 0, 0, count, script_type, network), count)
+            if addresses != expected:
+                print('MISMATCH {} {} {}'.format(network, script_type, name))
+                exit(1)
+            row.append('{:>14.0f} {:>6.1f}x'.format(batched, batched / legacy))
+        bip32_batch._NativePublicKey = backends[0][1]
+
+        print('{:<6} {:<12} {:>16.0f} {}'.format(network, script_type, legacy, ' '.join(row)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/bin/env python3
+
+import glob
+import json
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.utils.utxo import map_txs_by_address  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, 'ingester', 'fixtures')
+
+usage = """
+Usage:
+    python3 benchmark_tx_decoder.py [repeat]
+Example:
+    python3 benchmark_tx_decoder.py 50 """
+
+
+def legacy_map_txs_by_address(txs, txs_by_address, filter_addresses):
+    """ map_txs_by_address as it was before the compact decoder, kept as the baseline """
+    for tx in txs:
+        txid = tx.get('txid')
+        vin = tx.get('vin')
+        vout = tx.get('vout')
+
+        for tx_in in vin:
+            address = tx_in.get('addr')
+            satoshis = tx_in.get('valueSat', 0)
+
+            if not address:
+                continue
+
+            should_include_address = (not filter_addresses) or address in filter_addresses
+            if address not in txs_by_address and should_include_address:
+                txs_by_address[address] = {}
+
+            if (filter_addresses and address in filter_addresses) or (
+                    not filter_addresses and address in txs_by_address):
+                txs_by_address[address][txid] = txs_by_address[address].setdefault(txid, 0) - satoshis
+
+        for tx_out in vout:
+            for address in tx_out['scriptPubKey'].get('addresses', []):
+                if (not filter_addresses) or address in filter_addresses:
+                    if address not in txs_by_address:
+                        txs_by_address[address] = {}
+
+                    satoshis = int(Decimal(tx_out.get('value')).quantize(Decimal(10) ** -8) * (10 ** 8))
+                    txs_by_address[address][txid] = txs_by_address[address].setdefault(txid, 0) + satoshis
+
+    return txs_by_address
+
+
+def load_blocks():
+    """ Pair every block in valid_blocks with its transactions from valid_txs """
+    blocks = []
+    for block_file in sorted(glob.glob(os.path.join(FIXTURES, 'valid_blocks', '*', 'block_*.json'))):
+        network = os.path.basename(os.path.dirname(block_file))
+        height = os.path.basename(block_file)[len('block_'):-len('.json')]
+        txs_file = os.path.join(FIXTURES, 'valid_txs', network, 'txs_{}.json'.format(height))
+        if not os.path.exists(txs_file):
+            continue
+
+        with open(txs_file) as f:
+            blocks.append((network, height, json.load(f)['txs']))
+    return blocks
+
+
+def filter_for(txs, size):
+    """ A sync_xpub style filter: size output addresses from the block padded with addresses that are not in it """
+    addresses = [address for tx in txs for tx_out in tx['vout'] for address in tx_out['scriptPubKey'].get('addresses', [])]
+    addresses = addresses[::max(len(addresses) // size, 1)][:size]
+    return addresses + ['unused{}'.format(i) for i in range(size - len(addresses))]
+
+
+def time_map(func, txs, filter_addresses, repeat):
+    return min(timeit.repeat(lambda: func(txs, {}, filter_addresses), number=1, repeat=repeat))
+
+
+def main():
+    if len(sys.argv) > 2:
+        print(usage)
+        exit()
+    repeat = int(sys.argv[1]) if len(sys.argv) == 2 else 20
+
+    scenarios = [('block', 0), ('xpub x10', 10), ('xpub x100', 100)]
+    totals = {name: [0, 0] for name, _ in scenarios}
+
+    print('{:<6} {:<8} {:>5}  {}'.format('net', 'block', 'txs', '  '.join(
+        '{:>24}'.format(name + ' legacy/decoder us') for name, _ in scenarios)))
+
+    for network, height, txs in load_blocks():
+        row = []
+        for name, size in scenarios:
+            filter_addresses = filter_for(txs, size) if size else []
+            if legacy_map_txs_by_address(txs, {}, filter_addresses) != map_txs_by_address(txs, {}, filter_addresses):
+                print('MISMATCH {} {} {}'.format(network, height, name))
+                exit(1)
+
+            legacy = time_map(legacy_map_txs_by_address, txs, filter_addresses, repeat)
+            decoder = time_map(map_txs_by_address, txs, filter_addresses, repeat)
+            totals[name][0] += legacy
+            totals[name][1] += decoder
+            row.append('{:>10.0f} /{:>7.0f} {:>4.1f}x'.format(legacy * 1e6, decoder * 1e6, legacy / decoder))
+
+        print('{:<6} {:<8} {:>5}  {}'.format(network, height, len(txs), '  '.join(row)))
+
+    print('{:<6} {:<8} {:>5}  {}'.format('total', '', '', '  '.join(
+        '{:>10.0f} /{:>7.0f} {:>4.1f}x'.format(legacy * 1e6, decoder * 1e6, legacy / decoder)
+        for legacy, decoder in totals.values())))
+
+
+if __name__ == '__main__':
+    main()